@@ -0,0 +1,1223 @@
+"""
+效能量測腳本：比對新舊計算引擎的輸出是否一致，並量測計算、模擬與繪圖的耗時。
+用法：python benchmark.py
+微基準回歸測試 (計算引擎、圖表設定、Flex Message、Sheets 資料列)：
+    python benchmark.py --suite --save benchmark_baseline.json      # 記錄基準
+    python benchmark.py --suite --compare benchmark_baseline.json   # 與基準比較，任一案例變慢超過 --threshold 時結束代碼為 1
+冷啟動量測 (以 -X importtime 分析 import main，並以 uvicorn 子行程量測第一個回應的時間)：
+    python benchmark.py --startup
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import urllib.error
+import urllib.request
+
+from calculator import PlanResultCache, calculate_retirement_plan, calculate_retirement_plan_fast, calculate_retirement_plans, calculate_sensitivity_grid, solve_min_monthly_saving, simulate_retirement_plan
+from chart_util import render_chart_png, ChartCache, ChartPrerenderer, chart_cache_key, quickchart_request_body
+from flex_util import create_flex_message, build_result_message, build_profile_message, build_summary_message, build_info_message, build_text_message, profile_bubble, color_for_profile, ProfileMessageCache, PROFILE_TYPES
+from line_util import prepare_messages, push_body, reply_body, multicast_body, MULTICAST_MAX_RECIPIENTS
+from bulk_util import BulkSendStore, BulkSender
+from storage_util import ResultStore, PlanStore, SheetsReplicator
+from sheets_util import build_row, MemorySheetSink, SheetsWriteBuffer, SHEETS_ROWS_SPILLED
+from payload_util import FastJSONResponse, encode_history, decode_history, dumps
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from command_util import CommandRouter
+from metrics_util import Counter, Histogram
+from webhook_util import WebhookDispatcher, EventDedupeCache
+from linebot.v3.webhooks import MessageEvent, TextMessageContent
+from linebot.v3.messaging import ApiClient, Configuration, FlexContainer, FlexMessage, PushMessageRequest, ReplyMessageRequest, MulticastRequest
+
+
+def random_plan_inputs(rng: random.Random) -> tuple:
+    """產生一組隨機但合理的試算參數 (含整數、整數金額與任意小數)"""
+    current_age = rng.randint(18, 80)
+    return (
+        current_age,
+        rng.randint(current_age - 3, current_age + 45),
+        rng.choice([30000, 40000.0, round(rng.uniform(0, 100000), 2)]),
+        rng.choice([0, 10000.0, round(rng.uniform(0, 50000), 2)]),
+        rng.choice([10000, 20000.0, round(rng.uniform(0, 100000), 2)]),
+        rng.choice([1000000, 0.0, round(rng.uniform(0, 10000000), 2)]),
+        rng.choice([90, 100, 120]),
+        rng.choice([0.015, 0.0, round(rng.uniform(-0.05, 0.1), 4)]),
+    )
+
+
+# 隨機輸入不易產生的情況：已退休、年數 <= 0、整數利率 (金額維持整數)、超出通膨倍數表、超出 64 位元的金額
+CALCULATOR_EDGE_CASES = [
+    (70, 60, 30000, 0, 0, 100, 100, 0.015),
+    (90, 65, 30000.0, 0.0, 10000.0, 1e6, 90, 0.0),
+    (95, 65, 30000.0, 0.0, 10000.0, 1e6, 90, 0.0),
+    (30, 30, 30000, 0, 10000, 0, 31, 0.0),
+    (30, 200, 1, 1, 1, 1, 100, 0.01),
+    (30, 65, 30000, 10000, 10000, 0, 100, 0),
+    (30, 65, 30000, 0, 10000, 10 ** 17 + 1, 100, 0),
+    (30, 29, -30000.0, 5.0, -10000.0, -7.0, 80, -0.5),
+    (30, 65, 0, 0, 0, 0, 100, -1.0),
+    (20, 10, 1, 1, 1, 1, 230, 0.01),
+    (30, 65, 30000, 0, 10000, 10 ** 19, 100, 0.015),
+    (30, 65, 30000, 0, 10000, 1e300, 100, 0.0),
+]
+
+
+def check_calculator_parity(samples: int = 20000, seed: int = 42) -> int:
+    """確認 calculate_retirement_plan_fast 與逐年迴圈的 JSON 輸出逐位元相同 (含 int / float 型別)，回傳不一致的筆數"""
+    rng = random.Random(seed)
+    mismatches = 0
+    for args in [random_plan_inputs(rng) for _ in range(samples)] + CALCULATOR_EDGE_CASES:
+        if json.dumps(calculate_retirement_plan(*args)) != json.dumps(calculate_retirement_plan_fast(*args)):
+            mismatches += 1
+            print(f"  不一致: {args}")
+    return mismatches
+
+
+def check_batch_parity(samples: int = 5000, seed: int = 7) -> int:
+    """確認批次試算與逐筆呼叫 calculate_retirement_plan 的結果相同，回傳不一致的筆數"""
+    rng = random.Random(seed)
+    rows = [random_plan_inputs(rng) for _ in range(samples)]
+    batch = calculate_retirement_plans(*zip(*rows), include_history=True)
+    mismatches = 0
+    for i, args in enumerate(rows):
+        expected = calculate_retirement_plan(*args)
+        actual = {key: batch[key][i] for key in expected}
+        if expected != actual:
+            mismatches += 1
+            print(f"  不一致: {args}")
+    return mismatches
+
+
+def check_sensitivity_parity(samples: int = 300, seed: int = 41) -> int:
+    """確認敏感度分析每一格的缺口與交叉點都和逐筆呼叫 calculate_retirement_plan 相同，回傳不一致的格數"""
+    rng = random.Random(seed)
+    mismatches = 0
+    for _ in range(samples):
+        args = random_plan_inputs(rng)
+        current_age, _, basic, fun, _, saving, max_age, _ = args
+        retire_ages = sorted(rng.sample(range(current_age - 3, current_age + 46), 4))
+        monthly_savings = [0, 10000.0, round(rng.uniform(0, 100000), 2)]
+        interest_rates = [0.0, 0.015, round(rng.uniform(-0.05, 0.1), 4)]
+        grid = calculate_sensitivity_grid(current_age, retire_ages, basic, fun, monthly_savings, saving, max_age, interest_rates)
+        for a, retire_age in enumerate(retire_ages):
+            for j, monthly_saving in enumerate(monthly_savings):
+                for i, interest_rate in enumerate(interest_rates):
+                    expected = calculate_retirement_plan(current_age, retire_age, basic, fun, monthly_saving, saving, max_age, interest_rate)
+                    if (grid["gap"][a][j][i], grid["crossover_age"][a][j][i]) != (expected["gap"], expected["crossover_age"]):
+                        mismatches += 1
+                        print(f"  不一致: {(current_age, retire_age, basic, fun, monthly_saving, saving, max_age, interest_rate)}")
+    return mismatches
+
+
+def check_solver_parity(samples: int = 300, seed: int = 43) -> int:
+    """
+    以 calculate_retirement_plan 驗證最低月存款：解出的金額缺口為 0、少 1 元時缺口不為 0；
+    無解 (None) 時即使月存款為 0 或極大，缺口都不為 0。回傳不一致的組合數。
+    """
+    rng = random.Random(seed)
+    mismatches = 0
+    for _ in range(samples):
+        current_age, _, basic, fun, _, saving, max_age, _ = random_plan_inputs(rng)
+        retire_ages = sorted(rng.sample(range(current_age - 3, current_age + 46), 4))
+        interest_rates = [0.0, 0.015, round(rng.uniform(-0.05, 0.1), 4)]
+        solved = solve_min_monthly_saving(current_age, retire_ages, basic, fun, saving, max_age, interest_rates)
+        for a, retire_age in enumerate(retire_ages):
+            for i, interest_rate in enumerate(interest_rates):
+                def gap(monthly_saving):
+                    return calculate_retirement_plan(current_age, retire_age, basic, fun, monthly_saving, saving, max_age, interest_rate)["gap"]
+                minimum = solved["min_monthly_saving"][a][i]
+                if minimum is None:
+                    ok = gap(0) > 0 and gap(1e9) > 0
+                else:
+                    ok = gap(minimum) == 0 and (minimum == 0 or gap(minimum - 1) > 0)
+                if not ok:
+                    mismatches += 1
+                    print(f"  不一致: {(current_age, retire_age, basic, fun, saving, max_age, interest_rate)} -> {minimum}")
+    return mismatches
+
+
+def check_simulation_parity(samples: int = 300, seed: int = 44) -> int:
+    """
+    蒙地卡羅模擬的一致性：
+    1. 波動度為 0 時每條路徑都等於 calculate_retirement_plan (含已退休者)：
+       各百分位數帶等於存款軌跡 (閉式解與逐年迴圈的浮點誤差容許 1 元或 1e-9 相對誤差)，
+       成功機率為 0 或 1、交叉點全部落在同一年齡
+    2. 相同 seed 結果完全相同
+    3. 分段模擬 (chunk_size) 的成功機率與交叉點分佈與一次模擬完全相同 (百分位數帶為直方圖近似值，不比較)
+    回傳不一致的組合數。
+    """
+    rng = random.Random(seed)
+    cases = [random_plan_inputs(rng) for _ in range(samples)]
+    # 已退休 (退休年齡小於或等於目前年齡)
+    cases += [(70, 65, 40000, 10000, 20000, 5000000, 100, 0.015), (65, 65, 30000, 0, 0, 8000000, 90, 0.0),
+              (80, 60, 25000.5, 5000, 0, 1234567.89, 120, 0.03)]
+    mismatches = 0
+    for args in cases:
+        current_age, retire_age, basic, fun, saving, current_saving, max_age, interest_rate = args
+        expected = calculate_retirement_plan(*args)
+        simulated = simulate_retirement_plan(current_age, retire_age, basic, fun, saving, current_saving, max_age, interest_rate,
+                                             paths=4, return_volatility=0.0, inflation_volatility=0.0)
+        funds = expected["history"]["funds"]
+        bands_ok = all(
+            all(abs(a - b) <= max(1, abs(b) * 1e-9) for a, b in zip(band, funds))
+            for band in simulated["history"]["funds_percentiles"].values()
+        )
+        distribution = simulated["crossover_age_distribution"]
+        crossover_age = expected["crossover_age"]
+        if crossover_age is None:
+            crossover_ok = distribution["never"] == 1
+        else:
+            crossover_ok = distribution["probability"][crossover_age - current_age - 1] == 1
+        success_ok = simulated["success_probability"] == (expected["gap"] == 0)
+        if not (bands_ok and crossover_ok and success_ok):
+            mismatches += 1
+            print(f"  模擬與試算不一致: {args}")
+
+    args = (30, 65, 40000, 10000, 20000, 1000000)
+    single = simulate_retirement_plan(*args, paths=5000, seed=7)
+    if simulate_retirement_plan(*args, paths=5000, seed=7) != single:
+        mismatches += 1
+        print("  相同 seed 的模擬結果不同")
+    for chunk_size in (1, 333, 4096):
+        chunked = simulate_retirement_plan(*args, paths=5000, seed=7, chunk_size=chunk_size)
+        if (chunked["success_probability"] != single["success_probability"]
+                or chunked["crossover_age_distribution"] != single["crossover_age_distribution"]):
+            mismatches += 1
+            print(f"  分段模擬 (chunk_size={chunk_size}) 的成功機率或交叉點分佈與一次模擬不同")
+    return mismatches
+
+
+def legacy_result_message(result: dict, chart_url: str, max_age: int, interest_rate: float) -> FlexMessage:
+    """原本的做法：每次組出完整 dict，再由 FlexContainer.from_dict 走訪驗證整棵樹"""
+    contents = FlexContainer.from_dict(create_flex_message(result, chart_url, max_age, interest_rate))
+    return FlexMessage(alt_text="您的財富規劃試算結果出爐了！", contents=contents)
+
+
+def legacy_profile_message(profile_type: str, image_url: str) -> FlexMessage:
+    contents = FlexContainer.from_dict(profile_bubble(image_url, profile_type, color_for_profile(profile_type)))
+    return FlexMessage(alt_text=f"專屬理財類型分析結果：{profile_type}", contents=contents)
+
+
+def check_flex_parity(samples: int = 2000, seed: int = 3) -> int:
+    """確認 Flex 範本產生的訊息與原本逐次建立的訊息序列化結果相同，回傳不一致的筆數"""
+    rng = random.Random(seed)
+    mismatches = 0
+    for i in range(samples):
+        args = random_plan_inputs(rng)
+        result = calculate_retirement_plan(*args)
+        chart_url = f"https://example.com/static/charts/{i}.png"
+        expected = legacy_result_message(result, chart_url, args[6], args[7]).to_dict()
+        actual = build_result_message(result, chart_url, args[6], args[7]).to_dict()
+        profile_type = rng.choice(["積極型", "穩健型", "保守型"])
+        image_url = f"https://example.com/profile/{i}.png"
+        if expected != actual or legacy_profile_message(profile_type, image_url).to_dict() != build_profile_message(profile_type, image_url).to_dict():
+            mismatches += 1
+            print(f"  不一致: {args}")
+    return mismatches
+
+
+SDK_API_CLIENT = ApiClient(Configuration(access_token="benchmark"))
+
+
+def sdk_push_body(to: str, messages: list) -> bytes:
+    """SDK 原本每次推送的序列化流程：建立 PushMessageRequest 並轉成 JSON"""
+    return json.dumps(SDK_API_CLIENT.sanitize_for_serialization(PushMessageRequest(to=to, messages=messages))).encode("utf-8")
+
+
+def sdk_reply_body(reply_token: str, messages: list) -> bytes:
+    return json.dumps(SDK_API_CLIENT.sanitize_for_serialization(ReplyMessageRequest(reply_token=reply_token, messages=messages))).encode("utf-8")
+
+
+def check_prepared_parity() -> int:
+    """確認預先序列化的推播 / 回覆內容與 SDK 每次序列化的結果相同，回傳不一致的筆數"""
+    mismatches = 0
+    for profile_type in PROFILE_TYPES + ("其他",):
+        image_url = f"https://example.com/profile/{profile_type}.png"
+        expected = json.loads(sdk_push_body("U" + "0" * 32, [build_profile_message(profile_type, image_url)]))
+        actual = json.loads(push_body("U" + "0" * 32, prepare_messages([build_profile_message(profile_type, image_url)])))
+        if expected != actual:
+            mismatches += 1
+            print(f"  不一致: {profile_type}")
+
+    plan = {"created_at": "2026-01-01 09:00:00", "profile_type": "穩健型", "max_age": 95, "interest_rate": 0.02}
+    plan.update(calculate_retirement_plan(35, 65, 30000, 10000, 15000, 500000, 95, 0.02))
+    replies = {
+        "summary": [build_summary_message(plan)],
+        "info": [build_info_message("財稅優化策略", "說明", "預約一對一諮詢", "https://example.com/booking")],
+        "text": [build_text_message("目前還沒有您的試算紀錄")]
+    }
+    for name, messages in replies.items():
+        expected = json.loads(sdk_reply_body("0" * 32, messages))
+        actual = json.loads(reply_body("0" * 32, prepare_messages(messages)))
+        if expected != actual:
+            mismatches += 1
+            print(f"  回覆不一致: {name}")
+
+    to = [f"U{i:032d}" for i in range(MULTICAST_MAX_RECIPIENTS)]
+    messages = replies["summary"]
+    expected = SDK_API_CLIENT.sanitize_for_serialization(MulticastRequest(to=to, messages=messages))
+    if expected != json.loads(multicast_body(to, prepare_messages(messages))):
+        mismatches += 1
+        print("  multicast 不一致")
+    return mismatches
+
+
+def check_command_router() -> int:
+    """文字指令比對：完全相符、全形 / 標點 / 空白差異、指令開頭與只打一半的指令，回傳錯誤數"""
+    router = CommandRouter()
+    for command, aliases in (("財稅優化策略", ()), ("資產傳承規劃", ()), ("試算", ("退休試算",)), ("我的結果", ("試算結果",))):
+        router.add(command, command, aliases=aliases)
+    cases = {
+        "財稅優化策略": "財稅優化策略", " 財稅優化策略！": "財稅優化策略", "資產 傳承 規劃": "資產傳承規劃",
+        "財稅": "財稅優化策略", "資產傳承": "資產傳承規劃", "試算": "試算", "試算：我今年35歲": "試算",
+        "退休試算": "試算", "試算結果": "我的結果", "試算結": "我的結果", "我的": "我的結果",
+        "財": None, "你好": None, "": None, "？？": None
+    }
+    errors = 0
+    for text, expected in cases.items():
+        if router.match(text) != expected:
+            errors += 1
+            print(f"  指令比對錯誤: {text!r} -> {router.match(text)!r} (預期 {expected!r})")
+    return errors
+
+
+def webhook_text_event(event_id: str, text: str, redelivery: bool = False) -> dict:
+    return {
+        "type": "message", "mode": "active", "timestamp": 1700000000000,
+        "source": {"type": "user", "userId": "U" + "0" * 32},
+        "webhookEventId": event_id, "deliveryContext": {"isRedelivery": redelivery},
+        "replyToken": "0" * 32,
+        "message": {"type": "text", "id": event_id, "quoteToken": "q", "text": text}
+    }
+
+
+def signed_webhook(channel_secret: str, events: list) -> tuple:
+    body = json.dumps({"destination": "U" + "1" * 32, "events": events}).encode("utf-8")
+    signature = base64.b64encode(hmac.new(channel_secret.encode("utf-8"), body, hashlib.sha256).digest()).decode()
+    return body, signature
+
+
+def check_webhook_dedupe(unique_events: int = 5000, max_deliveries: int = 5, seed: int = 11) -> int:
+    """
+    重送風暴：每個事件送達 1~max_deliveries 次、順序打亂、每個請求夾帶 1~5 個事件，
+    確認每個事件只交給 handler 一次，且磁碟層在「重啟」(新的 EventDedupeCache) 後仍能辨識。回傳錯誤數。
+    """
+    rng = random.Random(seed)
+    secret = "benchmark-secret"
+    deliveries = []
+    for i in range(unique_events):
+        event_id = f"01H{i:023d}"
+        for attempt in range(rng.randint(1, max_deliveries)):
+            deliveries.append(webhook_text_event(event_id, f"訊息 {i}", redelivery=attempt > 0))
+    rng.shuffle(deliveries)
+    requests = []
+    while deliveries:
+        size = rng.randint(1, 5)
+        requests.append(signed_webhook(secret, deliveries[:size]))
+        deliveries = deliveries[size:]
+    total_events = sum(len(json.loads(body)["events"]) for body, _ in requests)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        disk_path = os.path.join(tmp, "dedupe.db")
+
+        async def replay(payloads: list) -> tuple:
+            handled = {}
+            dispatcher = WebhookDispatcher(secret, max_queue=len(payloads), dedupe=EventDedupeCache(disk_path=disk_path))
+
+            @dispatcher.add(MessageEvent, message=TextMessageContent)
+            async def count(event):
+                handled[event.webhook_event_id] = handled.get(event.webhook_event_id, 0) + 1
+
+            await dispatcher.start()
+            started = time.perf_counter()
+            for body, signature in payloads:
+                dispatcher.accept(body, signature)
+            await dispatcher.stop(drain_seconds=600)
+            return handled, dispatcher.stats(), time.perf_counter() - started
+
+        handled, stats, seconds = asyncio.run(replay(requests))
+        # 模擬重啟後 LINE 再重送一輪：全部都應該被磁碟層擋下
+        handled_after_restart, _, _ = asyncio.run(replay(requests[:200]))
+
+    errors = sum(1 for count in handled.values() if count != 1) + (unique_events - len(handled)) + len(handled_after_restart)
+    print(
+        f"Webhook 重送風暴：{len(requests)} 個請求 / {total_events} 個事件 / {unique_events} 個不重複，"
+        f"略過重複 {stats['duplicates']} 個 ({stats['duplicates'] / total_events:.1%})，"
+        f"{total_events / seconds:,.0f} 事件/秒，重啟後重複處理 {len(handled_after_restart)} 個"
+    )
+    return errors
+
+
+def check_sheets_buffer(batches: int = 4, rows_per_batch: int = 1500) -> int:
+    """
+    強制 Google Sheets 寫入失敗 (整批失敗與分段寫入中途失敗)，確認失敗的資料暫存到檔案後補寫
+    (每次只讀出暫存檔的一部分)，每一列最後都恰好寫入一次且順序不變。回傳遺失、重複或順序錯誤的列數。
+    """
+    rows = [[f"row-{i}", i] for i in range(batches * rows_per_batch)]
+    # 第 1 次呼叫整批失敗；補寫時分段寫入，第 3 次呼叫 (第二段) 失敗，第一段已寫入的列不應重寫
+    sink = MemorySheetSink(fail_times=1, fail_on_calls=(3,))
+    with tempfile.TemporaryDirectory() as tmp:
+        spill_path = os.path.join(tmp, "sheets_spill.jsonl")
+        buffer = SheetsWriteBuffer(sink, batch_rows=len(rows) + 1, flush_seconds=3600, max_pending_rows=len(rows) + 1,
+                                   spill_path=spill_path, retry_seconds=0.05, spill_read_rows=700)
+        spilled_before = SHEETS_ROWS_SPILLED.values().get((), 0)
+        for b in range(batches):
+            for row in rows[b * rows_per_batch:(b + 1) * rows_per_batch]:
+                buffer.put(row)
+            buffer.flush()
+            # 等重試時間到期，下一批才會連同暫存檔一起補寫
+            time.sleep(0.06)
+        buffer.close()
+        spilled = SHEETS_ROWS_SPILLED.values().get((), 0) - spilled_before
+        leftover = os.path.exists(spill_path)
+
+    written = [row[1] for row in sink.rows]
+    expected = [row[1] for row in rows]
+    duplicates = len(written) - len(set(written))
+    missing = len(set(expected) - set(written))
+    errors = duplicates + missing + int(leftover)
+    if not errors and written != expected:
+        errors = sum(1 for a, b in zip(written, expected) if a != b)
+    print(f"Google Sheets 緩衝：{len(rows)} 列，{sink.calls} 次寫入 (失敗 2 次)，暫存後補寫 {spilled} 列，寫入 {len(written)} 列")
+    return errors
+
+
+def check_sheets_replicator() -> int:
+    """
+    SQLite 同步到 Google Sheets：工作表寫入失敗時紀錄須保持未同步、下一輪重寫；
+    已填理財人格的新紀錄直接寫在同一列；工作表上找不到該列時理財人格更新保留到下一輪。回傳錯誤數。
+    """
+    sink = MemorySheetSink(fail_times=1)
+    missing_users = {"U1"}
+    profile_updates = []
+
+    def update_profile(user_id, profile_type, allocations):
+        if user_id in missing_users or not any(row[1] == user_id for row in sink.rows):
+            return False
+        profile_updates.append((user_id, profile_type))
+        return True
+
+    saved_env = {name: os.environ.get(name) for name in ("GOOGLE_APPLICATION_CREDENTIALS", "GOOGLE_SHEET_URL")}
+    os.environ.update({name: value or "benchmark" for name, value in saved_env.items()})
+    errors = 0
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            store = PlanStore(os.path.join(tmp, "plans.db"))
+            replicator = SheetsReplicator(store, writer=SheetsWriteBuffer(sink, spill_path=None), update_profile=update_profile)
+            request_data = {"current_age": 30, "retire_age": 65, "monthly_basic_expense": 20000,
+                            "monthly_fun_expense": 5000, "current_saving": 100000}
+            result = calculate_retirement_plan(30, 65, 20000, 5000, 10000, 100000)
+            for user_id in ("U0", "U1", "U2"):
+                store.save_plan(user_id, user_id, request_data, result)
+            store.update_profile("U0", "穩健型", {"stock": 30})
+
+            # 第一輪寫入失敗：紀錄都應保持未同步
+            errors += replicator._replicate_safely()
+            errors += len(store.unsynced_plans()) != 3
+            # 第二輪寫入成功：三列都寫入，U0 的理財人格直接寫在新的一列，不需另外更新
+            errors += not replicator._replicate_safely()
+            errors += [row[1] for row in sink.rows] != ["U0", "U1", "U2"] or sink.rows[0][12] != "穩健型"
+            errors += len(store.unsynced_plans()) + len(store.unsynced_profiles()) + len(profile_updates)
+
+            # 工作表上找不到 U1 的列：更新保留，之後找得到時才同步
+            store.update_profile("U1", "積極型", {"stock": 60})
+            replicator.replicate()
+            errors += len(store.unsynced_profiles()) != 1
+            missing_users.clear()
+            replicator.replicate()
+            errors += len(store.unsynced_profiles()) + (profile_updates != [("U1", "積極型")])
+            store.close()
+    finally:
+        for name, value in saved_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+    print(f"Google Sheets 同步：{len(sink.rows)} 列，{sink.calls} 次寫入 (失敗 1 次)，理財人格更新 {len(profile_updates)} 次")
+    return errors
+
+
+def check_webhook_retry(events: int = 60, fail_every: int = 3) -> int:
+    """
+    handler 失敗的事件應取消去重記錄：第一輪每 fail_every 個事件失敗一次，LINE 重送整批後，
+    失敗的事件再處理一次並成功，成功過的事件不重複處理。
+    最前面另有一個格式錯誤 (解析到一半失敗) 的請求，其中已登記的事件之後仍須處理。回傳錯誤數。
+    """
+    secret = "benchmark-secret"
+    malformed = signed_webhook(secret, [webhook_text_event(f"01R{i:023d}", f"訊息 {i}", redelivery=False) for i in range(3)] + [42])
+    payloads = [malformed] + [signed_webhook(secret, [webhook_text_event(f"01R{i:023d}", f"訊息 {i}", redelivery=attempt > 0)
+                                                      for i in range(j, min(j + 5, events))])
+                              for attempt in range(2) for j in range(0, events, 5)]
+    failing = {f"01R{i:023d}" for i in range(0, events, fail_every)}
+    attempts = {}
+    succeeded = {}
+
+    async def replay():
+        dispatcher = WebhookDispatcher(secret, max_queue=len(payloads), dedupe=EventDedupeCache())
+
+        @dispatcher.add(MessageEvent, message=TextMessageContent)
+        async def flaky(event):
+            event_id = event.webhook_event_id
+            attempts[event_id] = attempts.get(event_id, 0) + 1
+            if event_id in failing and attempts[event_id] == 1:
+                raise RuntimeError("模擬 handler 失敗")
+            succeeded[event_id] = succeeded.get(event_id, 0) + 1
+
+        await dispatcher.start()
+        for body, signature in payloads:
+            dispatcher.accept(body, signature)
+        await dispatcher.stop(drain_seconds=600)
+
+    asyncio.run(replay())
+    errors = (events - len(succeeded)) + sum(1 for count in succeeded.values() if count != 1)
+    errors += sum(1 for event_id, count in attempts.items() if count != (2 if event_id in failing else 1))
+    print(f"Webhook 失敗重送：{len(failing)} 個事件第一次處理失敗，重送後成功 {sum(1 for e in failing if succeeded.get(e) == 1)} 個")
+    return errors
+
+
+def check_history_encoding(cases: int = 2000, seed: int = 23) -> int:
+    """精簡歷年軌跡格式：隨機試算結果編碼後再解碼須與原本相同，回傳不一致的筆數"""
+    rng = random.Random(seed)
+    mismatches = 0
+    for _ in range(cases):
+        current_age = rng.randint(20, 60)
+        result = calculate_retirement_plan(
+            current_age, rng.randint(current_age, 70), rng.uniform(0, 200000), rng.uniform(0, 50000),
+            rng.uniform(0, 100000), rng.choice([0.0, rng.uniform(0, 5e7), round(rng.uniform(0, 5e7))]),
+            rng.randint(80, 120), rng.uniform(0, 0.1)
+        )
+        encoded = json.loads(json.dumps(encode_history(result["history"])))
+        if decode_history(encoded) != result["history"]:
+            mismatches += 1
+    return mismatches
+
+
+def check_large_payload() -> int:
+    """極大的存款使金額超出 64 位元整數 (orjson 不支援)，dumps 應改用標準 json 且內容與 JSONResponse 相同，回傳不一致的筆數"""
+    mismatches = 0
+    for current_saving in (10 ** 19, 10 ** 30, 1e300):
+        result = calculate_retirement_plan(30, 65, 30000, 10000, 10000, current_saving)
+        try:
+            if json.loads(dumps(result)) != json.loads(JSONResponse(result).body):
+                mismatches += 1
+        except TypeError as e:
+            mismatches += 1
+            print(f"  序列化失敗: current_saving={current_saving}: {e}")
+    return mismatches
+
+
+class FakeMulticastClient:
+    """本機假的 LINE multicast：記錄每位收件人收到的訊息；fail_calls 指定的第幾次請求回傳錯誤"""
+
+    def __init__(self, fail_calls: set = frozenset()):
+        self.fail_calls = fail_calls
+        self.calls = 0
+        self.received = {}
+        self.retry_keys = set()
+
+    async def multicast_prepared(self, to: list, messages_json: bytes, retry_key: str = None):
+        self.calls += 1
+        if self.calls in self.fail_calls:
+            raise ConnectionError("fake LINE API error")
+        # 與 LINE 相同：已接受過的 retry key 不會再送出
+        if retry_key in self.retry_keys:
+            return None
+        self.retry_keys.add(retry_key)
+        for user_id in to:
+            self.received.setdefault(user_id, []).append(messages_json)
+
+
+def check_bulk_send(recipients: int = 3000, cohorts: int = 3, seed: int = 17) -> int:
+    """
+    批次推送：recipients 位使用者分屬 cohorts 組相同的試算結果 (另有少數重複的收件人)，
+    以假的 LINE API 與假的繪圖函式執行；第一次執行時讓部分批次失敗，繼續 (resume) 後
+    確認每位使用者剛好收到一次正確的訊息、每組只繪製一次圖表、每次 multicast 不超過上限。
+    另有一組 result_id 已過期的收件人 ({"error": ...})，只有該組失敗且不會收到訊息。回傳錯誤數。
+    """
+    rng = random.Random(seed)
+    payloads = []
+    for i in range(cohorts):
+        result = calculate_retirement_plan(30 + i, 65, 30000, 10000, 15000, 500000)
+        payloads.append({"result": result, "history": {"ages": [30 + i, 65]}, "max_age": 100, "interest_rate": 0.015})
+    members = [(f"U{i:032d}", rng.randrange(cohorts)) for i in range(recipients)]
+    recipient_list = [(user_id, payloads[cohort]) for user_id, cohort in members]
+    recipient_list += rng.sample(recipient_list, recipients // 20)
+    expired = [f"X{i:032d}" for i in range(10)]
+    recipient_list += [(user_id, {"error": "Result expired or not found, please recalculate"}) for user_id in expired]
+
+    renders = []
+
+    def build_messages(payload: dict) -> bytes:
+        renders.append(payload["history"]["ages"][0])
+        return json.dumps(payload["history"]).encode("utf-8")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = BulkSendStore(os.path.join(tmp, "bulk.db"))
+        client = FakeMulticastClient(fail_calls={1, 3})
+        sender = BulkSender(store, client, build_messages)
+        started = time.perf_counter()
+        job_id = sender.submit(recipient_list)
+        first = asyncio.run(sender.run_job(job_id))
+        second = asyncio.run(sender.run_job(job_id))
+        seconds = time.perf_counter() - started
+        store.close()
+
+    errors = 0
+    for user_id, cohort in members:
+        expected = json.dumps(payloads[cohort]["history"]).encode("utf-8")
+        if client.received.get(user_id) != [expected]:
+            errors += 1
+    errors += sum(1 for user_id in expired if user_id in client.received)
+    errors += len(renders) != cohorts
+    errors += first["status"] != "failed" or first["batches_failed"] != 3
+    errors += second["status"] != "failed" or second["batches_failed"] != 1 or second["recipients_sent"] != recipients
+    print(
+        f"批次推送 {recipients} 位 / {cohorts} 組內容：繪圖 {len(renders)} 次，multicast {client.calls} 次 "
+        f"(含 2 次失敗後繼續)，{seconds * 1000:.1f} ms"
+    )
+    return errors
+
+
+def api_plan_inputs(args: tuple) -> tuple:
+    """CalculateRequest 驗證後的型別：年齡為 int，金額與利率為 float"""
+    return tuple(int(value) if i in (0, 1, 6) else float(value) for i, value in enumerate(args))
+
+
+def check_plan_cache(samples: int = 5000, seed: int = 31) -> int:
+    """
+    快取的結果序列化後需與直接計算逐位元相同；整數 / 小數寫法不同的相同輸入需命中同一筆快取，
+    且每次回傳新的複本 (修改回傳值不影響下一次命中)；從資料庫取出的常見輸入預先計算後，再次試算時直接命中。回傳錯誤數。
+    """
+    rng = random.Random(seed)
+    cache = PlanResultCache(max_entries=samples // 2)
+    errors = 0
+    for _ in range(samples):
+        args = random_plan_inputs(rng)
+        expected = dumps(calculate_retirement_plan(*api_plan_inputs(args)))
+        first = cache.calculate(*api_plan_inputs(args))
+        first["result_id"] = "modified"
+        first["history"]["ages"] = ()
+        again = cache.calculate(*args)
+        if dumps(again) != expected or again is first or again["history"] is first["history"]:
+            errors += 1
+            print(f"  快取不一致: {args}")
+    stats = cache.stats()
+    errors += stats["entries"] > samples // 2 or stats["hits"] != samples
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = PlanStore(os.path.join(tmp, "plans.db"))
+        common = [random_plan_inputs(rng) for _ in range(5)]
+        for uses, args in enumerate(common, start=1):
+            request_data = dict(zip(("current_age", "retire_age", "monthly_basic_expense", "monthly_fun_expense",
+                                     "monthly_saving", "current_saving", "max_age", "interest_rate"), args))
+            for _ in range(uses):
+                store.save_plan("U", "n", request_data, calculate_retirement_plan(*args))
+        inputs = store.common_inputs(3)
+        store.close()
+    warm = PlanResultCache()
+    errors += warm.warm_up(inputs) != 3
+    errors += [api_plan_inputs(args) for args in inputs] != [api_plan_inputs(args) for args in common[:1:-1]]
+    for args in common[:1:-1]:
+        warm.calculate(*api_plan_inputs(args))
+    errors += warm.stats()["hits"] != 3
+    return errors
+
+
+def check_metrics(threads: int = 8, per_thread: int = 20000) -> int:
+    """多個執行緒同時記錄 (各自的分片)，匯出時加總的次數與總和需與實際記錄的完全相同"""
+    counter = Counter("check_events_total", "check", ("kind",))
+    histogram = Histogram("check_seconds", "check", ("stage",), buckets=(0.001, 0.01))
+
+    def record(index: int):
+        for i in range(per_thread):
+            counter.inc("even" if i % 2 == 0 else "odd")
+            histogram.observe((i % 4) * 0.004, "work")
+
+    workers = [threading.Thread(target=record, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    errors = 0
+    errors += counter.values() != {("even",): threads * per_thread // 2, ("odd",): threads * per_thread // 2}
+    count, total = histogram.snapshot()[("work",)]
+    errors += count != threads * per_thread
+    errors += abs(total - threads * per_thread / 4 * (0.004 + 0.008 + 0.012)) > 1e-6
+    text = "\n".join(histogram.render())
+    errors += f'check_seconds_bucket{{stage="work",le="0.001"}} {threads * per_thread // 4}' not in text
+    errors += f'check_seconds_bucket{{stage="work",le="+Inf"}} {threads * per_thread}' not in text
+    return errors
+
+
+def time_per_call(func, args: tuple, number: int = 2000, repeat: int = 5) -> float:
+    """回傳單次呼叫的最佳耗時 (微秒)"""
+    best = min(timeit.repeat(lambda: func(*args), number=number, repeat=repeat))
+    return best / number * 1e6
+
+
+CALCULATOR_CASES = {
+    "短期 (45 歲, 壽命 100)": (45, 65, 40000.0, 10000.0, 20000.0, 1000000.0, 100, 0.015),
+    "一般 (30 歲, 壽命 100)": (30, 65, 40000.0, 10000.0, 20000.0, 1000000.0, 100, 0.015),
+    "長期 (20 歲, 壽命 120)": (20, 65, 40000.0, 10000.0, 20000.0, 1000000.0, 120, 0.015),
+}
+
+
+def bench_calculator():
+    print("calculate_retirement_plan：逐年迴圈 vs calculate_retirement_plan_fast (微秒/次)")
+    for name, args in CALCULATOR_CASES.items():
+        loop_us = time_per_call(calculate_retirement_plan, args)
+        fast_us = time_per_call(calculate_retirement_plan_fast, args)
+        print(f"  {name}: {loop_us:8.1f} -> {fast_us:8.1f}  (x{loop_us / fast_us:.2f})")
+
+
+def bench_batch(scenarios: int = 10000):
+    rng = random.Random(0)
+    rows = [random_plan_inputs(rng) for _ in range(scenarios)]
+    columns = list(zip(*rows))
+    loop_ms = timeit.timeit(lambda: [calculate_retirement_plan(*args) for args in rows], number=1) * 1e3
+    batch_ms = min(timeit.repeat(lambda: calculate_retirement_plans(*columns), number=1, repeat=3)) * 1e3
+    print(f"批次試算 {scenarios} 組情境：逐筆迴圈 {loop_ms:.1f} ms -> 矩陣運算 {batch_ms:.1f} ms  (x{loop_ms / batch_ms:.2f})")
+
+
+def bench_sensitivity_grid():
+    retire_ages = list(range(55, 71))
+    monthly_savings = [float(v) for v in range(0, 100001, 5000)]
+    interest_rates = [0.0, 0.01, 0.015, 0.02, 0.03, 0.05]
+    args = (30, 40000.0, 10000.0, 1000000.0, 100)
+    cells = len(retire_ages) * len(monthly_savings) * len(interest_rates)
+
+    def per_cell():
+        for retire_age in retire_ages:
+            for saving in monthly_savings:
+                for rate in interest_rates:
+                    calculate_retirement_plan(args[0], retire_age, args[1], args[2], saving, args[3], args[4], rate)
+
+    loop_ms = timeit.timeit(per_cell, number=1) * 1e3
+    grid_ms = min(timeit.repeat(
+        lambda: calculate_sensitivity_grid(args[0], retire_ages, args[1], args[2], monthly_savings, args[3], args[4], interest_rates),
+        number=1, repeat=3
+    )) * 1e3
+    print(f"敏感度分析 {cells} 格：逐格迴圈 {loop_ms:.1f} ms -> 共用複利/通膨表 {grid_ms:.1f} ms  (x{loop_ms / grid_ms:.2f})")
+
+
+def bench_simulation():
+    args = CALCULATOR_CASES["一般 (30 歲, 壽命 100)"]
+    for paths, chunk_size in ((10000, None), (100000, None), (100000, 20000)):
+        seconds = min(timeit.repeat(lambda: simulate_retirement_plan(*args, paths=paths, seed=1, chunk_size=chunk_size), number=1, repeat=3))
+        mode = f"分段 {chunk_size}" if chunk_size else "一次"
+        print(f"蒙地卡羅 {paths} 條路徑 x 70 年 ({mode})：{seconds * 1e3:.1f} ms，{paths / seconds:,.0f} 路徑/秒")
+
+
+def bench_flex_message():
+    args = CALCULATOR_CASES["一般 (30 歲, 壽命 100)"]
+    result = calculate_retirement_plan(*args)
+    chart_url = "https://example.com/static/charts/0.png"
+    print("Flex Message 建立 (微秒/則)")
+    for name, legacy, template, call_args in (
+        ("試算結果", legacy_result_message, build_result_message, (result, chart_url, args[6], args[7])),
+        ("理財人格", legacy_profile_message, build_profile_message, ("積極型", "https://example.com/profile.png")),
+    ):
+        legacy_us = time_per_call(legacy, call_args, number=500)
+        template_us = time_per_call(template, call_args, number=500)
+        print(f"  {name}: from_dict {legacy_us:8.1f} -> 範本 {template_us:8.1f}  (x{legacy_us / template_us:.2f})")
+
+    # 理財人格推播：每次建立卡片並由 SDK 序列化 vs 快取序列化好的卡片，只接上收件人
+    cache = ProfileMessageCache()
+    cache.preload({"積極型": "https://example.com/profile.png"})
+    user_id = "U" + "0" * 32
+    sdk_us = time_per_call(lambda: sdk_push_body(user_id, [legacy_profile_message("積極型", "https://example.com/profile.png")]), (), number=500)
+    cached_us = time_per_call(lambda: push_body(user_id, cache.get("積極型", "https://example.com/profile.png")), (), number=500)
+    print(f"  理財人格推播內容: 建立 + SDK 序列化 {sdk_us:8.1f} -> 快取 {cached_us:8.1f}  (x{sdk_us / cached_us:.0f})")
+
+
+def bench_calculate_payload():
+    """/api/calculate 回應：原本 jsonable_encoder + JSONResponse vs 直接以 FastJSONResponse 序列化，以及精簡格式的大小"""
+    result = calculate_retirement_plan(30, 65, 40000.0, 10000.0, 20000.0, 1000000.0)
+    summary = {key: value for key, value in result.items() if key != "history"}
+    compact = dict(result, history=encode_history(result["history"]))
+    default = time_per_call(lambda r: JSONResponse(jsonable_encoder(r)), (result,))
+    fast = time_per_call(FastJSONResponse, (result,))
+    encode = time_per_call(lambda r: FastJSONResponse(dict(r, history=encode_history(r["history"]))), (result,))
+    decode = time_per_call(decode_history, (compact["history"],))
+    print("/api/calculate 回應序列化 (微秒/次)")
+    print(f"  jsonable_encoder + JSONResponse {default:8.1f} -> FastJSONResponse {fast:6.1f}  (x{default / fast:.0f})")
+    print(f"  精簡格式 (含編碼) {encode:.1f}，/api/send_result 解碼 {decode:.1f}")
+    print(
+        f"  回應大小：完整 {len(FastJSONResponse(result).body)} bytes，history_format=compact "
+        f"{len(FastJSONResponse(compact).body)} bytes，fields=summary {len(FastJSONResponse(summary).body)} bytes"
+    )
+
+    # /api/send_result 請求：上傳完整結果 vs 只帶 result_id (伺服器端暫存)
+    store = ResultStore(max_entries=1000)
+    result_id = store.put({"user_id": "U" + "0" * 32, "result": result, "max_age": 100, "interest_rate": 0.015})
+    full_body = json.dumps({"user_id": "U" + "0" * 32, "result": result, "history": result["history"]}).encode("utf-8")
+    handle_body = json.dumps({"user_id": "U" + "0" * 32, "result_id": result_id}).encode("utf-8")
+    full_parse = time_per_call(json.loads, (full_body,))
+    handle_parse = time_per_call(lambda body: store.get(json.loads(body)["result_id"]), (handle_body,))
+    print(
+        f"  /api/send_result 請求：完整結果 {len(full_body)} bytes / 解析 {full_parse:.1f} -> "
+        f"result_id {len(handle_body)} bytes / 解析 + 查詢 {handle_parse:.1f}"
+    )
+
+
+def bench_chart_prerender(users: int = 40, render_seconds: float = 0.05, send_ratio: float = 0.8, seed: int = 29):
+    """
+    預先繪製：users 位使用者在 2 秒內陸續試算，其中 send_ratio 比例在試算後 0.1~0.5 秒按下推送；
+    以假的繪圖函式 (每張 render_seconds 秒，相當於 QuickChart 往返) 比較推送時等待圖表的時間。
+    """
+    rng = random.Random(seed)
+    histories = [calculate_retirement_plan(25 + i % 40, 65, 30000 + i, 10000, 15000, 500000)["history"] for i in range(users)]
+
+    def fake_render(cache: ChartCache):
+        def render(history: dict, crossover_age: int = None) -> str:
+            key = chart_cache_key(history, crossover_age)
+            url = cache.get(key)
+            if url is None:
+                time.sleep(render_seconds)
+                url = f"https://example.com/{key}.png"
+                cache.put(key, url)
+            return url
+        return render
+
+    async def scenario(prerender: bool) -> tuple:
+        cache = ChartCache()
+        prerenderer = ChartPrerenderer(fake_render(cache), workers=2, cache=cache)
+        waits = []
+
+        async def user(history: dict, arrival: float, send_delay: float):
+            await asyncio.sleep(arrival)
+            if prerender:
+                prerenderer.submit(history)
+            if send_delay is not None:
+                await asyncio.sleep(send_delay)
+                started = time.perf_counter()
+                await prerenderer.chart_url(history)
+                waits.append(time.perf_counter() - started)
+
+        await asyncio.gather(*(user(history, arrival, send_delay) for history, arrival, send_delay in plan))
+        prerenderer.close()
+        return sorted(waits), prerenderer.stats()
+
+    plan = [
+        (history, rng.uniform(0, 2.0), rng.uniform(0.1, 0.5) if rng.random() < send_ratio else None)
+        for history in histories
+    ]
+    baseline, _ = asyncio.run(scenario(False))
+    waits, stats = asyncio.run(scenario(True))
+    print(
+        f"預先繪製圖表 ({users} 位使用者，繪圖 {render_seconds * 1000:.0f} ms)："
+        f"推送等待圖表中位數 {baseline[len(baseline) // 2] * 1000:.1f} ms -> {waits[len(waits) // 2] * 1000:.1f} ms，"
+        f"命中率 {stats['hit_rate']:.0%}，浪費 {stats['wasted']} 次 (未推送的使用者)"
+    )
+
+
+def bench_plan_cache(requests_count: int = 20000, rounds: int = 5, seed: int = 37):
+    """
+    表單常見的輸入分佈 (整數年齡、集中在幾個整數金額、多數使用者不改壽命與利率)：
+    有無試算結果快取時每次試算的平均耗時與命中率。兩種做法交錯量測，取最快的一輪。
+    """
+    rng = random.Random(seed)
+
+    def pick(weighted: dict):
+        return rng.choices(list(weighted), list(weighted.values()))[0]
+
+    stream = []
+    for _ in range(requests_count):
+        stream.append((
+            rng.randint(25, 55), pick({65: 6, 60: 3, 62: 1}),
+            float(pick({30000: 5, 20000: 2, 40000: 2, 50000: 1})), float(pick({10000: 5, 0: 3, 20000: 2})),
+            float(pick({10000: 4, 20000: 4, 30000: 2})), float(pick({1000000: 4, 0: 2, 500000: 2, 2000000: 2})),
+            100, 0.015
+        ))
+
+    direct_times, cached_times = [], []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for args in stream:
+            calculate_retirement_plan_fast(*args)
+        direct_times.append(time.perf_counter() - started)
+        cache = PlanResultCache()
+        started = time.perf_counter()
+        for args in stream:
+            cache.calculate(*args)
+        cached_times.append(time.perf_counter() - started)
+    stats = cache.stats()
+    direct = min(direct_times) / requests_count * 1e6
+    cached = min(cached_times) / requests_count * 1e6
+    print(
+        f"試算結果快取 ({requests_count} 次表單試算)：每次 {direct:.1f} -> {cached:.1f} µs  (x{direct / cached:.2f})，"
+        f"命中率 {stats['hit_rate']:.0%}，快取 {stats['entries']} 筆"
+    )
+
+
+def bench_metrics_overhead():
+    """每次記錄指標的額外耗時 (與 API 請求的毫秒級處理時間相比應可忽略)"""
+    histogram = Histogram("bench_seconds", "bench", ("stage",))
+    counter = Counter("bench_total", "bench", ("api", "outcome"))
+
+    def span():
+        with histogram.time("calculate.compute"):
+            pass
+
+    print(
+        f"指標記錄：observe {time_per_call(histogram.observe, (0.0123, 'calculate.compute'), number=100000):.2f} µs，"
+        f"計時區塊 {time_per_call(span, (), number=100000):.2f} µs，"
+        f"計數 {time_per_call(counter.inc, ('push', 'success'), number=100000):.2f} µs"
+    )
+
+
+def bench_chart_render():
+    result = calculate_retirement_plan(*CALCULATOR_CASES["一般 (30 歲, 壽命 100)"])
+    render_chart_png(result["history"], result["crossover_age"])  # 先載入字型
+    ms = min(timeit.repeat(lambda: render_chart_png(result["history"], result["crossover_age"]), number=5, repeat=3)) / 5 * 1e3
+    print(f"本機繪製圖表 (Pillow)：{ms:.1f} ms/張")
+
+
+# === 微基準回歸測試 ===
+
+# 每個案例輪流使用的輸入組數 (同一個 seed 每次產生相同的輸入)
+SUITE_SAMPLES = 64
+# 取許多次短量測 (每次約 10 ms) 中最快的一次：比少數幾次長量測更不受其他程序與 CPU 降頻干擾
+SUITE_REPEAT = 60
+SUITE_SAMPLE_SECONDS = 0.01
+SUITE_REFERENCE = "reference"
+# 年齡分佈：(目前年齡範圍, 退休年齡範圍, 壽命範圍)
+SUITE_HORIZONS = {
+    "short": ((45, 60), (60, 67), (85, 100)),
+    "typical": ((28, 40), (60, 67), (95, 100)),
+    "long": ((20, 28), (55, 65), (110, 120)),
+}
+
+
+def suite_plan_inputs(horizon: str, seed: int) -> list:
+    """(current_age, retire_age, basic, fun, saving, current_saving, max_age, interest_rate) 的隨機組合"""
+    rng = random.Random(seed)
+    (age_lo, age_hi), (retire_lo, retire_hi), (max_lo, max_hi) = SUITE_HORIZONS[horizon]
+    inputs = []
+    for _ in range(SUITE_SAMPLES):
+        current_age = rng.randint(age_lo, age_hi)
+        inputs.append((
+            current_age, rng.randint(max(retire_lo, current_age + 1), retire_hi),
+            float(rng.randrange(20000, 60001, 1000)), float(rng.randrange(0, 30001, 1000)),
+            float(rng.randrange(5000, 50001, 1000)), float(rng.randrange(0, 5000001, 10000)),
+            rng.randint(max_lo, max_hi), rng.choice((0.005, 0.01, 0.015, 0.02, 0.03))
+        ))
+    return inputs
+
+
+def quickchart_request(history: dict, crossover_age: int) -> bytes:
+    """generate_quickchart_url 發出請求前的部分：取樣、組出設定並序列化成 request body (不連網)"""
+    return json.dumps(quickchart_request_body(history, crossover_age)).encode("utf-8")
+
+
+def suite_cases() -> dict:
+    """{案例名稱: (函式, [參數 tuple, ...])}；每次量測依序以所有參數各呼叫一次"""
+    cases = {}
+    plans = {horizon: suite_plan_inputs(horizon, seed) for seed, horizon in enumerate(SUITE_HORIZONS, start=101)}
+    for horizon, inputs in plans.items():
+        cases[f"calculator.{horizon}"] = (calculate_retirement_plan, inputs)
+    for horizon, inputs in plans.items():
+        cases[f"calculator_fast.{horizon}"] = (calculate_retirement_plan_fast, inputs)
+
+    results = [(args, calculate_retirement_plan(*args)) for horizon in SUITE_HORIZONS for args in plans[horizon]]
+    chart_url = "https://quickchart.io/chart/render/sf-0123456789abcdef"
+    cases["chart.quickchart_request"] = (
+        quickchart_request, [(result["history"], result["crossover_age"]) for _, result in results]
+    )
+    flex_inputs = [(result, chart_url, args[6], args[7]) for args, result in results]
+    cases["flex.create_flex_message"] = (create_flex_message, flex_inputs)
+    cases["flex.from_dict"] = (FlexContainer.from_dict, [(create_flex_message(*item),) for item in flex_inputs])
+    cases["flex.build_result_message"] = (build_result_message, flex_inputs)
+
+    request_keys = ("current_age", "retire_age", "monthly_basic_expense", "monthly_fun_expense", "monthly_saving",
+                    "current_saving", "max_age", "interest_rate")
+    cases["sheets.build_row"] = (build_row, [
+        (f"U{i:032x}", "使用者", dict(zip(request_keys, args)), result) for i, (args, result) in enumerate(results)
+    ])
+    return cases
+
+
+def suite_reference(n: int = 2000) -> int:
+    """固定的純 Python 運算，與各案例交錯量測，用來扣除機器速度 (降頻、其他程序) 的影響"""
+    total = 0
+    for i in range(n):
+        total += (i * i) % 7
+    return total
+
+
+def measure_cases(cases: dict, repeat: int = SUITE_REPEAT) -> dict:
+    """
+    所有案例輪流量測 repeat 輪 (每輪每個案例約 SUITE_SAMPLE_SECONDS 秒)，各案例在相同的機器狀態下取樣；
+    回傳單次呼叫的最佳與中位數耗時 (微秒)。
+    """
+    timers = {}
+    for name, (func, inputs) in cases.items():
+        def run(func=func, inputs=inputs):
+            for args in inputs:
+                func(*args)
+
+        timer = timeit.Timer(run)
+        number = 1
+        while timer.timeit(number) < SUITE_SAMPLE_SECONDS:
+            number *= 2
+        timers[name] = (timer, number, len(inputs))
+
+    samples = {name: [] for name in timers}
+    for _ in range(repeat):
+        for name, (timer, number, calls) in timers.items():
+            samples[name].append(timer.timeit(number) / number / calls * 1e6)
+
+    results = {}
+    for name, values in samples.items():
+        values.sort()
+        results[name] = {"best_us": values[0], "median_us": values[len(values) // 2]}
+    return results
+
+
+def run_suite(pattern: str = None) -> dict:
+    cases = {name: case for name, case in suite_cases().items() if not pattern or pattern in name}
+    cases[SUITE_REFERENCE] = (suite_reference, [()])
+    results = measure_cases(cases)
+    reference = results.pop(SUITE_REFERENCE)["best_us"]
+    for name, result in results.items():
+        result["relative"] = result["best_us"] / reference
+        print(f"  {name:<30}{result['best_us']:>10.2f} µs  (中位數 {result['median_us']:.2f}，參考運算的 {result['relative']:.2f} 倍)")
+    return {
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "reference_us": reference,
+        "cases": results,
+    }
+
+
+def compare_suite(baseline: dict, current: dict, threshold: float) -> int:
+    """
+    以相對於參考運算的耗時比較 (同一台機器速度變動時仍可比較)；回傳變慢超過 threshold (比例) 的案例數。
+    不同機器或 Python 版本的基準僅供參考。
+    """
+    if baseline.get("platform") != current["platform"] or baseline.get("python") != current["python"]:
+        print(f"注意：基準記錄於 {baseline.get('platform')} / Python {baseline.get('python')}，與目前環境不同")
+    regressions = 0
+    print(f"與基準 ({baseline.get('created_at')}) 比較，門檻 +{threshold:.0%}：")
+    for name, result in current["cases"].items():
+        before = baseline["cases"].get(name)
+        if before is None:
+            print(f"  {name:<30}{'':>10}   -> {result['best_us']:>10.2f} µs  新增")
+            continue
+        change = result["relative"] / before["relative"] - 1
+        if change > threshold:
+            status = "變慢"
+            regressions += 1
+        elif change < -threshold:
+            status = "變快"
+        else:
+            status = "持平"
+        print(f"  {name:<30}{before['best_us']:>10.2f} -> {result['best_us']:>10.2f} µs  {change:+7.1%}  {status}")
+    skipped = [name for name in baseline["cases"] if name not in current["cases"]]
+    if skipped:
+        print(f"  基準中另有 {len(skipped)} 個案例本次未執行")
+    return regressions
+
+
+def suite_main(args) -> int:
+    print("微基準 (每次呼叫的最佳耗時)：")
+    current = run_suite(args.filter)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(current, f, ensure_ascii=False, indent=2)
+        print(f"基準已存到 {args.save}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_suite(baseline, current, args.threshold)
+        print(f"{regressions} 個案例變慢超過 {args.threshold:.0%}")
+        return 1 if regressions else 0
+    return 0
+
+
+# === 冷啟動 ===
+
+# import main 時不應載入的重量級模組 (第一次使用或預熱時才載入)
+STARTUP_DEFERRED_MODULES = ("linebot.v3.messaging", "linebot.v3.webhooks", "aiohttp", "requests", "gspread",
+                            "google.oauth2.service_account", "pytz")
+STARTUP_TOP_MODULES = 8
+STARTUP_CALCULATE_BODY = json.dumps({
+    "current_age": 35, "retire_age": 65, "monthly_basic_expense": 30000, "monthly_fun_expense": 10000,
+    "monthly_saving": 20000, "current_saving": 1000000
+}).encode("utf-8")
+
+
+def startup_env() -> dict:
+    """子行程的環境：可 import 本目錄的 main，外部服務都不設定 (不會連網)"""
+    env = {key: value for key, value in os.environ.items()
+           if not key.startswith(("LINE_", "GOOGLE_", "PUBLIC_BASE_URL", "PLAN_CACHE_WARMUP"))}
+    env["PYTHONPATH"] = os.path.dirname(os.path.abspath(__file__))
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+    return env
+
+
+def parse_importtime(stderr: str) -> list:
+    """-X importtime 的輸出轉成 [(層級, 模組, 自身微秒, 累計微秒), ...] (子模組在父模組之前)"""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        # 名稱前固定一個空格，每深一層多兩個空格
+        level = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        entries.append((level, name.strip(), int(self_us), int(cumulative_us)))
+    return entries
+
+
+def import_profile(workdir: str) -> dict:
+    """
+    在新的直譯器中 import main：回傳耗時、main 直接載入的模組中最慢的幾個，以及不應載入卻已載入的延後模組；
+    接著再 import 延後的模組，量出預熱 (或改為在 import 時載入) 需要的時間。
+    """
+    code = (
+        "import json, sys\n"
+        "import main\n"
+        f"print(json.dumps([name for name in {STARTUP_DEFERRED_MODULES!r} if name in sys.modules]))\n"
+        f"for name in {STARTUP_DEFERRED_MODULES!r}:\n"
+        "    __import__(name)\n"
+    )
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=workdir, env=startup_env(),
+                          capture_output=True, text=True, timeout=120)
+    if proc.returncode != 0:
+        raise RuntimeError(f"import main 失敗:\n{proc.stderr[-2000:]}")
+
+    entries = parse_importtime(proc.stderr)
+    main_index = next(i for i, entry in enumerate(entries) if entry[:2] == (0, "main"))
+    children = []
+    for level, name, _, cumulative in reversed(entries[:main_index]):
+        if level == 0:
+            break
+        if level == 1:
+            children.append((name, cumulative))
+    deferred = {name: cumulative for level, name, _, cumulative in entries[main_index + 1:] if level == 0}
+    return {
+        "import_main_ms": entries[main_index][3] / 1000,
+        "top_modules": sorted(children, key=lambda item: -item[1])[:STARTUP_TOP_MODULES],
+        "loaded_deferred": json.loads(proc.stdout.strip().splitlines()[-1]),
+        "deferred_ms": sum(deferred.get(name, 0) for name in STARTUP_DEFERRED_MODULES) / 1000,
+    }
+
+
+def check_lazy_imports() -> int:
+    """import main 時不應載入 STARTUP_DEFERRED_MODULES；回傳已載入的模組數"""
+    with tempfile.TemporaryDirectory() as workdir:
+        loaded = import_profile(workdir)["loaded_deferred"]
+    for name in loaded:
+        print(f"  import main 時已載入 {name}")
+    return len(loaded)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def first_response(workdir: str, path: str, body: bytes = None, warmup: bool = True) -> float:
+    """以 uvicorn 子行程啟動服務，量測從啟動行程到 path 第一次成功回應的秒數"""
+    port = _free_port()
+    env = dict(startup_env(), WARMUP_ON_STARTUP="1" if warmup else "0")
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{port}{path}", data=body, headers={"Content-Type": "application/json"}
+    )
+    started = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while True:
+            try:
+                with urllib.request.urlopen(request, timeout=30) as resp:
+                    resp.read()
+                return time.perf_counter() - started
+            except urllib.error.HTTPError:
+                raise
+            except (urllib.error.URLError, ConnectionError):
+                if proc.poll() is not None:
+                    raise RuntimeError(f"服務啟動失敗 (結束代碼 {proc.returncode})")
+                time.sleep(0.005)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+
+
+def startup_main(args) -> int:
+    """冷啟動量測；import main 時載入了延後的模組時結束代碼為 1"""
+    with tempfile.TemporaryDirectory() as workdir:
+        profiles = [import_profile(workdir) for _ in range(args.runs)]
+        profile = min(profiles, key=lambda item: item["import_main_ms"])
+        print(f"import main：最佳 {profile['import_main_ms']:.0f} ms (共 {args.runs} 次，-X importtime)")
+        print("main 直接 import 的模組 (累計耗時)：")
+        for name, cumulative in profile["top_modules"]:
+            print(f"  {name:<32}{cumulative / 1000:>8.1f} ms")
+        deferred_ms = min(item["deferred_ms"] for item in profiles)
+        print(f"延後載入的模組 ({', '.join(STARTUP_DEFERRED_MODULES)})：{deferred_ms:.0f} ms，"
+              f"改在 import 時載入則約 {profile['import_main_ms'] + deferred_ms:.0f} ms")
+
+        print("從啟動 uvicorn 到第一次回應 (中位數 / 最佳)：")
+        targets = (
+            ("GET /", "/", None, True),
+            ("POST /api/calculate", "/api/calculate", STARTUP_CALCULATE_BODY, True),
+            ("POST /api/calculate (WARMUP_ON_STARTUP=0)", "/api/calculate", STARTUP_CALCULATE_BODY, False),
+            ("GET /api/warmup", "/api/warmup", None, False),
+        )
+        for label, path, body, warmup in targets:
+            times = sorted(first_response(workdir, path, body, warmup) for _ in range(args.runs))
+            print(f"  {label:<44}{times[len(times) // 2] * 1000:>8.0f} / {times[0] * 1000:.0f} ms")
+
+    if profile["loaded_deferred"]:
+        print(f"import main 時已載入應延後的模組：{', '.join(profile['loaded_deferred'])}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="一致性檢查與效能量測")
+    parser.add_argument("--suite", action="store_true", help="只執行微基準回歸測試")
+    parser.add_argument("--save", metavar="PATH", help="將微基準結果存成基準檔 (JSON)")
+    parser.add_argument("--compare", metavar="PATH", help="與基準檔比較")
+    parser.add_argument("--threshold", type=float, default=0.15, help="變慢超過此比例即視為回歸 (預設 0.15)")
+    parser.add_argument("--filter", help="只執行名稱包含此字串的案例")
+    parser.add_argument("--startup", action="store_true", help="只執行冷啟動量測")
+    parser.add_argument("--runs", type=int, default=5, help="冷啟動量測的重複次數 (預設 5)")
+    args = parser.parse_args()
+    if args.suite or args.save or args.compare:
+        raise SystemExit(suite_main(args))
+    if args.startup:
+        raise SystemExit(startup_main(args))
+
+    mismatches = check_calculator_parity() + check_batch_parity() + check_sensitivity_parity() + check_solver_parity() + check_simulation_parity() + check_flex_parity() + check_prepared_parity() + check_command_router() + check_webhook_dedupe() + check_webhook_retry() + check_bulk_send() + check_sheets_buffer() + check_sheets_replicator() + check_history_encoding() + check_large_payload() + check_metrics() + check_plan_cache() + check_lazy_imports()
+    print(f"輸出一致性檢查：{mismatches} 筆不一致")
+    bench_calculator()
+    bench_batch()
+    bench_sensitivity_grid()
+    bench_simulation()
+    bench_flex_message()
+    bench_calculate_payload()
+    bench_chart_prerender()
+    bench_plan_cache()
+    bench_metrics_overhead()
+    bench_chart_render()
+    if mismatches:
+        raise SystemExit(1)
@@ -0,0 +1,261 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import uuid
+from datetime import datetime
+
+from starlette.concurrency import run_in_threadpool
+
+import sheets_util
+from line_util import MULTICAST_MAX_RECIPIENTS
+from metrics_util import BACKGROUND_TASK_SECONDS, BACKGROUND_TASK_FAILURES
+
+# 同時進行的 multicast 請求 / 訊息建立 (圖表繪製) 數量
+BULK_CONCURRENCY = 4
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bulk_jobs (
+    id TEXT PRIMARY KEY,
+    created_at TEXT NOT NULL,
+    status TEXT NOT NULL,
+    recipients INTEGER NOT NULL,
+    messages INTEGER NOT NULL,
+    batches INTEGER NOT NULL,
+    finished_at TEXT
+);
+CREATE TABLE IF NOT EXISTS bulk_messages (
+    job_id TEXT NOT NULL,
+    message_key TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    messages_json BLOB,
+    PRIMARY KEY (job_id, message_key)
+);
+CREATE TABLE IF NOT EXISTS bulk_batches (
+    job_id TEXT NOT NULL,
+    batch_no INTEGER NOT NULL,
+    message_key TEXT NOT NULL,
+    recipients TEXT NOT NULL,
+    retry_key TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    error TEXT,
+    PRIMARY KEY (job_id, batch_no)
+);
+"""
+
+
+def message_key(payload: dict) -> str:
+    """內容相同的訊息得到相同的 key (與欄位順序無關)"""
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+
+def _now() -> str:
+    return datetime.now(sheets_util.tz).strftime("%Y-%m-%d %H:%M:%S")
+
+
+class BulkSendStore:
+    """
+    批次推送工作的進度紀錄 (SQLite)：每則不重複的訊息與每個 multicast 批次各一列，
+    批次送出後立即標記，服務中斷後可從尚未完成的批次繼續。
+    """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+    def create_job(self, groups: dict) -> str:
+        """groups: {message_key: (payload, [user_id, ...])}；收件人每 MULTICAST_MAX_RECIPIENTS 位切成一個批次"""
+        job_id = uuid.uuid4().hex
+        messages = []
+        batches = []
+        recipients = 0
+        for key, (payload, user_ids) in groups.items():
+            messages.append((job_id, key, json.dumps(payload, ensure_ascii=False)))
+            recipients += len(user_ids)
+            for start in range(0, len(user_ids), MULTICAST_MAX_RECIPIENTS):
+                # 每個批次固定一個 retry key，中斷後重送同一批次不會讓使用者收到兩次
+                batches.append((
+                    job_id, len(batches), key, json.dumps(user_ids[start:start + MULTICAST_MAX_RECIPIENTS]),
+                    str(uuid.uuid4())
+                ))
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO bulk_jobs (id, created_at, status, recipients, messages, batches) VALUES (?, ?, 'pending', ?, ?, ?)",
+                (job_id, _now(), recipients, len(messages), len(batches))
+            )
+            self._db.executemany("INSERT INTO bulk_messages (job_id, message_key, payload) VALUES (?, ?, ?)", messages)
+            self._db.executemany(
+                "INSERT INTO bulk_batches (job_id, batch_no, message_key, recipients, retry_key) VALUES (?, ?, ?, ?, ?)",
+                batches
+            )
+            self._db.commit()
+        return job_id
+
+    def job(self, job_id: str):
+        with self._lock:
+            row = self._db.execute("SELECT * FROM bulk_jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            counts = dict(self._db.execute(
+                "SELECT status, COUNT(*) FROM bulk_batches WHERE job_id = ? GROUP BY status", (job_id,)
+            ).fetchall())
+            sent_recipients = self._db.execute(
+                "SELECT COALESCE(SUM(json_array_length(recipients)), 0) FROM bulk_batches WHERE job_id = ? AND status = 'sent'",
+                (job_id,)
+            ).fetchone()[0]
+        job = dict(row)
+        job["batches_sent"] = counts.get("sent", 0)
+        job["batches_failed"] = counts.get("failed", 0)
+        job["batches_pending"] = counts.get("pending", 0)
+        job["recipients_sent"] = sent_recipients
+        return job
+
+    def unfinished_jobs(self) -> list:
+        with self._lock:
+            return [row[0] for row in self._db.execute(
+                "SELECT id FROM bulk_jobs WHERE status IN ('pending', 'running') ORDER BY created_at"
+            ).fetchall()]
+
+    def set_status(self, job_id: str, status: str):
+        finished_at = _now() if status in ("done", "failed") else None
+        with self._lock:
+            self._db.execute("UPDATE bulk_jobs SET status = ?, finished_at = ? WHERE id = ?", (status, finished_at, job_id))
+            self._db.commit()
+
+    def unprepared_messages(self, job_id: str) -> list:
+        with self._lock:
+            return [(row["message_key"], json.loads(row["payload"])) for row in self._db.execute(
+                "SELECT message_key, payload FROM bulk_messages WHERE job_id = ? AND messages_json IS NULL", (job_id,)
+            ).fetchall()]
+
+    def save_messages(self, job_id: str, key: str, messages_json: bytes):
+        with self._lock:
+            self._db.execute(
+                "UPDATE bulk_messages SET messages_json = ? WHERE job_id = ? AND message_key = ?", (messages_json, job_id, key)
+            )
+            self._db.commit()
+
+    def prepared_messages(self, job_id: str) -> dict:
+        with self._lock:
+            return {row[0]: row[1] for row in self._db.execute(
+                "SELECT message_key, messages_json FROM bulk_messages WHERE job_id = ? AND messages_json IS NOT NULL", (job_id,)
+            ).fetchall()}
+
+    def unsent_batches(self, job_id: str) -> list:
+        with self._lock:
+            return [dict(row) for row in self._db.execute(
+                "SELECT batch_no, message_key, recipients, retry_key FROM bulk_batches "
+                "WHERE job_id = ? AND status != 'sent' ORDER BY batch_no", (job_id,)
+            ).fetchall()]
+
+    def mark_batch(self, job_id: str, batch_no: int, status: str, error: str = None):
+        with self._lock:
+            self._db.execute(
+                "UPDATE bulk_batches SET status = ?, error = ? WHERE job_id = ? AND batch_no = ?",
+                (status, error, job_id, batch_no)
+            )
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class BulkSender:
+    """
+    批次推送試算結果：收件人依「訊息內容」分組，每組只建立一次訊息 (圖表只繪製一次)，
+    再以 multicast 每次最多 MULTICAST_MAX_RECIPIENTS 位送出，取代對每位使用者各呼叫一次 push。
+    client 需提供 multicast_prepared(to, messages_json, retry_key) (line_util.LinePushClient)；
+    build_messages(payload) -> bytes 為同步函式 (繪圖、建立 Flex Message 並序列化)，在 threadpool 中執行。
+    兩者都可以換成本機的假實作來測試。
+    payload 為 {"error": 原因} 時 (例如 result_id 已過期、取不到內容) 該組不建立訊息，批次直接標記為失敗，不影響其他組。
+    進度紀錄 (SQLite) 的讀寫同樣在 threadpool 中執行，不佔用 event loop。
+    """
+
+    def __init__(self, store: BulkSendStore, client, build_messages, max_concurrency: int = BULK_CONCURRENCY):
+        self.store = store
+        self.client = client
+        self.build_messages = build_messages
+        self.max_concurrency = max_concurrency
+        self._tasks = {}
+
+    def submit(self, recipients: list) -> str:
+        """recipients: [(user_id, payload), ...]；同一組內重複的 user_id 只送一次。回傳 job_id"""
+        groups = {}
+        for user_id, payload in recipients:
+            key = message_key(payload)
+            if key not in groups:
+                groups[key] = (payload, {})
+            groups[key][1][user_id] = None
+        return self.store.create_job({key: (payload, list(user_ids)) for key, (payload, user_ids) in groups.items()})
+
+    def start_job(self, job_id: str):
+        """在背景執行 (或繼續) 工作；同一個工作不會重複執行"""
+        task = self._tasks.get(job_id)
+        if task is None or task.done():
+            task = self._tasks[job_id] = asyncio.create_task(self.run_job(job_id))
+            # 結束後移除，長時間執行也不會累積已完成的工作
+            task.add_done_callback(lambda done: self._tasks.pop(job_id, None) if self._tasks.get(job_id) is done else None)
+
+    def resume_unfinished(self):
+        for job_id in self.store.unfinished_jobs():
+            print(f"繼續未完成的批次推送工作 {job_id}")
+            self.start_job(job_id)
+
+    async def close(self):
+        """取消進行中的工作；已送出的批次都已記錄，下次啟動時從未完成的批次繼續"""
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self._tasks = {}
+
+    async def run_job(self, job_id: str) -> dict:
+        await run_in_threadpool(self.store.set_status, job_id, "running")
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        failed_keys = {}
+
+        async def prepare(key: str, payload: dict):
+            if "error" in payload:
+                failed_keys[key] = payload["error"]
+                return
+            try:
+                async with semaphore:
+                    with BACKGROUND_TASK_SECONDS.time("bulk.build_messages"):
+                        messages_json = await run_in_threadpool(self.build_messages, payload)
+            except Exception as e:
+                BACKGROUND_TASK_FAILURES.inc("bulk.build_messages")
+                failed_keys[key] = f"建立訊息失敗: {e}"
+                return
+            await run_in_threadpool(self.store.save_messages, job_id, key, messages_json)
+
+        unprepared = await run_in_threadpool(self.store.unprepared_messages, job_id)
+        await asyncio.gather(*(prepare(key, payload) for key, payload in unprepared))
+        messages = await run_in_threadpool(self.store.prepared_messages, job_id)
+
+        async def send(batch: dict):
+            key = batch["message_key"]
+            if key not in messages:
+                await run_in_threadpool(self.store.mark_batch, job_id, batch["batch_no"], "failed", failed_keys.get(key, "訊息尚未建立"))
+                return
+            try:
+                async with semaphore:
+                    await self.client.multicast_prepared(json.loads(batch["recipients"]), messages[key], retry_key=batch["retry_key"])
+            except Exception as e:
+                BACKGROUND_TASK_FAILURES.inc("bulk.multicast")
+                print(f"批次推送 {job_id} 第 {batch['batch_no']} 批失敗: {e}")
+                await run_in_threadpool(self.store.mark_batch, job_id, batch["batch_no"], "failed", str(e))
+                return
+            await run_in_threadpool(self.store.mark_batch, job_id, batch["batch_no"], "sent")
+
+        batches = await run_in_threadpool(self.store.unsent_batches, job_id)
+        await asyncio.gather(*(send(batch) for batch in batches))
+
+        job = await run_in_threadpool(self.store.job, job_id)
+        await run_in_threadpool(self.store.set_status, job_id, "done" if job["batches_sent"] == job["batches"] else "failed")
+        return await run_in_threadpool(self.store.job, job_id)
@@ -1,3 +1,24 @@
+import math
+import threading
+from collections import OrderedDict
+from itertools import accumulate, repeat
+from operator import add, mul
+
+import numpy as np
+
+INFLATION_RATE = 0.03
+
+# 批次試算每次處理的情境數，限制 (情境數 x 年數) 矩陣的記憶體用量
+BATCH_CHUNK_ROWS = 4096
+
+# 蒙地卡羅模擬：輸出的存款百分位數帶，與分段模擬時每個年齡的直方圖格數
+SIMULATION_PERCENTILES = (5, 25, 50, 75, 95)
+SIMULATION_HISTOGRAM_BINS = 2048
+
+# 試算結果快取的筆數上限：表單輸入集中在整數年齡與整數金額 (例如 30000 / 10000)，重複率高
+PLAN_CACHE_SIZE = 4096
+
+
 def calculate_retirement_plan(current_age: int, retire_age: int, monthly_basic_expense: float, monthly_fun_expense: float, monthly_saving: float, current_saving: float, max_age: int = 100, interest_rate: float = 0.015):
     """
     計算退休規劃的資金需求、實際存款與缺口。
@@ -7,8 +28,6 @@ def calculate_retirement_plan(current_age: int, retire_age: int, monthly_basic_e
     3. 存款利率 interest_rate，每年複利。
     4. 存款僅在工作期間 (目前 -> 退休) 持續投入。
     """
-    INFLATION_RATE = 0.03
-
     years_to_live = max_age - current_age
     years_to_retire = retire_age - current_age
     
@@ -72,6 +91,624 @@ def calculate_retirement_plan(current_age: int, retire_age: int, monthly_basic_e
         }
     }
 
+# 通膨倍數 1.03^k 表 (k 為退休後第幾年)，與逐年迴圈相同以 ** 逐一計算，查表的值逐位元相同
+INFLATION_POWERS = [(1 + INFLATION_RATE) ** k for k in range(201)]
+# 直接呼叫 float 的 __round__，省去 round() 依型別查找方法的開銷 (結果相同，同為 round half to even)
+_round_float = float.__round__
+
+
+def calculate_retirement_plan_fast(current_age: int, retire_age: int, monthly_basic_expense: float, monthly_fun_expense: float, monthly_saving: float, current_saving: float, max_age: int = 100, interest_rate: float = 0.015):
+    """
+    calculate_retirement_plan 的快速版本 (/api/calculate 經由 PlanResultCache 使用)，輸出逐位元相同。
+    每個浮點運算的順序與逐年迴圈完全一樣，只改變執行方式：
+    1. 分成工作期間與退休期間兩段，迴圈內不再判斷是否退休；工作期間的需求固定為 0，不需計算。
+    2. 退休後的複利連乘、年支出與需求累加以 map / itertools.accumulate 在 C 中依序進行
+       (與迴圈的 *= / += 是相同的 left fold)；通膨倍數查 INFLATION_POWERS 表，不再每年呼叫 **。
+    3. 四捨五入以 map(float.__round__, ...) 一次完成，交叉點只在退休後的年份中尋找。
+    不使用 g^y 與等比級數的閉合公式或 NumPy：閉合公式與逐年累乘有浮點誤差，必須另做四捨五入邊界檢查並回退，
+    單筆試算只有數十年，NumPy 每次呼叫的固定開銷也比省下的時間多。
+    年數 <= 0 或利率不是 float (例如整數 0，金額維持整數運算) 時直接使用逐年迴圈。
+    """
+    years_to_live = max_age - current_age
+    growth = 1 + interest_rate
+    if years_to_live <= 0 or not isinstance(growth, float):
+        return calculate_retirement_plan(current_age, retire_age, monthly_basic_expense, monthly_fun_expense, monthly_saving, current_saving, max_age, interest_rate)
+    years_to_retire = retire_age - current_age
+    work_years = min(max(years_to_retire, 0), years_to_live)
+    retired_years = years_to_live - work_years
+
+    # --- 存款軌跡 (利率為 float，第一年之後都是 float) ---
+    yearly_saving = monthly_saving * 12
+    funds = []
+    total_fund = current_saving
+    for _ in range(work_years):
+        total_fund = total_fund * growth + yearly_saving
+        funds.append(total_fund)
+    if retired_years:
+        funds += accumulate(repeat(growth, retired_years), mul, initial=total_fund)
+        del funds[work_years]  # accumulate 的 initial (退休時的存款) 不是新的一年
+    total_fund = funds[-1]
+
+    # --- 需求軌跡 (通膨從退休後才開始計算，退休後第 k 年的倍數為 1.03^k) ---
+    history_needs_basic = [0] * (work_years + 1)
+    history_needs_with_fun = [0] * (work_years + 1)
+    total_need_basic = total_need_with_fun = 0
+    if retired_years:
+        first_k = work_years + 1 - years_to_retire
+        last_k = years_to_live - years_to_retire
+        if last_k < len(INFLATION_POWERS):
+            multipliers = INFLATION_POWERS[first_k:last_k + 1]
+        else:
+            multipliers = [(1 + INFLATION_RATE) ** k for k in range(first_k, last_k + 1)]
+        expense_basic = list(map(mul, repeat(monthly_basic_expense * 12), multipliers))
+        expense_with_fun = map(add, expense_basic, map(mul, repeat(monthly_fun_expense * 12), multipliers))
+        needs_basic = list(accumulate(expense_basic, initial=0))
+        needs_with_fun = list(accumulate(expense_with_fun, initial=0))
+        total_need_basic = needs_basic[-1]
+        total_need_with_fun = needs_with_fun[-1]
+        history_needs_basic += map(_round_float, needs_basic[1:])
+        history_needs_with_fun += map(_round_float, needs_with_fun[1:])
+
+    history_funds = [current_saving]
+    history_funds += map(_round_float, funds)
+
+    gap = total_need_with_fun - total_fund
+    if gap < 0:
+        gap = 0
+
+    # 找出交叉點：存款低於累積需求(含娛樂)的年齡 (只有退休後的需求大於 0)
+    crossover_age = None
+    for i in range(work_years + 1, years_to_live + 1):
+        need = history_needs_with_fun[i]
+        if need > 0 and need >= history_funds[i]:
+            crossover_age = current_age + i
+            break
+
+    return {
+        "total_need_basic": round(total_need_basic),
+        "total_need_with_fun": round(total_need_with_fun),
+        "total_fund": round(total_fund),
+        "gap": round(gap),
+        "crossover_age": crossover_age,
+        "history": {
+            "ages": list(range(current_age, max_age + 1)),
+            "funds": history_funds,
+            "needs_basic": history_needs_basic,
+            "needs_with_fun": history_needs_with_fun
+        }
+    }
+
+
+def plan_inputs_key(current_age: int, retire_age: int, monthly_basic_expense: float, monthly_fun_expense: float, monthly_saving: float, current_saving: float, max_age: int = 100, interest_rate: float = 0.015):
+    """
+    正規化的試算輸入 (依 calculate_retirement_plan 的參數順序)：年齡轉成 int，金額與利率轉成 float，
+    30000 與 30000.0 得到同一個 key。含 NaN / inf 時回傳 None (不快取)。
+    """
+    amounts = tuple(float(value) + 0.0 for value in (monthly_basic_expense, monthly_fun_expense, monthly_saving, current_saving, interest_rate))
+    if not all(math.isfinite(value) for value in amounts):
+        return None
+    return (int(current_age), int(retire_age)) + amounts[:4] + (int(max_age), amounts[4])
+
+
+def _freeze_plan(result: dict) -> dict:
+    """歷年軌跡轉成 tuple，快取的結果由多個請求共用時不會被其中一個修改"""
+    result["history"] = {column: tuple(values) for column, values in result["history"].items()}
+    return result
+
+
+def _copy_plan(result: dict) -> dict:
+    """快取結果的淺層複本 (外層與 history 各一個新 dict，歷年軌跡的 tuple 共用)，呼叫端修改不會影響快取"""
+    return dict(result, history=dict(result["history"]))
+
+
+class PlanResultCache:
+    """
+    calculate_retirement_plan_fast 的結果快取 (LRU)，key 為 plan_inputs_key (不含 user_id / user_name)。
+    每次回傳新的淺層複本 (見 _copy_plan)：呼叫端可以加減欄位，歷年軌跡為 tuple，無法原地修改。
+    多個 threadpool worker 會同時存取，以 lock 保護；計算在 lock 外進行。
+    """
+
+    def __init__(self, max_entries: int = PLAN_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.warmed = 0
+
+    def calculate(self, current_age: int, retire_age: int, monthly_basic_expense: float, monthly_fun_expense: float, monthly_saving: float, current_saving: float, max_age: int = 100, interest_rate: float = 0.015) -> dict:
+        key = plan_inputs_key(current_age, retire_age, monthly_basic_expense, monthly_fun_expense, monthly_saving, current_saving, max_age, interest_rate)
+        if key is None:
+            return _freeze_plan(calculate_retirement_plan_fast(current_age, retire_age, monthly_basic_expense, monthly_fun_expense, monthly_saving, current_saving, max_age, interest_rate))
+
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return _copy_plan(result)
+            self.misses += 1
+
+        result = _freeze_plan(calculate_retirement_plan_fast(*key))
+        with self._lock:
+            self._store(key, result)
+        return _copy_plan(result)
+
+    def warm_up(self, inputs) -> int:
+        """預先計算 inputs (每筆為 calculate 的參數 tuple) 中尚未快取的組合，不計入命中統計；回傳新計算的組數"""
+        computed = 0
+        for args in inputs:
+            key = plan_inputs_key(*args)
+            if key is None:
+                continue
+            with self._lock:
+                if key in self._entries:
+                    continue
+            result = _freeze_plan(calculate_retirement_plan_fast(*key))
+            with self._lock:
+                self._store(key, result)
+                self.warmed += 1
+            computed += 1
+        return computed
+
+    def _store(self, key: tuple, result: dict):
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "warmed": self.warmed,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+
+def _near_rounding_tie(values: np.ndarray, rounded: np.ndarray, scale: np.ndarray, nonnegative: np.ndarray) -> np.ndarray:
+    """
+    逐列 (情境) 檢查 (情境數, 年數) 陣列中是否有數值落在 x.5 附近，回傳需要改用逐年迴圈的列。
+    向量化與逐年迴圈的相對誤差約在 1e-14 以下，只有 x.5 附近的數值才可能讓 round() 方向不同；
+    金額皆非負的列以數值本身估計誤差，其餘以該列的 scale (整條軌跡的最大值) 估計。
+    先用整批最大 scale 的寬鬆門檻篩出少數候選格，再逐格精確判斷，避免對整個矩陣做多次運算。
+    """
+    near_tie = np.zeros(len(values), dtype=bool)
+    distance = np.abs(values - rounded)
+    threshold = 0.5 - (np.max(scale, where=np.isfinite(scale), initial=0) * 1e-12 + 1e-9)
+    candidate_rows, candidate_years = np.nonzero(distance >= threshold)
+    if len(candidate_rows):
+        candidate = values[candidate_rows, candidate_years]
+        tolerance = np.where(nonnegative[candidate_rows], np.abs(candidate), scale[candidate_rows]) * 1e-12 + 1e-9
+        near_tie[candidate_rows[distance[candidate_rows, candidate_years] >= 0.5 - tolerance]] = True
+    return near_tie
+
+
+def _calculate_plan_chunk(current_age, retire_age, monthly_basic_expense, monthly_fun_expense, monthly_saving, current_saving, max_age, interest_rate, include_history):
+    """
+    以 (情境數, 年數) 矩陣一次計算一批情境，數值與逐筆呼叫 calculate_retirement_plan 相同。
+    落在四捨五入邊界、非有限值或年數 <= 0 的情境，改用逐年迴圈計算。
+    """
+    years_to_live = max_age - current_age
+    years_to_retire = retire_age - current_age
+    max_years = max(int(years_to_live.max()), 1)
+
+    # 第 y 年 (1 ~ max_years)，欄位超過各情境壽命的部分最後會被遮罩掉
+    years = np.arange(1, max_years + 1)
+    valid = years <= years_to_live[:, None]
+    work_years = np.clip(years_to_retire, 0, np.maximum(years_to_live, 0))[:, None]
+    working = years <= work_years
+
+    # g^0 ~ g^max_years：利率通常只有少數幾種，先對不重複的利率建表再依索引取出
+    unique_rates, rate_index = np.unique(interest_rate, return_inverse=True)
+    growth = np.power((1 + unique_rates)[:, None], np.arange(max_years + 1, dtype=float))[rate_index]
+
+    # 第 0 層：存款，第 1 層：需求(僅生活)，第 2 層：需求(含娛樂)
+    paths = np.empty((3, len(current_age), max_years))
+
+    # --- 存款軌跡 ---
+    # 工作期間：本金·g^y + 年存款·Σ_{j=0}^{y-1} g^j
+    funds = paths[0]
+    np.multiply(current_saving[:, None], growth[:, 1:], out=funds)
+    funds += (monthly_saving * 12)[:, None] * growth[:, :-1].cumsum(axis=1)
+    fund_at_retire = np.where(
+        work_years[:, 0] > 0,
+        np.take_along_axis(funds, np.maximum(work_years - 1, 0), axis=1)[:, 0],
+        current_saving
+    )
+    # 退休後：退休時存款·g^(y-退休年)
+    retired_growth = np.take_along_axis(growth, np.clip(years - work_years, 0, max_years), axis=1)
+    np.copyto(funds, fund_at_retire[:, None] * retired_growth, where=~working)
+
+    # --- 需求軌跡 (通膨從退休後才開始計算) ---
+    # 通膨倍數只與退休後第幾年有關，先建表 1.03^k 再查表
+    years_in_retirement = np.where(working, 0, years - years_to_retire[:, None])
+    first_year = int(years_in_retirement.min())
+    inflation_table = np.power(1 + INFLATION_RATE, np.arange(first_year, int(years_in_retirement.max()) + 1, dtype=float))
+    inflation_multiplier = inflation_table[years_in_retirement - first_year]
+    np.copyto(inflation_multiplier, 0.0, where=working)
+    expense_basic = (monthly_basic_expense * 12)[:, None] * inflation_multiplier
+    expense_basic.cumsum(axis=1, out=paths[1])
+    (expense_basic + (monthly_fun_expense * 12)[:, None] * inflation_multiplier).cumsum(axis=1, out=paths[2])
+
+    # 超過各情境壽命的欄位不列入計算
+    np.copyto(paths, 0.0, where=~valid)
+
+    last_year = np.maximum(years_to_live - 1, 0)[:, None]
+    total_fund, total_need_basic, total_need_with_fun = np.take_along_axis(paths, last_year[None], axis=2)[:, :, 0]
+    gap = np.maximum(total_need_with_fun - total_fund, 0)
+
+    # 與單筆版本相同的四捨五入邊界檢查，逐情境判斷是否需要改用迴圈
+    rounded = np.rint(paths)
+    rounded_gap = np.rint(gap)
+    with np.errstate(invalid="ignore"):
+        scale = np.maximum(np.abs(paths).max(axis=(0, 2)), gap)
+        nonnegative = (
+            (np.minimum.reduce([monthly_basic_expense, monthly_fun_expense, monthly_saving, current_saving]) >= 0)
+            & (interest_rate > -1)
+        )
+        fallback = (years_to_live <= 0) | ~np.isfinite(scale) | (np.abs(gap - rounded_gap) >= 0.5 - (scale * 1e-12 + 1e-9))
+        for layer, rounded_layer in zip(paths, rounded):
+            fallback |= _near_rounding_tie(layer, rounded_layer, scale, nonnegative)
+
+        # 找出交叉點：存款低於累積需求(含娛樂)的年齡
+        crossed = (rounded[2] > 0) & (rounded[2] >= rounded[0])
+    crossover_age = np.where(crossed.any(axis=1), current_age + 1 + crossed.argmax(axis=1), None)
+
+    last_year = last_year[:, 0]
+    rows = np.arange(len(current_age))
+    results = {
+        "total_need_basic": rounded[1, rows, last_year],
+        "total_need_with_fun": rounded[2, rows, last_year],
+        "total_fund": rounded[0, rows, last_year],
+        "gap": rounded_gap,
+    }
+    results = {key: np.where(fallback, 0, values).astype(np.int64).tolist() for key, values in results.items()}
+    results["crossover_age"] = crossover_age.tolist()
+
+    if include_history:
+        history_funds, history_needs_basic, history_needs_with_fun = np.where(fallback[:, None], 0, rounded).astype(np.int64).tolist()
+        results["history"] = [
+            {
+                "ages": list(range(age, age + n + 1)),
+                "funds": [saving] + history_funds[i][:n],
+                "needs_basic": [0] + history_needs_basic[i][:n],
+                "needs_with_fun": [0] + history_needs_with_fun[i][:n]
+            }
+            for i, (age, n, saving) in enumerate(zip(current_age.tolist(), years_to_live.tolist(), current_saving.tolist()))
+        ]
+
+    for i in np.flatnonzero(fallback).tolist():
+        result = calculate_retirement_plan(
+            int(current_age[i]), int(retire_age[i]), monthly_basic_expense[i].item(), monthly_fun_expense[i].item(),
+            monthly_saving[i].item(), current_saving[i].item(), int(max_age[i]), interest_rate[i].item()
+        )
+        for key in ("total_need_basic", "total_need_with_fun", "total_fund", "gap", "crossover_age"):
+            results[key][i] = result[key]
+        if include_history:
+            results["history"][i] = result["history"]
+
+    return results
+
+
+def calculate_retirement_plans(current_age, retire_age, monthly_basic_expense, monthly_fun_expense, monthly_saving, current_saving, max_age=100, interest_rate=0.015, include_history: bool = False):
+    """
+    批次試算多組退休規劃情境，參數為欄位式陣列 (純量會自動廣播到所有情境)。
+    所有情境以矩陣運算一次算完，不逐筆呼叫 calculate_retirement_plan，但每個情境的結果與其完全相同。
+    回傳欄位式結果：{"total_need_basic": [...], ..., "crossover_age": [...]}，
+    include_history=True 時另外附上每個情境的 "history"。
+    """
+    columns = np.broadcast_arrays(
+        np.asarray(current_age, dtype=np.int64),
+        np.asarray(retire_age, dtype=np.int64),
+        np.asarray(monthly_basic_expense),
+        np.asarray(monthly_fun_expense),
+        np.asarray(monthly_saving),
+        np.asarray(current_saving),
+        np.asarray(max_age, dtype=np.int64),
+        np.asarray(interest_rate, dtype=float),
+    )
+    columns = [np.atleast_1d(column) for column in columns]
+    if columns[0].ndim != 1:
+        raise ValueError("批次試算參數必須是一維陣列或純量")
+
+    total_rows = len(columns[0])
+    results = {key: [] for key in ("total_need_basic", "total_need_with_fun", "total_fund", "gap", "crossover_age")}
+    if include_history:
+        results["history"] = []
+
+    for start in range(0, total_rows, BATCH_CHUNK_ROWS):
+        chunk = [column[start:start + BATCH_CHUNK_ROWS] for column in columns]
+        for key, values in _calculate_plan_chunk(*chunk, include_history).items():
+            results[key].extend(values)
+
+    return results
+
+def _inflation_table(current_age: int, retire_ages: np.ndarray, years_to_live: int) -> np.ndarray:
+    """1.03^k (k = 0 ~ 可能出現的最大退休後年數)，各退休年齡共用"""
+    max_years_in_retirement = years_to_live - min(int(retire_ages.min()) - current_age, 0)
+    return np.power(1 + INFLATION_RATE, np.arange(max_years_in_retirement + 1, dtype=float))
+
+
+def _needs_paths(monthly_basic_expense: float, monthly_fun_expense: float, inflation_table: np.ndarray, years_to_live: int, years_to_retire: int) -> np.ndarray:
+    """單一退休年齡的累積需求軌跡 (2, 年數)：第 0 列僅生活、第 1 列含娛樂，計算方式與向量化版本相同"""
+    needs = np.zeros((2, years_to_live))
+    work_years = min(max(years_to_retire, 0), years_to_live)
+    if work_years < years_to_live:
+        first_year_in_retirement = work_years + 1 - years_to_retire
+        inflation_multiplier = inflation_table[first_year_in_retirement:first_year_in_retirement + years_to_live - work_years]
+        expense_basic = (monthly_basic_expense * 12) * inflation_multiplier
+        expense_basic.cumsum(out=needs[0, work_years:])
+        (expense_basic + (monthly_fun_expense * 12) * inflation_multiplier).cumsum(out=needs[1, work_years:])
+    return needs
+
+
+def calculate_sensitivity_grid(current_age: int, retire_ages, monthly_basic_expense: float, monthly_fun_expense: float, monthly_savings, current_saving: float, max_age: int = 100, interest_rates=0.015):
+    """
+    敏感度分析：計算 退休年齡 x 每月存款 x 利率 所有組合的資金缺口與交叉點，每格結果與 calculate_retirement_plan 相同。
+    1. 需求軌跡只與退休年齡有關，每個退休年齡只算一次。
+    2. 複利表 g^y 與年金累積 Σg^j 每個利率只算一次；工作期間的存款軌跡與退休年齡無關，所有退休年齡共用。
+    回傳的 gap / crossover_age 為巢狀陣列，索引順序為 [退休年齡][月存款][利率]。
+    """
+    retire_ages = np.atleast_1d(np.asarray(retire_ages, dtype=np.int64))
+    monthly_savings = np.atleast_1d(np.asarray(monthly_savings, dtype=float))
+    interest_rates = np.atleast_1d(np.asarray(interest_rates, dtype=float))
+    shape = (len(retire_ages), len(monthly_savings), len(interest_rates))
+    years_to_live = max_age - current_age
+
+    gap = np.zeros(shape)
+    crossover_age = np.full(shape, None, dtype=object)
+    fallback = np.full(shape, years_to_live <= 0)
+
+    if years_to_live > 0:
+        growth = np.power((1 + interest_rates)[:, None], np.arange(years_to_live + 1, dtype=float))
+        annuity = growth[:, :years_to_live].cumsum(axis=1)
+        # 工作期間的存款軌跡 (月存款, 利率, 年數)：本金·g^y + 年存款·Σ_{j=0}^{y-1} g^j
+        working_funds = current_saving * growth[:, 1:] + (monthly_savings * 12)[:, None, None] * annuity
+        inflation_table = _inflation_table(current_age, retire_ages, years_to_live)
+        nonnegative = (
+            (min(monthly_basic_expense, monthly_fun_expense, current_saving) >= 0)
+            & (monthly_savings >= 0)[:, None]
+            & (interest_rates > -1)
+        ).ravel()
+
+        for a, retire_age in enumerate(retire_ages.tolist()):
+            years_to_retire = retire_age - current_age
+            work_years = min(max(years_to_retire, 0), years_to_live)
+            retired_years = years_to_live - work_years
+
+            funds = working_funds
+            if retired_years:
+                # 退休後：退休時存款·g^(y-退休年)
+                fund_at_retire = working_funds[:, :, work_years - 1, None] if work_years else current_saving
+                funds = working_funds.copy()
+                funds[:, :, work_years:] = fund_at_retire * growth[:, 1:retired_years + 1]
+            needs = _needs_paths(monthly_basic_expense, monthly_fun_expense, inflation_table, years_to_live, years_to_retire)
+
+            gap[a] = np.maximum(needs[1, -1] - funds[:, :, -1], 0)
+            rounded_funds = np.rint(funds)
+            rounded_needs = np.rint(needs)
+
+            # 找出交叉點：存款低於累積需求(含娛樂)的年齡
+            crossed = (rounded_needs[1] > 0) & (rounded_needs[1] >= rounded_funds)
+            crossover_age[a] = np.where(crossed.any(axis=2), current_age + 1 + crossed.argmax(axis=2), None)
+
+            # 四捨五入邊界檢查，判斷哪些格需要改用迴圈
+            with np.errstate(invalid="ignore"):
+                flat_funds = funds.reshape(-1, years_to_live)
+                needs_scale = np.abs(needs).max()
+                scale = np.maximum(np.maximum(np.abs(flat_funds).max(axis=1), needs_scale), gap[a].ravel())
+                near_tie = (
+                    ~np.isfinite(scale)
+                    | (np.abs(gap[a].ravel() - np.rint(gap[a].ravel())) >= 0.5 - (scale * 1e-12 + 1e-9))
+                    | _near_rounding_tie(flat_funds, rounded_funds.reshape(-1, years_to_live), scale, nonnegative)
+                )
+                if _near_rounding_tie(needs, rounded_needs, np.full(2, needs_scale), np.full(2, min(monthly_basic_expense, monthly_fun_expense) >= 0)).any():
+                    near_tie[:] = True
+            fallback[a] = near_tie.reshape(shape[1:])
+
+    gap = np.where(fallback, 0, np.rint(gap)).astype(np.int64).tolist()
+    crossover_age = crossover_age.tolist()
+    for a, j, i in zip(*np.nonzero(fallback)):
+        result = calculate_retirement_plan(current_age, int(retire_ages[a]), monthly_basic_expense, monthly_fun_expense, monthly_savings[j].item(), current_saving, max_age, interest_rates[i].item())
+        gap[a][j][i] = result["gap"]
+        crossover_age[a][j][i] = result["crossover_age"]
+
+    return {
+        "retire_age": retire_ages.tolist(),
+        "monthly_saving": monthly_savings.tolist(),
+        "interest_rate": interest_rates.tolist(),
+        "gap": gap,
+        "crossover_age": crossover_age
+    }
+
+
+def solve_min_monthly_saving(current_age: int, retire_ages, monthly_basic_expense: float, monthly_fun_expense: float, current_saving: float, max_age: int = 100, interest_rates=0.015):
+    """
+    對每個 退休年齡 x 利率 組合，求出讓資金缺口為 0 的最低每月存款 (整數元)。
+    期末存款 = (本金·g^W + 年存款·Σ_{j=0}^{W-1} g^j)·g^(n-W)，對月存款為線性且遞增，
+    以此封閉解在整數上二分搜尋，每一步只需計算期末值，不需逐年迴圈。
+    已退休 (月存款不影響結果) 且缺口不為 0 的組合回傳 None。
+    回傳的 min_monthly_saving 索引順序為 [退休年齡][利率]。
+    """
+    retire_ages = np.atleast_1d(np.asarray(retire_ages, dtype=np.int64))
+    interest_rates = np.atleast_1d(np.asarray(interest_rates, dtype=float))
+    years_to_live = max(max_age - current_age, 0)
+
+    growth = np.power((1 + interest_rates)[:, None], np.arange(years_to_live + 1, dtype=float))
+    annuity = np.concatenate((np.zeros((len(interest_rates), 1)), growth[:, :years_to_live].cumsum(axis=1)), axis=1)
+
+    # 各組合 (退休年齡, 利率) 的期末存款係數：期末存款 = (base + 年存款·slope)·post
+    work_years = np.clip(retire_ages - current_age, 0, years_to_live)[:, None]
+    base = current_saving * np.take_along_axis(growth, work_years.T, axis=1).T
+    slope = np.take_along_axis(annuity, work_years.T, axis=1).T
+    post = np.take_along_axis(growth, (years_to_live - work_years).T, axis=1).T
+
+    if years_to_live:
+        inflation_table = _inflation_table(current_age, retire_ages, years_to_live)
+        total_need = np.array([
+            _needs_paths(monthly_basic_expense, monthly_fun_expense, inflation_table, years_to_live, retire_age - current_age)[1, -1]
+            for retire_age in retire_ages.tolist()
+        ])[:, None]
+    else:
+        total_need = np.zeros((len(retire_ages), 1))
+
+    def is_gap_zero(monthly_saving: np.ndarray) -> np.ndarray:
+        total_fund = (base + (monthly_saving * 12) * slope) * post
+        return np.rint(np.maximum(total_need - total_fund, 0)) == 0
+
+    lo = np.zeros(base.shape)
+    solved = is_gap_zero(lo)
+    growing = slope * post > 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        estimate = (total_need - 0.5 - base * post) / (12 * slope * post)
+    hi = np.where(growing & np.isfinite(estimate), np.maximum(np.ceil(estimate) + 1, 1), 1)
+
+    # 估計值可能因浮點誤差差 1 元，不足時倍增上界直到缺口為 0
+    active = ~solved & growing
+    for _ in range(64):
+        short = active & ~is_gap_zero(hi)
+        if not short.any():
+            break
+        hi = np.where(short, hi * 2, hi)
+    active &= is_gap_zero(hi)
+
+    # 整數二分搜尋：lo 缺口不為 0，hi 缺口為 0
+    while (active & (hi - lo > 1)).any():
+        mid = np.floor((lo + hi) / 2)
+        ok = is_gap_zero(mid)
+        hi = np.where(active & ok, mid, hi)
+        lo = np.where(active & ~ok, mid, lo)
+
+    min_monthly_saving = np.where(solved, 0, np.where(active, hi, None))
+    return {
+        "retire_age": retire_ages.tolist(),
+        "interest_rate": interest_rates.tolist(),
+        "min_monthly_saving": [[None if v is None else int(v) for v in row] for row in min_monthly_saving.tolist()]
+    }
+
+def _simulate_paths(return_rng, inflation_rng, count: int, current_age: int, retire_age: int, monthly_basic_expense: float, monthly_fun_expense: float, monthly_saving: float, current_saving: float, max_age: int, interest_rate: float, return_volatility: float, inflation_volatility: float):
+    """
+    模擬 count 條路徑，回傳 (存款軌跡 (count, 年數), 資金缺口 (count,), 交叉點年份索引 (count,)，未交叉為年數)。
+    與 calculate_retirement_plan 相同的模型，只是每年的存款利率與通膨率改為隨機抽樣。
+    """
+    years_to_live = max_age - current_age
+    years_to_retire = retire_age - current_age
+    work_years = min(max(years_to_retire, 0), years_to_live)
+
+    # 單年報酬與通膨不低於 -99%，避免複利歸零
+    returns = return_rng.normal(interest_rate, return_volatility, (count, years_to_live))
+    growth = np.maximum(1 + returns, 0.01, out=returns).cumprod(axis=1)
+
+    # --- 存款軌跡 ---
+    # f_y = f_{y-1}·g_y + 年存款  =>  f_y = G_y·(本金 + 年存款·Σ_{t<=min(y,W)} 1/G_t)
+    funds = np.full((count, years_to_live), float(current_saving))
+    if work_years:
+        contributions = (monthly_saving * 12) * (1 / growth[:, :work_years]).cumsum(axis=1)
+        funds[:, :work_years] += contributions
+        funds[:, work_years:] += contributions[:, -1:]
+    funds *= growth
+
+    # --- 需求軌跡 (通膨從退休後才開始計算) ---
+    # 退休後第 m 年的通膨倍數為退休後各年 (1+通膨) 的連乘；已退休者退休至今的年數以 3% 計
+    needs = np.zeros((count, years_to_live))
+    if work_years < years_to_live:
+        inflation = inflation_rng.normal(INFLATION_RATE, inflation_volatility, (count, years_to_live - work_years))
+        multiplier = np.maximum(1 + inflation, 0.01, out=inflation).cumprod(axis=1)
+        multiplier *= (1 + INFLATION_RATE) ** (work_years - years_to_retire) * ((monthly_basic_expense + monthly_fun_expense) * 12)
+        multiplier.cumsum(axis=1, out=needs[:, work_years:])
+
+    gap = np.maximum(needs[:, -1] - funds[:, -1], 0)
+
+    # 找出交叉點：存款低於累積需求(含娛樂)的年份
+    rounded_needs = np.rint(needs)
+    crossed = (rounded_needs > 0) & (rounded_needs >= np.rint(funds))
+    crossover_index = np.where(crossed.any(axis=1), crossed.argmax(axis=1), years_to_live)
+
+    return funds, gap, crossover_index
+
+
+def _histogram_percentiles(counts: np.ndarray, edges_low: np.ndarray, bin_width: np.ndarray, percentiles) -> np.ndarray:
+    """由每個年齡的直方圖 (年數, 格數) 估計百分位數，格內以線性內插"""
+    cumulative = counts.cumsum(axis=1)
+    total = cumulative[:, -1:]
+    bands = []
+    for p in percentiles:
+        target = total[:, 0] * p / 100
+        index = np.minimum((cumulative < target[:, None]).sum(axis=1), counts.shape[1] - 1)
+        rows = np.arange(len(index))
+        below = np.where(index > 0, cumulative[rows, np.maximum(index - 1, 0)], 0)
+        in_bin = np.maximum(counts[rows, index], 1)
+        bands.append(edges_low + (index + np.clip((target - below) / in_bin, 0, 1)) * bin_width)
+    return np.array(bands)
+
+
+def simulate_retirement_plan(current_age: int, retire_age: int, monthly_basic_expense: float, monthly_fun_expense: float, monthly_saving: float, current_saving: float, max_age: int = 100, interest_rate: float = 0.015, paths: int = 10000, seed: int = 0, return_volatility: float = 0.02, inflation_volatility: float = 0.01, chunk_size: int = None):
+    """
+    蒙地卡羅退休模擬：每年存款利率 ~ N(interest_rate, return_volatility)、通膨率 ~ N(3%, inflation_volatility)。
+    所有路徑以 (路徑數, 年數) 陣列一次計算；報酬與通膨各用一條由 seed 衍生的亂數串流，結果可重現。
+    chunk_size 有值時每次只模擬 chunk_size 條路徑，記憶體用量固定：
+    成功機率與交叉點分佈與一次模擬完全相同；存款百分位數帶則是由每個年齡的直方圖 (SIMULATION_HISTOGRAM_BINS 格，
+    範圍取自第一段) 內插出的近似值，誤差約一格寬度，落在範圍外的路徑歸入頭尾格，與一次模擬的 np.percentile 不會逐位相同。
+    """
+    years_to_live = max_age - current_age
+    if years_to_live <= 0:
+        raise ValueError("max_age 必須大於 current_age")
+    if paths <= 0:
+        raise ValueError("paths 必須大於 0")
+
+    return_rng, inflation_rng = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(2)]
+    chunk_size = min(chunk_size or paths, paths)
+    plan_args = (current_age, retire_age, monthly_basic_expense, monthly_fun_expense, monthly_saving, current_saving, max_age, interest_rate, return_volatility, inflation_volatility)
+
+    successes = 0
+    crossover_counts = np.zeros(years_to_live + 1, dtype=np.int64)
+    histogram = None
+    for start in range(0, paths, chunk_size):
+        funds, gap, crossover_index = _simulate_paths(return_rng, inflation_rng, min(chunk_size, paths - start), *plan_args)
+        successes += int((np.rint(gap) == 0).sum())
+        crossover_counts += np.bincount(crossover_index, minlength=years_to_live + 1)
+
+        if chunk_size == paths:
+            bands = np.percentile(funds, SIMULATION_PERCENTILES, axis=0)
+            break
+
+        # 分段模擬：以第一段的範圍 (前後各放寬一半) 建立每個年齡的直方圖，超出範圍的值計入頭尾格
+        if histogram is None:
+            low, high = funds.min(axis=0), funds.max(axis=0)
+            span = np.maximum(high - low, 1.0)
+            edges_low = low - span / 2
+            bin_width = span * 2 / SIMULATION_HISTOGRAM_BINS
+            histogram = np.zeros(years_to_live * SIMULATION_HISTOGRAM_BINS, dtype=np.int64)
+        bins = np.clip(((funds - edges_low) / bin_width).astype(np.int64), 0, SIMULATION_HISTOGRAM_BINS - 1)
+        bins += np.arange(years_to_live) * SIMULATION_HISTOGRAM_BINS
+        histogram += np.bincount(bins.ravel(), minlength=histogram.size)
+    else:
+        bands = _histogram_percentiles(histogram.reshape(years_to_live, -1), edges_low, bin_width, SIMULATION_PERCENTILES)
+
+    bands = np.rint(bands).astype(np.int64).tolist()
+    return {
+        "paths": paths,
+        "seed": seed,
+        "success_probability": successes / paths,
+        "history": {
+            "ages": list(range(current_age, max_age + 1)),
+            "funds_percentiles": {f"p{p}": [current_saving] + band for p, band in zip(SIMULATION_PERCENTILES, bands)}
+        },
+        "crossover_age_distribution": {
+            "ages": list(range(current_age + 1, max_age + 1)),
+            "probability": (crossover_counts[:-1] / paths).tolist(),
+            "never": int(crossover_counts[-1]) / paths
+        }
+    }
+
 if __name__ == "__main__":
     # Test
     res = calculate_retirement_plan(
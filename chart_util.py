@@ -1,15 +1,21 @@
 import urllib.parse
 import json
 import time
-import requests
+import os
+import io
+import hashlib
+import sqlite3
+import threading
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from starlette.concurrency import run_in_threadpool
+from PIL import Image, ImageDraw, ImageFont
+from metrics_util import STAGE_SECONDS, BACKGROUND_TASK_SECONDS, BACKGROUND_TASK_FAILURES, Counter
 
-def generate_quickchart_url(history: dict, crossover_age: int = None) -> str:
-    """
-    將計算的歷年資料軌跡轉換為 QuickChart API 圖片網址。
-    使用 QuickChart 短網址 API 避免超過 LINE 的 2000 字元限制。
-    """
-    
-    # 取出約 8~10 個資料點當作圖表呈現
+def _sample_history(history: dict):
+    """取出約 8~10 個資料點當作圖表呈現，金額換算為萬元，回傳 (ages, funds, needs_basic, needs_with_fun)"""
     raw_ages = history["ages"]
     raw_funds = history["funds"]
     raw_needs_basic = history["needs_basic"]
@@ -27,15 +33,128 @@ def generate_quickchart_url(history: dict, crossover_age: int = None) -> str:
     funds = [round(raw_funds[i] / 10000, 1) for i in indices]
     needs_basic = [round(raw_needs_basic[i] / 10000, 1) for i in indices]
     needs_with_fun = [round(raw_needs_with_fun[i] / 10000, 1) for i in indices]
-    
-    # 副標題：交叉點說明
+    return ages, funds, needs_basic, needs_with_fun
+
+
+def _chart_subtitle(crossover_age: int = None, with_icon: bool = True) -> str:
+    """副標題：交叉點說明 (本地繪圖的字型沒有 emoji，可省略圖示)"""
     if crossover_age:
-        subtitle_text = f"📌 約在 {crossover_age} 歲時存款將不足以支應退休開銷"
-    else:
-        subtitle_text = "✅ 存款預估可支撐退休生活至 100 歲"
-    
-    # 底部說明文字（假設條件）
-    footer_text = "假設條件：通膨率 3% ／ 存款利率 1.5% ／ 預計壽命 100 歲"
+        text = f"約在 {crossover_age} 歲時存款將不足以支應退休開銷"
+        return f"📌 {text}" if with_icon else text
+    text = "存款預估可支撐退休生活至 100 歲"
+    return f"✅ {text}" if with_icon else text
+
+
+# === 圖表網址快取 ===
+
+# QuickChart 服務位址：可改成自架的 QuickChart，或壓力測試 (loadtest.py) 的本機假服務
+QUICKCHART_BASE_URL = os.getenv("QUICKCHART_BASE_URL", "https://quickchart.io").rstrip("/")
+QUICKCHART_FALLBACKS = Counter("quickchart_fallbacks_total", "QuickChart 短網址失敗、改用長網址的次數")
+# QuickChart 圖片尺寸與背景色 (短網址 POST 與長網址 GET 共用)
+QUICKCHART_WIDTH = 800
+QUICKCHART_HEIGHT = 500
+QUICKCHART_BACKGROUND = "rgb(253,251,247)"
+
+# QuickChart 短網址 (免費方案) 的有效期限為 3 天，快取不可比它更久
+CHART_CACHE_TTL_SECONDS = 3 * 24 * 60 * 60
+
+
+def chart_cache_key(history: dict, crossover_age: int = None, renderer: str = "quickchart") -> str:
+    """
+    以取樣後的圖表資料 (ages/funds/needs 與交叉點) 計算內容雜湊。
+    不同使用者輸入相同的整數金額時，取樣結果相同，就能共用同一張圖。
+    """
+    payload = json.dumps([renderer, crossover_age, *_sample_history(history)], separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+
+class ChartCache:
+    """
+    圖表網址快取：記憶體 LRU (筆數上限 + TTL)，可選擇加上 SQLite 磁碟層，重啟後仍可沿用尚未過期的網址。
+    多個 threadpool worker 會同時存取，所有操作都以 lock 保護。
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = CHART_CACHE_TTL_SECONDS, disk_path: str = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (url, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._db = None
+        if disk_path:
+            self._db = sqlite3.connect(disk_path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS chart_cache (key TEXT PRIMARY KEY, url TEXT NOT NULL, expires_at REAL NOT NULL)")
+            self._db.execute("DELETE FROM chart_cache WHERE expires_at <= ?", (time.time(),))
+            self._db.commit()
+
+    def get(self, key: str):
+        """回傳快取的網址，不存在或已過期時回傳 None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry:
+                del self._entries[key]
+
+            if self._db is not None:
+                row = self._db.execute("SELECT url, expires_at FROM chart_cache WHERE key = ? AND expires_at > ?", (key, now)).fetchone()
+                if row:
+                    self._store(key, row[0], row[1])
+                    self.disk_hits += 1
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+    def peek(self, key: str) -> bool:
+        """記憶體中是否有尚未過期的網址 (不更新 LRU 順序與命中統計，不查磁碟)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return bool(entry and entry[1] > time.time())
+
+    def put(self, key: str, url: str):
+        expires_at = time.time() + self.ttl_seconds
+        with self._lock:
+            self._store(key, url, expires_at)
+            if self._db is not None:
+                # 寫入時順便清除過期資料，磁碟層不會無限成長 (寫入只發生在產生新圖表之後，頻率很低)
+                self._db.execute("DELETE FROM chart_cache WHERE expires_at <= ?", (time.time(),))
+                self._db.execute("INSERT OR REPLACE INTO chart_cache (key, url, expires_at) VALUES (?, ?, ?)", (key, url, expires_at))
+                self._db.commit()
+
+    def _store(self, key: str, url: str, expires_at: float):
+        self._entries[key] = (url, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0
+            }
+
+
+def quickchart_config(history: dict, crossover_age: int = None) -> dict:
+    """由歷年軌跡取樣並組出 QuickChart 的 Chart.js 設定 (不發出網路請求)"""
+    ages, funds, needs_basic, needs_with_fun = _sample_history(history)
+    subtitle_text = _chart_subtitle(crossover_age)
     
     # 設定 QuickChart 的 Chart.js 格式
     # 使用 chartjs-plugin-annotation 畫交叉點垂直線
@@ -132,32 +251,442 @@ def generate_quickchart_url(history: dict, crossover_age: int = None) -> str:
             }
         }
     }
+    return chart_config
+
+
+def quickchart_request_body(history: dict, crossover_age: int = None) -> dict:
+    """QuickChart 短網址 API (POST /chart/create) 的 request body"""
+    return {
+        "chart": quickchart_config(history, crossover_age),
+        "width": QUICKCHART_WIDTH,
+        "height": QUICKCHART_HEIGHT,
+        "backgroundColor": QUICKCHART_BACKGROUND,
+        "format": "png"
+    }
+
+
+def generate_quickchart_url(history: dict, crossover_age: int = None, cache: ChartCache = None) -> str:
+    """
+    將計算的歷年資料軌跡轉換為 QuickChart API 圖片網址。
+    使用 QuickChart 短網址 API 避免超過 LINE 的 2000 字元限制。
+    有提供 cache 時，相同內容的圖表直接沿用之前的短網址，不再發出 HTTP 請求。
+    """
+    cache_key = None
+    if cache is not None:
+        cache_key = chart_cache_key(history, crossover_age, "quickchart")
+        cached_url = cache.get(cache_key)
+        if cached_url:
+            return cached_url
+
+    body = quickchart_request_body(history, crossover_age)
     
-    # 使用 QuickChart 短網址 API (POST) 取得短連結
+    # 使用 QuickChart 短網址 API (POST) 取得短連結；requests 在第一次呼叫時才載入
     try:
-        resp = requests.post("https://quickchart.io/chart/create", json={
-            "chart": chart_config,
-            "width": 800,
-            "height": 500,
-            "backgroundColor": "rgb(253,251,247)",
-            "format": "png"
-        }, timeout=10)
+        import requests
+        with STAGE_SECONDS.time("chart.quickchart"):
+            resp = requests.post(f"{QUICKCHART_BASE_URL}/chart/create", json=body, timeout=10)
         
         if resp.status_code == 200:
             short_url = resp.json().get("url", "")
             print(f"QuickChart short URL ({len(short_url)} chars): {short_url}")
+            if cache is not None and short_url:
+                cache.put(cache_key, short_url)
             return short_url
     except Exception as e:
         print(f"QuickChart short URL failed: {e}")
+    QUICKCHART_FALLBACKS.inc()
     
-    # Fallback: 使用 GET URL (可能超過長度限制)
-    chart_json = json.dumps(chart_config)
-    base_url = "https://quickchart.io/chart"
-    params = {"c": chart_json, "w": 800, "h": 500, "bkg": "rgb(253,251,247)", "f": "png"}
+    # Fallback: 使用 GET URL (可能超過長度限制)，不寫入快取，下次再嘗試取得短網址
+    chart_json = json.dumps(body["chart"])
+    base_url = f"{QUICKCHART_BASE_URL}/chart"
+    params = {"c": chart_json, "w": QUICKCHART_WIDTH, "h": QUICKCHART_HEIGHT, "bkg": QUICKCHART_BACKGROUND, "f": "png"}
     url = f"{base_url}?{urllib.parse.urlencode(params)}"
     print(f"Fallback URL ({len(url)} chars)")
     return url
 
+# === 本地繪圖 (Pillow)，取代 QuickChart 的外部請求 ===
+
+CHART_WIDTH = 800
+CHART_HEIGHT = 500
+# 先以 2 倍解析度繪製再縮小，線條才有反鋸齒效果
+CHART_SUPERSAMPLE = 2
+CHART_BACKGROUND = (253, 251, 247)
+# PNG 壓縮等級：1 的編碼時間約為預設值 6 的三分之一，檔案略大但仍遠低於 LINE 的 10MB 限制
+CHART_PNG_COMPRESS_LEVEL = 1
+
+# 依序嘗試的中文字型；可用 CHART_FONT_PATH 環境變數指定
+CJK_FONT_CANDIDATES = [
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc",
+    "/System/Library/Fonts/PingFang.ttc",
+    "C:/Windows/Fonts/msjh.ttc",
+]
+
+# 與 QuickChart 設定相同的三條資料線：(標籤, 線條顏色, 虛線樣式)
+CHART_DATASETS = [
+    ("預估實際存款", (16, 185, 129), None),
+    ("需求(僅生活)", (59, 130, 246), (3, 3)),
+    ("需求(含娛樂)", (245, 158, 11), (5, 5)),
+]
+
+
+@lru_cache(maxsize=None)
+def _chart_font_path():
+    """找出可用的中文字型路徑，找不到時回傳 None"""
+    for path in [os.getenv("CHART_FONT_PATH")] + CJK_FONT_CANDIDATES:
+        if path and os.path.exists(path):
+            return path
+    print("警告: 找不到中文字型，圖表文字可能無法正確顯示，請設定 CHART_FONT_PATH。")
+    return None
+
+
+def has_cjk_font() -> bool:
+    """本機繪圖是否找得到中文字型；找不到時圖表上的中文會變成方框，應改用 QuickChart"""
+    return _chart_font_path() is not None
+
+
+@lru_cache(maxsize=None)
+def _chart_font(size: int) -> ImageFont.FreeTypeFont:
+    """載入中文字型 (依尺寸快取)，找不到時使用 Pillow 內建字型 (無法顯示中文)"""
+    path = _chart_font_path()
+    if path:
+        return ImageFont.truetype(path, size)
+    return ImageFont.load_default(size)
+
+
+def _nice_axis_max(value: float, ticks: int = 5):
+    """回傳 (軸最大值, 刻度間距)，刻度間距取 1/2/5 x 10^n"""
+    if value <= 0:
+        return 1.0, 0.2
+    raw_step = value / ticks
+    magnitude = 10 ** int(f"{raw_step:e}".split("e")[1])
+    for factor in (1, 2, 5, 10):
+        step = factor * magnitude
+        if step >= raw_step:
+            break
+    axis_max = step * -(-value // step)
+    return axis_max, step
+
+
+def _dashed_polyline(draw: ImageDraw.ImageDraw, points: list, color, width: int, dash: tuple):
+    """沿折線畫虛線，dash = (線段長, 間隔長)"""
+    on, off = dash
+    drawing, remaining = True, on
+    for (x0, y0), (x1, y1) in zip(points, points[1:]):
+        length = ((x1 - x0) ** 2 + (y1 - y0) ** 2) ** 0.5
+        position = 0.0
+        while position < length:
+            segment = min(remaining, length - position)
+            if drawing:
+                t0, t1 = position / length, (position + segment) / length
+                draw.line([(x0 + (x1 - x0) * t0, y0 + (y1 - y0) * t0), (x0 + (x1 - x0) * t1, y0 + (y1 - y0) * t1)], fill=color, width=width)
+            position += segment
+            remaining -= segment
+            if remaining <= 0:
+                drawing = not drawing
+                remaining = on if drawing else off
+
+
+def render_chart_png(history: dict, crossover_age: int = None) -> bytes:
+    """
+    以 Pillow 在本地繪製與 QuickChart 版本相同內容的折線圖 (三條資料線、交叉點標註、標題與副標題)，回傳 PNG bytes。
+    """
+    ages, funds, needs_basic, needs_with_fun = _sample_history(history)
+    series = [funds, needs_basic, needs_with_fun]
+
+    k = CHART_SUPERSAMPLE
+    width, height = CHART_WIDTH * k, CHART_HEIGHT * k
+    # RGB 底圖搭配 RGBA 畫筆：半透明顏色會直接與底圖混合，不需要額外圖層與 alpha 合成
+    image = Image.new("RGB", (width, height), CHART_BACKGROUND)
+    draw = ImageDraw.Draw(image, "RGBA")
+    text_color = (74, 64, 54)
+    tick_color = (140, 126, 108)
+    title_font, label_font, tick_font = _chart_font(16 * k), _chart_font(12 * k), _chart_font(11 * k)
+
+    # --- 標題與副標題 ---
+    y = 10 * k
+    for line in ["退休金與存款趨勢圖 (單位：萬)", _chart_subtitle(crossover_age, with_icon=False)]:
+        draw.text((width / 2, y), line, font=title_font, fill=text_color, anchor="ma")
+        y += 22 * k
+
+    # --- 圖例 ---
+    legend_items = []
+    for label, color, _ in CHART_DATASETS:
+        legend_items.append((label, color, draw.textlength(label, font=label_font)))
+    legend_width = sum(30 * k + w + 14 * k for _, _, w in legend_items)
+    x = (width - legend_width) / 2
+    y += 4 * k
+    for label, color, text_width in legend_items:
+        draw.rectangle([x, y + 2 * k, x + 24 * k, y + 12 * k], fill=color + (38,), outline=color, width=2 * k)
+        draw.text((x + 30 * k, y + 7 * k), label, font=label_font, fill=text_color, anchor="lm")
+        x += 30 * k + text_width + 14 * k
+
+    # --- 座標軸 ---
+    axis_max, tick_step = _nice_axis_max(max(max(values) for values in series))
+    tick_labels = []
+    value = 0.0
+    while value <= axis_max + tick_step / 2:
+        tick_labels.append((value, f"{value:,.0f}" if tick_step >= 1 else f"{value:,.1f}"))
+        value += tick_step
+    left = 16 * k + max(draw.textlength(text, font=tick_font) for _, text in tick_labels)
+    right = width - 16 * k
+    top = y + 28 * k
+    bottom = height - (24 + 30) * k  # 底部保留 30px，與 QuickChart 設定的 padding 相同
+
+    def to_x(index: int) -> float:
+        return left + (right - left) * index / max(len(ages) - 1, 1)
+
+    def to_y(value: float) -> float:
+        return bottom - (bottom - top) * value / axis_max
+
+    for value, text in tick_labels:
+        y = to_y(value)
+        _dashed_polyline(draw, [(left, y), (right, y)], text_color + (13,), k, (4 * k, 4 * k))
+        draw.text((left - 8 * k, y), text, font=tick_font, fill=tick_color, anchor="rm")
+    label_every = max(1, -(-len(ages) // 10))
+    for i, age in enumerate(ages):
+        if i % label_every == 0:
+            draw.text((to_x(i), bottom + 8 * k), str(age), font=tick_font, fill=tick_color, anchor="ma")
+
+    # --- 資料線 (半透明填色到 0，再畫線) ---
+    line_points = []
+    for (label, color, dash), values in zip(CHART_DATASETS, series):
+        points = [(to_x(i), to_y(v)) for i, v in enumerate(values)]
+        draw.polygon([(points[0][0], bottom)] + points + [(points[-1][0], bottom)], fill=color + (38,))
+        line_points.append((points, color, dash))
+    for points, color, dash in line_points:
+        if dash:
+            _dashed_polyline(draw, points, color, 3 * k, (dash[0] * k, dash[1] * k))
+        else:
+            draw.line(points, fill=color, width=3 * k, joint="curve")
+
+    # --- 交叉點標註 ---
+    if crossover_age and crossover_age in ages:
+        x = to_x(ages.index(crossover_age))
+        _dashed_polyline(draw, [(x, top), (x, bottom)], (239, 68, 68, 153), 2 * k, (6 * k, 4 * k))
+        label = f"{crossover_age} 歲"
+        label_width = draw.textlength(label, font=label_font)
+        draw.rounded_rectangle(
+            [x - label_width / 2 - 6 * k, top, x + label_width / 2 + 6 * k, top + 20 * k],
+            radius=6 * k, fill=(239, 68, 68, 204)
+        )
+        draw.text((x, top + 10 * k), label, font=label_font, fill=(255, 255, 255), anchor="mm")
+
+    # 整數倍縮小用 reduce (區塊平均)，比 LANCZOS 快一個數量級，反鋸齒效果相同
+    image = image.reduce(k)
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", compress_level=CHART_PNG_COMPRESS_LEVEL)
+    return buffer.getvalue()
+
+
+def generate_local_chart_url(history: dict, crossover_age: int, output_dir: str, base_url: str, cache: ChartCache = None) -> str:
+    """
+    在本地繪製圖表並存到 output_dir (由 FastAPI StaticFiles 提供)，回傳公開網址。
+    base_url 為對外的靜態檔網址前綴，例如 https://example.onrender.com/static/charts
+    檔名即內容雜湊，相同內容的圖表只會繪製一次 (檔案本身就是磁碟快取)。
+    """
+    key = chart_cache_key(history, crossover_age, "local")
+    if cache is not None:
+        cached_url = cache.get(key)
+        if cached_url:
+            return cached_url
+
+    filename = f"{key}.png"
+    path = os.path.join(output_dir, filename)
+    try:
+        # 沿用既有檔案時更新修改時間，ChartFileJanitor 才不會在網址快取到期前刪掉它
+        os.utime(path)
+    except FileNotFoundError:
+        # 先寫入暫存檔再改名，避免同時請求讀到寫到一半的圖片
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with STAGE_SECONDS.time("chart.render_png"):
+            png = render_chart_png(history, crossover_age)
+        with open(temp_path, "wb") as f:
+            f.write(png)
+        os.replace(temp_path, path)
+
+    url = f"{base_url.rstrip('/')}/{filename}"
+    if cache is not None:
+        cache.put(key, url)
+    return url
+
+class ChartFileJanitor:
+    """
+    背景執行緒：定期刪除 output_dir 中超過 ttl_seconds 未被使用的圖表 PNG (與殘留的暫存檔)，
+    TTL 與 ChartCache 相同，已快取的網址在到期前仍指向存在的檔案。
+    """
+
+    def __init__(self, output_dir: str, ttl_seconds: float = CHART_CACHE_TTL_SECONDS, interval: float = 60 * 60):
+        self.output_dir = output_dir
+        self.ttl_seconds = ttl_seconds
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="chart-janitor", daemon=True)
+            self._thread.start()
+
+    def close(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        # 啟動時先清一輪，之後每 interval 秒清一次
+        while True:
+            try:
+                with BACKGROUND_TASK_SECONDS.time("chart.prune_files"):
+                    self.prune()
+            except Exception as e:
+                BACKGROUND_TASK_FAILURES.inc("chart.prune_files")
+                print(f"清除過期圖表失敗，下一輪重試: {e}")
+            if self._stop.wait(self.interval):
+                return
+
+    def prune(self, now: float = None) -> int:
+        """刪除過期的圖表檔案，回傳刪除的檔案數"""
+        cutoff = (time.time() if now is None else now) - self.ttl_seconds
+        removed = 0
+        with os.scandir(self.output_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith((".png", ".tmp")) or not entry.is_file():
+                    continue
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+# === 預先繪製圖表 ===
+
+# 預先繪製的結果保留多久等待 /api/send_result 取用；逾時未取用視為浪費
+PRERENDER_TTL_SECONDS = 10 * 60
+
+
+class ChartPrerenderer:
+    """
+    試算完成後立即在背景繪製圖表 (大部分使用者幾秒後就會按「傳送到 LINE」)。
+    以固定數量的 worker 執行，依圖表內容雜湊保存 future；/api/send_result 取用已完成的網址或等待進行中的繪製，
+    不必從頭開始。進行中的數量達 max_pending 時不再預先繪製 (不影響正常流程)。
+    render(history, crossover_age) -> url 為實際的繪圖函式，本身應使用 ChartCache，完成的網址之後也能直接由快取取得。
+    """
+
+    def __init__(self, render, renderer: str = "quickchart", workers: int = 2, max_pending: int = 64,
+                 ttl_seconds: float = PRERENDER_TTL_SECONDS, cache: ChartCache = None):
+        self.render = render
+        self.renderer = renderer
+        self.max_pending = max_pending
+        self.ttl_seconds = ttl_seconds
+        self.cache = cache
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chart-prerender")
+        self.workers = workers
+        self._futures = OrderedDict()  # key -> (future, submitted_at)
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.skipped = 0
+        self.already_cached = 0
+        self.ready_hits = 0
+        self.inflight_hits = 0
+        self.cache_hits = 0
+        self.preempted = 0
+        self.misses = 0
+        self.wasted = 0
+        self.failed = 0
+
+    def submit(self, history: dict, crossover_age: int = None):
+        """在背景開始繪製；已有快取、同內容已在繪製或 worker 忙碌時不做任何事"""
+        key = chart_cache_key(history, crossover_age, self.renderer)
+        if self.cache is not None and self.cache.peek(key):
+            with self._lock:
+                self.already_cached += 1
+            return
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            if key in self._futures:
+                return
+            if sum(1 for future, _ in self._futures.values() if not future.done()) >= self.max_pending:
+                self.skipped += 1
+                return
+            future = self._executor.submit(self.render, history, crossover_age)
+            self._futures[key] = (future, now)
+            self.submitted += 1
+
+    async def chart_url(self, history: dict, crossover_age: int = None) -> str:
+        """取得圖表網址：優先使用預先繪製的結果 (已完成或進行中)，沒有時才在 threadpool 中繪製"""
+        key = chart_cache_key(history, crossover_age, self.renderer)
+        with self._lock:
+            entry = self._futures.pop(key, None)
+            if entry is not None:
+                if entry[0].done():
+                    self.ready_hits += 1
+                elif entry[0].cancel():
+                    # 還在排隊、尚未開始繪製：不必等前面的工作，直接自己繪製
+                    entry = None
+                    self.preempted += 1
+                else:
+                    self.inflight_hits += 1
+            elif self.cache is not None and self.cache.peek(key):
+                self.cache_hits += 1
+            else:
+                self.misses += 1
+
+        if entry is not None:
+            try:
+                with STAGE_SECONDS.time("chart.prerender_wait"):
+                    return await asyncio.wrap_future(entry[0])
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                print(f"預先繪製圖表失敗，改為重新繪製: {e}")
+
+        return await run_in_threadpool(self.render, history, crossover_age)
+
+    def _expire(self, now: float):
+        while self._futures:
+            key, (future, submitted_at) = next(iter(self._futures.items()))
+            if submitted_at + self.ttl_seconds > now:
+                break
+            del self._futures[key]
+            self.wasted += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._expire(time.time())
+            hits = self.ready_hits + self.inflight_hits
+            return {
+                "workers": self.workers,
+                "pending": sum(1 for future, _ in self._futures.values() if not future.done()),
+                "waiting": len(self._futures),
+                "submitted": self.submitted,
+                "skipped": self.skipped,
+                "already_cached": self.already_cached,
+                "ready_hits": self.ready_hits,
+                "inflight_hits": self.inflight_hits,
+                "cache_hits": self.cache_hits,
+                "preempted": self.preempted,
+                "misses": self.misses,
+                "hit_rate": hits / (hits + self.preempted + self.misses) if hits + self.preempted + self.misses else 0.0,
+                "wasted": self.wasted,
+                "failed": self.failed
+            }
+
+    def close(self, wait: bool = False):
+        """停止 worker；尚未被取用的預先繪製都算浪費。wait=True 時等待繪製中的圖表完成"""
+        with self._lock:
+            self.wasted += len(self._futures)
+            self._futures.clear()
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+
 if __name__ == "__main__":
     # Test
     from calculator import calculate_retirement_plan
@@ -0,0 +1,87 @@
+import unicodedata
+
+# 模糊比對 (輸入只打了指令的開頭) 時至少要有幾個字
+MIN_PREFIX_CHARS = 2
+
+
+def normalize_command(text: str) -> str:
+    """
+    指令比對用的正規化：全形轉半形 (NFKC)、去除空白與標點、英文轉小寫。
+    「 我的結果！」、「我的 結果」與「我的結果」都會得到同一個 key。
+    """
+    text = unicodedata.normalize("NFKC", text)
+    return "".join(
+        char for char in text
+        if not unicodedata.category(char).startswith(("P", "Z", "C"))
+    ).lower()
+
+
+class _TrieNode:
+    __slots__ = ("children", "target", "targets")
+
+    def __init__(self):
+        self.children = {}
+        self.target = None
+        # 此節點之下所有指令的目標，用來判斷輸入的開頭是否只對應到一個指令
+        self.targets = set()
+
+
+class CommandRouter:
+    """
+    文字指令的分派表。比對順序：
+    1. 正規化後完全相符：dict 查詢，O(1)
+    2. 輸入以某個指令開頭 (例如「試算 我今年35歲」)：沿 trie 找最長的相符指令
+    3. 輸入是某個指令的開頭 (例如只打了「財稅」)：該前綴底下只有一個目標時視為該指令
+    target 可以是任何物件 (例如預先序列化好的回覆訊息或產生回覆的函式)，由呼叫端決定如何使用。
+    """
+
+    def __init__(self, min_prefix_chars: int = MIN_PREFIX_CHARS):
+        self.min_prefix_chars = min_prefix_chars
+        self._exact = {}
+        self._root = _TrieNode()
+
+    def add(self, command: str, target, aliases: tuple = ()):
+        for name in (command,) + tuple(aliases):
+            key = normalize_command(name)
+            if not key:
+                raise ValueError(f"無效的指令: {name!r}")
+            self._exact[key] = target
+            node = self._root
+            node.targets.add(id(target))
+            for char in key:
+                node = node.children.setdefault(char, _TrieNode())
+                node.targets.add(id(target))
+            node.target = target
+
+    def match(self, text: str):
+        """回傳對應的 target；沒有相符的指令時回傳 None"""
+        key = normalize_command(text or "")
+        if not key:
+            return None
+
+        target = self._exact.get(key)
+        if target is not None:
+            return target
+
+        node = self._root
+        longest = None
+        for char in key:
+            node = node.children.get(char)
+            if node is None:
+                return longest
+            if node.target is not None:
+                longest = node.target
+
+        # 整段輸入都在 trie 裡，但不是完整指令
+        if len(key) >= self.min_prefix_chars and len(node.targets) == 1:
+            while node.target is None:
+                node = next(iter(node.children.values()))
+            return node.target
+        return longest
+
+    def targets(self) -> tuple:
+        """所有不重複的 target (依加入順序)"""
+        return tuple({id(target): target for target in self._exact.values()}.values())
+
+    def __len__(self):
+        return len(self._exact)
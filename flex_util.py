@@ -0,0 +1,490 @@
+import inspect
+import threading
+from collections import OrderedDict
+
+from line_util import prepare_messages
+
+# LINE SDK 的訊息模型 (與其依賴的 pydantic.v1) 在第一次建立訊息時才載入，
+# 範本也在第一次 render (或 compile_templates 預熱) 時才建立
+
+PROFILE_TYPES = ("積極型", "穩健型", "保守型")
+
+
+def format_money(val):
+    return f"NT$ {val:,}"
+
+
+def result_slots(result: dict, chart_url: str, max_age: int = 100, interest_rate: float = 0.015) -> dict:
+    """試算結果卡片中會隨使用者變動的文字 (圖表網址、金額、缺口顏色、提示文字)"""
+    gap = result["gap"]
+    gap_color = "#10b981" if gap <= 0 else "#ef4444"
+    gap_text = "恭喜！已達成目標" if gap <= 0 else format_money(gap)
+
+    # 交叉點提示文字
+    crossover_age = result.get("crossover_age")
+    if crossover_age:
+        chart_hint = f"當綠色線（存款）與橘色線（需求）交叉時，代表存款即將用盡。依您目前的規劃，約在 {crossover_age} 歲時存款將不足以支應退休開銷。點擊圖片可放大查看！"
+    else:
+        chart_hint = f"恭喜！依您目前的規劃，存款預估可支撐退休生活至 {max_age} 歲。點擊圖片可放大查看！"
+
+    return {
+        "chart_url": chart_url,
+        "chart_hint": chart_hint,
+        "total_need_with_fun": format_money(result["total_need_with_fun"]),
+        "total_need_basic": format_money(result["total_need_basic"]),
+        "total_fund": format_money(result["total_fund"]),
+        "gap_text": gap_text,
+        "gap_color": gap_color,
+        "assumptions": f"⚙️ 假設條件：通膨率 3% ／存款利率 {interest_rate*100:.1f}% ／預計壽命 {max_age} 歲"
+    }
+
+
+def result_bubble(chart_url: str, chart_hint: str, total_need_with_fun: str, total_need_basic: str,
+                  total_fund: str, gap_text: str, gap_color: str, assumptions: str) -> dict:
+    """試算結果卡片 (Flex bubble) 的 JSON 結構"""
+    return {
+        "type": "bubble",
+        "header": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [
+                {
+                    "type": "text",
+                    "text": "退休金試算結果",
+                    "weight": "bold",
+                    "size": "xl",
+                    "color": "#d97706"
+                }
+            ],
+            "backgroundColor": "#fdfbf7"
+        },
+        "hero": {
+            "type": "image",
+            "url": chart_url,
+            "size": "full",
+            "aspectRatio": "8:5",
+            "aspectMode": "fit",
+            "action": {
+                "type": "uri",
+                "label": "查看完整圖表",
+                "uri": chart_url
+            }
+        },
+        "body": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [
+                {
+                    "type": "text",
+                    "text": "📌 圖表怎麼看？",
+                    "weight": "bold",
+                    "size": "sm",
+                    "color": "#d97706",
+                    "margin": "none"
+                },
+                {
+                    "type": "text",
+                    "text": chart_hint,
+                    "wrap": True,
+                    "size": "xs",
+                    "color": "#8c7e6c",
+                    "margin": "sm"
+                },
+                {"type": "separator", "margin": "lg", "color": "#d1c7bc"},
+                {
+                    "type": "box",
+                    "layout": "horizontal",
+                    "contents": [
+                        {"type": "text", "text": "退休總需求 (含娛樂)", "color": "#8c7e6c", "size": "sm", "flex": 5},
+                        {"type": "text", "text": total_need_with_fun, "align": "end", "weight": "bold", "color": "#4a4036", "flex": 5}
+                    ],
+                    "margin": "lg"
+                },
+                {
+                    "type": "box",
+                    "layout": "horizontal",
+                    "contents": [
+                        {"type": "text", "text": "退休總需求 (僅生活)", "color": "#8c7e6c", "size": "sm", "flex": 5},
+                        {"type": "text", "text": total_need_basic, "align": "end", "weight": "bold", "color": "#4a4036", "flex": 5}
+                    ],
+                    "margin": "md"
+                },
+                {
+                    "type": "box",
+                    "layout": "horizontal",
+                    "contents": [
+                        {"type": "text", "text": "預估實際存款累積", "color": "#8c7e6c", "size": "sm", "flex": 5},
+                        {"type": "text", "text": total_fund, "align": "end", "weight": "bold", "color": "#4a4036", "flex": 5}
+                    ],
+                    "margin": "md"
+                },
+                {"type": "separator", "margin": "lg", "color": "#d1c7bc"},
+                {
+                    "type": "box",
+                    "layout": "horizontal",
+                    "contents": [
+                        {"type": "text", "text": "資金缺口 (以含娛樂為準)", "color": "#8c7e6c", "size": "md", "weight": "bold", "flex": 5},
+                        {"type": "text", "text": gap_text, "align": "end", "weight": "bold", "color": gap_color, "flex": 5}
+                    ],
+                    "margin": "lg"
+                },
+                {"type": "separator", "margin": "lg", "color": "#d1c7bc"},
+                {
+                    "type": "text",
+                    "text": assumptions,
+                    "wrap": True,
+                    "size": "xxs",
+                    "color": "#b0a090",
+                    "margin": "lg"
+                }
+            ],
+            "backgroundColor": "#ffffff"
+        }
+    }
+
+
+def create_flex_message(result: dict, chart_url: str, max_age: int = 100, interest_rate: float = 0.015) -> dict:
+    """建立 LINE Flex Message JSON 結構"""
+    return result_bubble(**result_slots(result, chart_url, max_age, interest_rate))
+
+
+def color_for_profile(profile_type: str) -> str:
+    """根據 profile_type 決定邊框顏色"""
+    if profile_type == "積極型":
+        return "#ef4444"
+    if profile_type == "保守型":
+        return "#10b981"
+    return "#f59e0b"  # 預設穩健橘黃
+
+
+def profile_bubble(image_url: str, profile_type: str, profile_color: str) -> dict:
+    """理財人格卡片 (Flex bubble) 的 JSON 結構"""
+    return {
+        "type": "bubble",
+        "header": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [
+                {
+                    "type": "text",
+                    "text": "您的專屬理財人格",
+                    "weight": "bold",
+                    "size": "xl",
+                    "color": "#d97706"
+                }
+            ],
+            "backgroundColor": "#fdfbf7"
+        },
+        "hero": {
+            "type": "image",
+            "url": image_url,
+            "size": "full",
+            "aspectRatio": "1024:1536",
+            "aspectMode": "cover"
+        },
+        "body": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [
+                {
+                    "type": "text",
+                    "text": profile_type,
+                    "weight": "bold",
+                    "size": "xxl",
+                    "color": profile_color,
+                    "align": "center"
+                }
+            ],
+            "backgroundColor": "#ffffff"
+        }
+    }
+
+
+def summary_bubble(created_at: str, profile_text: str, total_need_with_fun: str, total_need_basic: str,
+                   total_fund: str, gap_text: str, gap_color: str, assumptions: str) -> dict:
+    """最近一次試算結果的摘要卡片 (回覆「我的結果」用，不含圖表)"""
+    def amount_row(label: str, value: str, margin: str, color: str = "#4a4036") -> dict:
+        return {
+            "type": "box",
+            "layout": "horizontal",
+            "contents": [
+                {"type": "text", "text": label, "color": "#8c7e6c", "size": "sm", "flex": 5},
+                {"type": "text", "text": value, "align": "end", "weight": "bold", "color": color, "flex": 5}
+            ],
+            "margin": margin
+        }
+
+    return {
+        "type": "bubble",
+        "header": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [
+                {
+                    "type": "text",
+                    "text": "您最近一次的試算結果",
+                    "weight": "bold",
+                    "size": "xl",
+                    "color": "#d97706"
+                },
+                {
+                    "type": "text",
+                    "text": created_at,
+                    "size": "xs",
+                    "color": "#b0a090",
+                    "margin": "sm"
+                }
+            ],
+            "backgroundColor": "#fdfbf7"
+        },
+        "body": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [
+                amount_row("理財人格", profile_text, "none"),
+                {"type": "separator", "margin": "lg", "color": "#d1c7bc"},
+                amount_row("退休總需求 (含娛樂)", total_need_with_fun, "lg"),
+                amount_row("退休總需求 (僅生活)", total_need_basic, "md"),
+                amount_row("預估實際存款累積", total_fund, "md"),
+                {"type": "separator", "margin": "lg", "color": "#d1c7bc"},
+                amount_row("資金缺口", gap_text, "lg", gap_color),
+                {"type": "separator", "margin": "lg", "color": "#d1c7bc"},
+                {
+                    "type": "text",
+                    "text": assumptions,
+                    "wrap": True,
+                    "size": "xxs",
+                    "color": "#b0a090",
+                    "margin": "lg"
+                }
+            ],
+            "backgroundColor": "#ffffff"
+        }
+    }
+
+
+def info_bubble(title: str, description: str, button_label: str, button_uri: str) -> dict:
+    """文字指令的說明卡片：標題、說明與一個連結按鈕"""
+    return {
+        "type": "bubble",
+        "header": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [
+                {
+                    "type": "text",
+                    "text": title,
+                    "weight": "bold",
+                    "size": "xl",
+                    "color": "#d97706"
+                }
+            ],
+            "backgroundColor": "#fdfbf7"
+        },
+        "body": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [
+                {
+                    "type": "text",
+                    "text": description,
+                    "wrap": True,
+                    "size": "sm",
+                    "color": "#4a4036"
+                }
+            ],
+            "backgroundColor": "#ffffff"
+        },
+        "footer": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [
+                {
+                    "type": "button",
+                    "style": "primary",
+                    "color": "#d97706",
+                    "action": {
+                        "type": "uri",
+                        "label": button_label,
+                        "uri": button_uri
+                    }
+                }
+            ]
+        }
+    }
+
+
+class FlexTemplate:
+    """
+    預先驗證好的 Flex 卡片範本。
+    以 bubble_func 的參數作為欄位 (slot)，第一次使用時用佔位字串建立一次並通過 FlexContainer.from_dict 完整驗證，
+    記下每個佔位字串在物件樹中的位置。render() 只複製通往這些欄位的節點並填入新值，
+    其餘節點與範本共用，不再重新走訪、驗證整棵樹。
+    """
+
+    def __init__(self, bubble_func):
+        self.bubble_func = bubble_func
+        self.slots = tuple(inspect.signature(bubble_func).parameters)
+        self.container = None
+        self._trie = None
+        self._lock = threading.Lock()
+
+    def compile(self):
+        """建立並驗證範本 (需要載入 LINE SDK)；已建立過時不做任何事"""
+        if self.container is not None:
+            return
+        with self._lock:
+            if self.container is not None:
+                return
+            from linebot.v3.messaging import FlexContainer
+            markers = {name: f"{{{{{name}}}}}" for name in self.slots}
+            container = FlexContainer.from_dict(self.bubble_func(**markers))
+
+            # 欄位位置以 trie 表示：{屬性名稱或 list index: 子 trie 或欄位名稱}
+            trie = {}
+            found = set()
+            slot_by_marker = {marker: name for name, marker in markers.items()}
+            for path, value in _walk(container, ()):
+                name = slot_by_marker.get(value)
+                if name is None:
+                    continue
+                node = trie
+                for step in path[:-1]:
+                    node = node.setdefault(step, {})
+                node[path[-1]] = name
+                found.add(name)
+            if found != set(self.slots):
+                raise ValueError(f"Flex 範本找不到欄位: {sorted(set(self.slots) - found)}")
+            self._trie = trie
+            self.container = container
+
+    def render(self, **values) -> "FlexContainer":
+        if set(values) != set(self.slots):
+            raise TypeError(f"Flex 範本需要的欄位為 {self.slots}")
+        for name, value in values.items():
+            if not isinstance(value, str):
+                raise TypeError(f"Flex 範本欄位 {name} 必須是字串")
+        if self.container is None:
+            self.compile()
+        return _fill(self.container, self._trie, values)
+
+
+def _walk(node, path: tuple, model_type=None):
+    """走訪 Flex 物件樹，產生 (路徑, 字串值)"""
+    if model_type is None:
+        from pydantic.v1 import BaseModel as model_type
+    if isinstance(node, model_type):
+        for field in node.__fields__:
+            yield from _walk(getattr(node, field), path + (field,), model_type)
+    elif isinstance(node, list):
+        for index, child in enumerate(node):
+            yield from _walk(child, path + (index,), model_type)
+    elif isinstance(node, str):
+        yield path, node
+
+
+def _fill(node, trie: dict, values: dict):
+    """只淺複製 trie 經過的節點 (copy-on-write)，不經過 pydantic 驗證"""
+    if isinstance(node, list):
+        node = list(node)
+        for index, sub in trie.items():
+            node[index] = values[sub] if isinstance(sub, str) else _fill(node[index], sub, values)
+        return node
+    update = {
+        field: values[sub] if isinstance(sub, str) else _fill(getattr(node, field), sub, values)
+        for field, sub in trie.items()
+    }
+    return node.copy(update=update)
+
+
+RESULT_TEMPLATE = FlexTemplate(result_bubble)
+PROFILE_TEMPLATE = FlexTemplate(profile_bubble)
+SUMMARY_TEMPLATE = FlexTemplate(summary_bubble)
+
+
+def compile_templates():
+    """預先建立所有 Flex 範本 (預熱用)"""
+    for template in (RESULT_TEMPLATE, PROFILE_TEMPLATE, SUMMARY_TEMPLATE):
+        template.compile()
+
+
+def build_result_message(result: dict, chart_url: str, max_age: int = 100, interest_rate: float = 0.015) -> "FlexMessage":
+    from linebot.v3.messaging import FlexMessage
+    contents = RESULT_TEMPLATE.render(**result_slots(result, chart_url, max_age, interest_rate))
+    return FlexMessage(alt_text="您的財富規劃試算結果出爐了！", contents=contents)
+
+
+def build_profile_message(profile_type: str, image_url: str) -> "FlexMessage":
+    from linebot.v3.messaging import FlexMessage
+    contents = PROFILE_TEMPLATE.render(image_url=image_url, profile_type=profile_type, profile_color=color_for_profile(profile_type))
+    return FlexMessage(alt_text=f"專屬理財類型分析結果：{profile_type}", contents=contents)
+
+
+def build_summary_message(plan: dict) -> "FlexMessage":
+    """以 storage_util.PlanStore.latest_plan 的紀錄填入摘要卡片，不需要重新試算"""
+    from linebot.v3.messaging import FlexMessage
+    max_age = int(plan["max_age"] or 100)
+    interest_rate = plan["interest_rate"] if plan["interest_rate"] is not None else 0.015
+    slots = result_slots(plan, "", max_age, interest_rate)
+    contents = SUMMARY_TEMPLATE.render(
+        created_at=f"試算時間：{plan['created_at']}",
+        profile_text=plan["profile_type"] or "尚未填寫",
+        total_need_with_fun=slots["total_need_with_fun"],
+        total_need_basic=slots["total_need_basic"],
+        total_fund=slots["total_fund"],
+        gap_text=slots["gap_text"],
+        gap_color=slots["gap_color"],
+        assumptions=slots["assumptions"]
+    )
+    return FlexMessage(alt_text="您最近一次的試算結果", contents=contents)
+
+
+def build_info_message(title: str, description: str, button_label: str, button_uri: str) -> "FlexMessage":
+    from linebot.v3.messaging import FlexContainer, FlexMessage
+    contents = FlexContainer.from_dict(info_bubble(title, description, button_label, button_uri))
+    return FlexMessage(alt_text=title, contents=contents)
+
+
+def build_text_message(text: str) -> "TextMessage":
+    from linebot.v3.messaging import TextMessage
+    return TextMessage(text=text)
+
+
+class ProfileMessageCache:
+    """
+    理財人格卡片只隨 理財人格 與 圖片網址 變動，直接快取序列化好的訊息 (prepare_messages 的結果)，
+    推送時只需要加上收件人。預設圖片 (preload) 預熱時建好且不會被淘汰；
+    其他自訂圖片網址以 LRU 保存，最多 max_entries 筆。
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._pinned = {}
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def preload(self, image_urls: dict):
+        """image_urls: {理財人格: 圖片網址}"""
+        for profile_type, image_url in image_urls.items():
+            if (profile_type, image_url) not in self._pinned:
+                self._pinned[(profile_type, image_url)] = prepare_messages([build_profile_message(profile_type, image_url)])
+
+    def get(self, profile_type: str, image_url: str) -> bytes:
+        key = (profile_type, image_url)
+        with self._lock:
+            prepared = self._pinned.get(key) or self._recent.get(key)
+            if prepared is not None:
+                if key in self._recent:
+                    self._recent.move_to_end(key)
+                self.hits += 1
+                return prepared
+            self.misses += 1
+
+        prepared = prepare_messages([build_profile_message(profile_type, image_url)])
+        with self._lock:
+            self._recent[key] = prepared
+            while len(self._recent) > self.max_entries:
+                self._recent.popitem(last=False)
+        return prepared
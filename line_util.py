@@ -0,0 +1,265 @@
+import asyncio
+import importlib
+import json
+import random
+import ssl
+import threading
+import uuid
+
+from starlette.concurrency import run_in_threadpool
+
+from metrics_util import STAGE_SECONDS, LINE_API_REQUESTS
+
+# LINE SDK (linebot.v3.messaging 的整棵模型) 與 aiohttp 載入要 1 秒以上，
+# 本模組不在 import 時載入，第一次推播 (或預熱) 時才在 threadpool 中載入
+
+# LINE 推播的重試設定：429 (流量限制) 與 5xx 以指數退避重試，其他錯誤直接回報
+PUSH_MAX_RETRIES = 4
+PUSH_BACKOFF_BASE_SECONDS = 0.5
+PUSH_BACKOFF_MAX_SECONDS = 8.0
+PUSH_TIMEOUT_SECONDS = 10
+# stage_duration_seconds 的標籤 (預先建好，記錄時不必組字串)
+_STAGE_NAMES = {"push": "line.push", "multicast": "line.multicast", "reply": "line.reply"}
+# Configuration 未指定 host 時 SDK 使用的 LINE API 位址；預先序列化的請求 (_post_json) 使用 Configuration.host
+LINE_API_HOST = "https://api.line.me"
+# 單次 multicast 的收件人上限 (LINE API 限制)
+MULTICAST_MAX_RECIPIENTS = 500
+
+
+def prepare_messages(messages: list) -> bytes:
+    """
+    預先把訊息序列化成 JSON (bytes)。內容固定的訊息 (例如理財人格卡片) 只需序列化一次，
+    之後以 push_prepared 推送時每次只需要組出收件人。
+    """
+    return json.dumps([message.to_dict() for message in messages], ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def push_body(to: str, messages_json: bytes) -> bytes:
+    """組出 push API 的 request body，內容與 SDK 序列化 PushMessageRequest 的結果相同"""
+    return b'{"to":' + json.dumps(to).encode("utf-8") + b',"messages":' + messages_json + b',"notificationDisabled":false}'
+
+
+def multicast_body(to: list, messages_json: bytes) -> bytes:
+    """組出 multicast API 的 request body，內容與 SDK 序列化 MulticastRequest 的結果相同"""
+    return b'{"to":' + json.dumps(to).encode("utf-8") + b',"messages":' + messages_json + b',"notificationDisabled":false}'
+
+
+def reply_body(reply_token: str, messages_json: bytes) -> bytes:
+    """組出 reply API 的 request body，內容與 SDK 序列化 ReplyMessageRequest 的結果相同"""
+    return b'{"replyToken":' + json.dumps(reply_token).encode("utf-8") + b',"messages":' + messages_json + b',"notificationDisabled":false}'
+
+
+class LazyMessages:
+    """
+    內容固定、第一次使用時才建立並序列化的訊息 (prepare_messages 的結果)。
+    建立 Flex 訊息需要載入 LINE SDK，延後到第一次回覆 (或預熱) 時，服務啟動時不必等待。
+    build() 回傳訊息 list。
+    """
+
+    def __init__(self, build):
+        self._build = build
+        self._prepared = None
+        self._lock = threading.Lock()
+
+    def get(self) -> bytes:
+        if self._prepared is None:
+            with self._lock:
+                if self._prepared is None:
+                    self._prepared = prepare_messages(self._build())
+        return self._prepared
+
+
+def _is_api_exception(e: Exception) -> bool:
+    # 例外只會在 SDK 已載入 (start() 之後) 才發生，這裡的 import 不會觸發載入
+    from linebot.v3.messaging.exceptions import ApiException
+    return isinstance(e, ApiException)
+
+
+def _is_retryable(e: Exception) -> bool:
+    if _is_api_exception(e):
+        return e.status == 429 or (e.status or 0) >= 500
+    import aiohttp
+    return isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+def _retry_delay(e: Exception, attempt: int) -> float:
+    """優先採用伺服器回傳的 Retry-After，否則為指數退避加上隨機抖動"""
+    headers = getattr(e, "headers", None) or {}
+    retry_after = headers.get("Retry-After")
+    if retry_after:
+        try:
+            return min(float(retry_after), PUSH_BACKOFF_MAX_SECONDS)
+        except ValueError:
+            pass
+    delay = min(PUSH_BACKOFF_BASE_SECONDS * (2 ** attempt), PUSH_BACKOFF_MAX_SECONDS)
+    return delay * random.uniform(0.5, 1.0)
+
+
+def _prepared_session(configuration, aiohttp):
+    """
+    預先序列化的請求 (_post_json) 使用的 aiohttp 連線池，只依 Configuration 的公開設定建立
+    (不取用 SDK 內部的 rest_client)；認證與 User-Agent 與 SDK 送出的相同。
+    """
+    from linebot import __version__
+    ssl_context = ssl.create_default_context(cafile=configuration.ssl_ca_cert)
+    if not configuration.verify_ssl:
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=configuration.connection_pool_maxsize, ssl=ssl_context),
+        headers={
+            "Authorization": f"Bearer {configuration.access_token}",
+            "User-Agent": f"line-bot-sdk-python/{__version__}"
+        },
+        trust_env=True
+    )
+
+
+class LinePushClient:
+    """
+    共用的非同步 LINE 推播客戶端：整個服務只建立一次連線池 (keep-alive)，
+    第一次推播時才載入 SDK 並建立 (或由預熱時 start())，關閉時 close()。
+    以 semaphore 限制同時推播數量，429 / 5xx 自動重試；
+    同一則推播的所有重試共用同一個 X-Line-Retry-Key，LINE 端不會重複送出。
+    """
+
+    def __init__(self, access_token: str, host: str = None, max_concurrency: int = 32):
+        # host 未指定時使用 LINE_API_HOST；SDK 的 Configuration 在 start() 時才建立
+        self.access_token = access_token
+        self.host = host or LINE_API_HOST
+        self.max_concurrency = max_concurrency
+        self.configuration = None
+        self._api_client = None
+        self._api = None
+        self._session = None
+        self._semaphore = None
+        self._timeout = None
+
+    async def start(self):
+        if self._api is not None:
+            return
+        # SDK 在 threadpool 中載入，不阻塞 event loop；等待期間其他請求建立過就直接沿用
+        messaging = await run_in_threadpool(importlib.import_module, "linebot.v3.messaging")
+        import aiohttp
+        if self._api is not None:
+            return
+        configuration = messaging.Configuration(access_token=self.access_token, host=self.host)
+        configuration.connection_pool_maxsize = self.max_concurrency
+        self.configuration = configuration
+        # aiohttp 的 ClientSession 需要在 event loop 內建立
+        self._api_client = messaging.AsyncApiClient(configuration)
+        self._api = messaging.AsyncMessagingApi(self._api_client)
+        self._session = _prepared_session(configuration, aiohttp)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._timeout = aiohttp.ClientTimeout(total=PUSH_TIMEOUT_SECONDS)
+
+    async def close(self):
+        if self._api_client is not None:
+            await self._api_client.close()
+            await self._session.close()
+            self._api_client = None
+            self._api = None
+            self._session = None
+
+    async def push_message(self, to: str, messages: list):
+        """推送訊息給單一使用者；重試用盡仍失敗時拋出最後一次的例外"""
+        if self._api is None:
+            await self.start()
+
+        from linebot.v3.messaging import PushMessageRequest
+        push_req = PushMessageRequest(to=to, messages=messages)
+        return await self._with_retry(lambda retry_key: self._api.push_message(
+            push_req,
+            x_line_retry_key=retry_key,
+            _request_timeout=PUSH_TIMEOUT_SECONDS
+        ), api="push")
+
+    async def push_prepared(self, to: str, messages_json: bytes):
+        """
+        推送 prepare_messages 預先序列化的訊息：略過 SDK 每次建立 PushMessageRequest 與序列化整棵訊息樹，
+        只把收件人接到已序列化的內容前面。共用同一個連線池、重試與併發上限。
+        """
+        if self._api is None:
+            await self.start()
+
+        body = push_body(to, messages_json)
+        return await self._with_retry(lambda retry_key: self._post_json("/v2/bot/message/push", body, retry_key), api="push")
+
+    async def multicast_prepared(self, to: list, messages_json: bytes, retry_key: str = None):
+        """
+        以 multicast 一次推送相同的訊息給多位使用者 (最多 MULTICAST_MAX_RECIPIENTS 位)。
+        可指定 retry_key：中斷後以同一個 key 重送時，LINE 已接受過的請求不會重複送出 (回應 409，視為成功)。
+        """
+        if len(to) > MULTICAST_MAX_RECIPIENTS:
+            raise ValueError(f"multicast 收件人最多 {MULTICAST_MAX_RECIPIENTS} 位")
+        if self._api is None:
+            await self.start()
+
+        body = multicast_body(to, messages_json)
+        return await self._with_retry(
+            lambda key: self._post_json("/v2/bot/message/multicast", body, key), retry_key=retry_key, api="multicast"
+        )
+
+    async def reply_prepared(self, reply_token: str, messages_json: bytes):
+        """
+        以 reply token 回覆預先序列化的訊息 (不計入推播額度)。
+        reply token 只能使用一次，重試不會造成重複回覆，因此不帶 retry key。
+        """
+        if self._api is None:
+            await self.start()
+
+        body = reply_body(reply_token, messages_json)
+        return await self._with_retry(lambda retry_key: self._post_json("/v2/bot/message/reply", body), api="reply")
+
+    async def _post_json(self, path: str, body: bytes, retry_key: str = None):
+        configuration = self.configuration
+        headers = {"Content-Type": "application/json"}
+        if retry_key:
+            headers["X-Line-Retry-Key"] = retry_key
+        async with self._session.post(
+            configuration.host + path,
+            data=body,
+            headers=headers,
+            proxy=configuration.proxy,
+            proxy_headers=configuration.proxy_headers,
+            timeout=self._timeout
+        ) as resp:
+            data = await resp.read()
+            if not 200 <= resp.status < 300:
+                # 與 SDK 相同的例外格式，重試判斷與錯誤處理不必區分兩種推送方式
+                from linebot.v3.messaging.exceptions import ApiException
+                e = ApiException(status=resp.status, reason=resp.reason)
+                e.body = data.decode("utf-8", "replace")
+                e.headers = resp.headers
+                raise e
+            return json.loads(data) if data else None
+
+    async def _with_retry(self, send, retry_key: str = None, api: str = "push"):
+        """
+        以同一個 retry key 執行 send(retry_key)，429 / 5xx 時退避重試；未指定 retry_key 時產生新的。
+        每次請求的結果記錄在 line_api_requests_total，含重試的總耗時記錄在 stage_duration_seconds{stage="line.<api>"}。
+        """
+        resumed = retry_key is not None
+        retry_key = retry_key or str(uuid.uuid4())
+        attempt = 0
+        with STAGE_SECONDS.time(_STAGE_NAMES[api]):
+            while True:
+                try:
+                    async with self._semaphore:
+                        response = await send(retry_key)
+                    LINE_API_REQUESTS.inc(api, "success")
+                    return response
+                except Exception as e:
+                    # 409：同一個 retry key 先前的請求其實已被 LINE 接受
+                    if _is_api_exception(e) and e.status == 409 and (attempt > 0 or resumed):
+                        LINE_API_REQUESTS.inc(api, "duplicate")
+                        return None
+                    if attempt >= PUSH_MAX_RETRIES or not _is_retryable(e):
+                        LINE_API_REQUESTS.inc(api, "error")
+                        raise
+                    LINE_API_REQUESTS.inc(api, "retry")
+                    delay = _retry_delay(e, attempt)
+                    reason = e.status if _is_api_exception(e) else type(e).__name__
+                    print(f"LINE 推播失敗 ({reason})，{delay:.1f} 秒後重試 ({attempt + 1}/{PUSH_MAX_RETRIES})")
+                    await asyncio.sleep(delay)
+                    attempt += 1
@@ -0,0 +1,668 @@
+"""
+離線壓力測試：以 uvicorn 啟動整個服務 (main.app)，外部服務全部換成本機的假服務：
+LINE Messaging API (push / multicast / reply)、QuickChart (/chart/create) 與 Google Sheet (gspread 工作表介面)，
+各自可設定延遲與錯誤率。量測 /api/calculate、/api/send_result、/api/send_profile 與 /webhook (附有效簽章)
+的吞吐量、p50/p95/p99 延遲、threadpool 飽和程度與 event loop 延遲，
+用來在部署前比較外部呼叫方式 (requests.post、ApiClient、Sheets 寫入) 調整的效果。
+用法：python loadtest.py --users 32 --duration 20 --line-latency 0.05 --line-error-rate 0.02
+"""
+import argparse
+import asyncio
+import base64
+import contextlib
+import hashlib
+import hmac
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+
+import aiohttp
+import anyio.to_thread
+import uvicorn
+from aiohttp import web
+
+ACCESS_TOKEN = "loadtest-access-token"
+CHANNEL_SECRET = "loadtest-channel-secret"
+SHEET_URL = "https://docs.google.com/spreadsheets/d/loadtest"
+ENDPOINTS = ("calculate", "send_result", "send_profile", "webhook")
+# send_result 代表「試算後按下推送」：先呼叫 /api/calculate 再以 result_id 呼叫 /api/send_result
+DEFAULT_MIX = "calculate=4,send_result=3,send_profile=1.5,webhook=1.5"
+WEBHOOK_TEXTS = ("我的結果", "節稅", "資產傳承", "試算", "你好")
+PROFILE_TYPES = ("積極型", "穩健型", "保守型")
+
+
+class FaultProfile:
+    """假服務的回應特性：latency 秒 (± jitter 比例的隨機抖動)，並以 error_rate 的機率回傳 error_status"""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, error_status: int = 500,
+                 seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self) -> float:
+        with self._lock:
+            return max(0.0, self.latency * (1 + self._rng.uniform(-self.jitter, self.jitter)))
+
+    def should_fail(self) -> bool:
+        with self._lock:
+            return self._rng.random() < self.error_rate
+
+    def describe(self) -> str:
+        return f"{self.latency * 1000:.0f} ms / 錯誤率 {self.error_rate:.0%}"
+
+
+# === 假的外部服務 ===
+
+class FakeLineAPI:
+    """
+    LINE Messaging API 的 push / multicast / reply：檢查 access token 與 request body，
+    已接受過的 X-Line-Retry-Key 再次送達時回傳 409 (與 LINE 相同)，注入的錯誤不會記錄 retry key。
+    """
+
+    def __init__(self, faults: FaultProfile):
+        self.faults = faults
+        self.received = Counter()
+        self.delivered = Counter()
+        self.duplicates = 0
+        self.injected_errors = 0
+        self.invalid = 0
+        self._accepted_keys = set()
+
+    def routes(self) -> list:
+        return [web.post(f"/v2/bot/message/{api}", self.handle) for api in ("push", "multicast", "reply")]
+
+    async def handle(self, request: web.Request) -> web.Response:
+        api = request.path.rsplit("/", 1)[-1]
+        self.received[api] += 1
+        await asyncio.sleep(self.faults.delay())
+
+        try:
+            body = await request.json()
+        except ValueError:
+            body = {}
+        if request.headers.get("Authorization") != f"Bearer {ACCESS_TOKEN}":
+            self.invalid += 1
+            return web.json_response({"message": "Authentication failed"}, status=401)
+        if not body.get("messages") or not (body.get("to") or body.get("replyToken")):
+            self.invalid += 1
+            return web.json_response({"message": "The request body has 1 error(s)"}, status=400)
+
+        retry_key = request.headers.get("X-Line-Retry-Key")
+        if retry_key and retry_key in self._accepted_keys:
+            self.duplicates += 1
+            return web.json_response({"message": "The retry key is already accepted"}, status=409)
+        if self.faults.should_fail():
+            self.injected_errors += 1
+            return web.json_response({"message": "injected error"}, status=self.faults.error_status,
+                                     headers={"Retry-After": "0.1"} if self.faults.error_status == 429 else None)
+        if retry_key:
+            self._accepted_keys.add(retry_key)
+        self.delivered[api] += len(body["to"]) if api == "multicast" else 1
+
+        if api == "multicast":
+            return web.json_response({})
+        return web.json_response({"sentMessages": [
+            {"id": uuid.uuid4().hex, "quoteToken": uuid.uuid4().hex} for _ in body["messages"]
+        ]})
+
+
+class FakeQuickChart:
+    """QuickChart 的 POST /chart/create：回傳以圖表內容雜湊組成的短網址"""
+
+    def __init__(self, faults: FaultProfile):
+        self.faults = faults
+        self.base_url = ""
+        self.received = 0
+        self.injected_errors = 0
+
+    def routes(self) -> list:
+        return [web.post("/chart/create", self.create)]
+
+    async def create(self, request: web.Request) -> web.Response:
+        self.received += 1
+        await asyncio.sleep(self.faults.delay())
+        body = await request.json()
+        if self.faults.should_fail():
+            self.injected_errors += 1
+            return web.json_response({"success": False, "error": "injected error"}, status=self.faults.error_status)
+        key = hashlib.sha1(json.dumps(body.get("chart"), sort_keys=True).encode("utf-8")).hexdigest()[:20]
+        return web.json_response({"success": True, "url": f"{self.base_url}/chart/render/{key}"})
+
+
+class FakeSheetsError(Exception):
+    pass
+
+
+def _column_index(letters: str) -> int:
+    index = 0
+    for char in letters:
+        index = index * 26 + ord(char) - ord("A") + 1
+    return index
+
+
+class FakeWorksheet:
+    """
+    gspread Worksheet 中服務用到的方法 (row_values / col_values / insert_row / append_rows / update)，資料存在記憶體。
+    每次呼叫在呼叫端的執行緒中 sleep (與 gspread 的同步 HTTP 請求一樣佔用該執行緒)。
+    """
+
+    def __init__(self, faults: FaultProfile):
+        self.faults = faults
+        self.rows = []
+        self.calls = Counter()
+        self.rows_appended = 0
+        self.injected_errors = 0
+        self._lock = threading.Lock()
+
+    def _call(self, name: str):
+        time.sleep(self.faults.delay())
+        with self._lock:
+            self.calls[name] += 1
+        if self.faults.should_fail():
+            with self._lock:
+                self.injected_errors += 1
+            raise FakeSheetsError(f"injected error ({name})")
+
+    def row_values(self, row: int) -> list:
+        self._call("row_values")
+        with self._lock:
+            return list(self.rows[row - 1]) if row <= len(self.rows) else []
+
+    def col_values(self, col: int) -> list:
+        self._call("col_values")
+        with self._lock:
+            return [row[col - 1] if len(row) >= col else "" for row in self.rows]
+
+    def insert_row(self, values: list, index: int = 1):
+        self._call("insert_row")
+        with self._lock:
+            self.rows.insert(index - 1, list(values))
+
+    def append_rows(self, values: list, **kwargs) -> dict:
+        self._call("append_rows")
+        with self._lock:
+            first_row = len(self.rows) + 1
+            self.rows.extend(list(row) for row in values)
+            self.rows_appended += len(values)
+            last_row = len(self.rows)
+        return {"updates": {"updatedRange": f"Sheet1!A{first_row}:S{last_row}", "updatedRows": len(values)}}
+
+    def update(self, range_name: str, values: list, **kwargs) -> dict:
+        self._call("update")
+        match = re.match(r"([A-Z]+)(\d+)", range_name)
+        first_col, row_no = _column_index(match.group(1)), int(match.group(2))
+        with self._lock:
+            for offset, row_values in enumerate(values):
+                row = self.rows[row_no - 1 + offset]
+                end = first_col - 1 + len(row_values)
+                row.extend([""] * (end - len(row)))
+                row[first_col - 1:end] = row_values
+        return {"updatedRange": range_name}
+
+
+class _FakeSpreadsheet:
+    def __init__(self, sheet: FakeWorksheet):
+        self.sheet1 = sheet
+
+
+class _FakeSheetsClient:
+    def __init__(self, sheet: FakeWorksheet):
+        self._sheet = sheet
+
+    def open_by_url(self, url: str) -> _FakeSpreadsheet:
+        return _FakeSpreadsheet(self._sheet)
+
+
+def install_fake_sheet(sheet: FakeWorksheet):
+    """讓 sheets_util 的連線建立 (憑證讀取、gspread.authorize) 回傳假工作表，其餘流程 (索引、批次寫入、重試) 不變"""
+    # sheets_util 在建立連線時才 import 這兩個模組，直接替換模組上的屬性
+    import gspread
+    from google.oauth2 import service_account
+
+    class _Credentials:
+        @staticmethod
+        def from_service_account_file(path: str, scopes: list = None):
+            return None
+
+    service_account.Credentials = _Credentials
+    gspread.authorize = lambda credentials: _FakeSheetsClient(sheet)
+
+
+class FakeServices(threading.Thread):
+    """在獨立的 event loop 上執行假的 LINE API 與 QuickChart，不與受測服務搶同一個 loop"""
+
+    def __init__(self, line: FakeLineAPI, quickchart: FakeQuickChart):
+        super().__init__(name="fake-services", daemon=True)
+        self.line = line
+        self.quickchart = quickchart
+        self.base_url = None
+        self._ready = threading.Event()
+        self._loop = None
+        self._stopped = None
+
+    def run(self):
+        self._loop = asyncio.new_event_loop()
+        self._loop.run_until_complete(self._serve())
+
+    async def _serve(self):
+        self._stopped = asyncio.Event()
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.add_routes(self.line.routes() + self.quickchart.routes())
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = runner.addresses[0][:2]
+        self.base_url = f"http://{host}:{port}"
+        self.quickchart.base_url = self.base_url
+        self._ready.set()
+        await self._stopped.wait()
+        await runner.cleanup()
+
+    def start_and_wait(self) -> str:
+        self.start()
+        self._ready.wait()
+        return self.base_url
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._stopped.set)
+        self.join()
+
+
+# === 受測服務 ===
+
+class AppServer(threading.Thread):
+    """
+    在獨立的執行緒與 event loop 上以 uvicorn 執行 app (含 lifespan)，並定期取樣：
+    threadpool (anyio 預設 limiter) 使用中 / 等待中的數量，以及 event loop 的排程延遲 (被同步呼叫卡住的程度)。
+    """
+
+    def __init__(self, app, sample_interval: float = 0.01):
+        super().__init__(name="app-server", daemon=True)
+        self.server = uvicorn.Server(uvicorn.Config(
+            app, host="127.0.0.1", port=0, log_level="warning", access_log=False, lifespan="on"
+        ))
+        self.sample_interval = sample_interval
+        self.recording = threading.Event()
+        self.threadpool_size = 0
+        self.threadpool_samples = []  # (使用中, 等待中)
+        self.loop_lag = []
+
+    def run(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        sampler = asyncio.ensure_future(self._sample())
+        try:
+            await self.server.serve()
+        finally:
+            sampler.cancel()
+
+    async def _sample(self):
+        limiter = anyio.to_thread.current_default_thread_limiter()
+        self.threadpool_size = limiter.total_tokens
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.sample_interval)
+            if self.recording.is_set():
+                statistics = limiter.statistics()
+                self.threadpool_samples.append((statistics.borrowed_tokens, statistics.tasks_waiting))
+                self.loop_lag.append(time.perf_counter() - started - self.sample_interval)
+
+    def start_and_wait(self) -> str:
+        self.start()
+        while not self.server.started:
+            if not self.is_alive():
+                raise RuntimeError("uvicorn 啟動失敗")
+            time.sleep(0.01)
+        port = self.server.servers[0].sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}"
+
+    def stop(self):
+        self.server.should_exit = True
+        self.join()
+
+
+# === 負載產生 ===
+
+def signed_webhook(events: list) -> tuple:
+    body = json.dumps({"destination": "U" + "1" * 32, "events": events}, ensure_ascii=False).encode("utf-8")
+    signature = base64.b64encode(hmac.new(CHANNEL_SECRET.encode("utf-8"), body, hashlib.sha256).digest()).decode()
+    return body, signature
+
+
+def webhook_text_event(user_id: str, text: str) -> dict:
+    event_id = uuid.uuid4().hex
+    return {
+        "type": "message", "mode": "active", "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": user_id},
+        "webhookEventId": event_id, "deliveryContext": {"isRedelivery": False},
+        "replyToken": uuid.uuid4().hex,
+        "message": {"type": "text", "id": event_id, "quoteToken": "q", "text": text}
+    }
+
+
+def random_calculate_request(rng: random.Random, user_id: str) -> dict:
+    current_age = rng.randint(22, 55)
+    return {
+        "user_id": user_id,
+        "user_name": "壓測使用者",
+        "current_age": current_age,
+        "retire_age": rng.randint(max(current_age + 5, 55), 70),
+        "monthly_basic_expense": rng.randrange(20000, 60001, 1000),
+        "monthly_fun_expense": rng.randrange(0, 30001, 1000),
+        "monthly_saving": rng.randrange(5000, 50001, 1000),
+        "current_saving": rng.randrange(0, 5000001, 10000),
+    }
+
+
+def random_profile_request(rng: random.Random, user_id: str) -> dict:
+    weights = [rng.random() for _ in range(6)]
+    total = sum(weights)
+    stock, fund, insurance, demand, time_deposit, crypto = (round(w / total * 100, 1) for w in weights)
+    return {
+        "user_id": user_id, "user_name": "壓測使用者", "profile_type": rng.choice(PROFILE_TYPES),
+        "stock": stock, "fund": fund, "insurance": insurance, "demand": demand,
+        "time_deposit": time_deposit, "crypto": crypto
+    }
+
+
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f"未知的情境: {name} (可用: {', '.join(ENDPOINTS)})")
+        mix[name] = float(weight or 1)
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError("情境權重總和需大於 0")
+    return mix
+
+
+class LoadRecorder:
+    def __init__(self):
+        self.latencies = {endpoint: [] for endpoint in ENDPOINTS}
+        self.statuses = {endpoint: Counter() for endpoint in ENDPOINTS}
+
+    def record(self, endpoint: str, seconds: float, status):
+        self.latencies[endpoint].append(seconds)
+        self.statuses[endpoint][status] += 1
+
+    def errors(self, endpoint: str) -> int:
+        return sum(count for status, count in self.statuses[endpoint].items()
+                   if not isinstance(status, int) or status >= 400)
+
+
+async def timed_post(session: aiohttp.ClientSession, recorder: LoadRecorder, endpoint: str, url: str, **kwargs):
+    started = time.perf_counter()
+    data = None
+    try:
+        async with session.post(url, **kwargs) as resp:
+            status = resp.status
+            data = await resp.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        status = type(e).__name__
+    recorder.record(endpoint, time.perf_counter() - started, status)
+    return status, data
+
+
+async def virtual_user(index: int, session: aiohttp.ClientSession, base_url: str, args, recorder: LoadRecorder,
+                       deadline: float):
+    """封閉式負載：每位虛擬使用者依權重挑選情境，完成後等待 think 秒再進行下一個"""
+    rng = random.Random(args.seed * 100003 + index)
+    user_id = f"U{uuid.UUID(int=rng.getrandbits(128)).hex}"
+    names = list(args.mix)
+    weights = [args.mix[name] for name in names]
+
+    while time.perf_counter() < deadline:
+        scenario = rng.choices(names, weights)[0]
+        if scenario in ("calculate", "send_result"):
+            status, data = await timed_post(session, recorder, "calculate", f"{base_url}/api/calculate",
+                                            json=random_calculate_request(rng, user_id))
+            if scenario == "send_result" and status == 200:
+                result_id = json.loads(data)["result_id"]
+                await timed_post(session, recorder, "send_result", f"{base_url}/api/send_result",
+                                 json={"user_id": user_id, "result_id": result_id})
+        elif scenario == "send_profile":
+            await timed_post(session, recorder, "send_profile", f"{base_url}/api/send_profile",
+                             json=random_profile_request(rng, user_id))
+        else:
+            body, signature = signed_webhook([webhook_text_event(user_id, rng.choice(WEBHOOK_TEXTS))])
+            await timed_post(session, recorder, "webhook", f"{base_url}/webhook", data=body,
+                             headers={"X-Line-Signature": signature, "Content-Type": "application/json"})
+        if args.think:
+            await asyncio.sleep(rng.uniform(0, 2 * args.think))
+
+
+async def generate_load(base_url: str, args) -> tuple:
+    recorder = LoadRecorder()
+    connector = aiohttp.TCPConnector(limit=args.users)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=60)) as session:
+        started = time.perf_counter()
+        deadline = started + args.duration
+        await asyncio.gather(*(virtual_user(i, session, base_url, args, recorder, deadline) for i in range(args.users)))
+        elapsed = time.perf_counter() - started
+    return recorder, elapsed
+
+
+# === 報告 ===
+
+def percentile(values: list, fraction: float) -> float:
+    """nearest-rank 百分位數；values 需已排序"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(fraction * len(values) + 0.5) - 1))]
+
+
+def build_report(args, recorder: LoadRecorder, elapsed: float, server: AppServer, line: FakeLineAPI,
+                 quickchart: FakeQuickChart, sheet: FakeWorksheet) -> dict:
+    from metrics_util import STAGE_SECONDS, BACKGROUND_TASK_SECONDS, BACKGROUND_TASK_FAILURES
+
+    endpoints = {}
+    for endpoint in ENDPOINTS:
+        latencies = sorted(recorder.latencies[endpoint])
+        if not latencies:
+            continue
+        endpoints[endpoint] = {
+            "requests": len(latencies),
+            "errors": recorder.errors(endpoint),
+            "statuses": {str(status): count for status, count in recorder.statuses[endpoint].items()},
+            "rps": len(latencies) / elapsed,
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p95_ms": percentile(latencies, 0.95) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+        }
+
+    samples = server.threadpool_samples or [(0, 0)]
+    busy = [borrowed for borrowed, _ in samples]
+    lag = sorted(server.loop_lag) or [0.0]
+    return {
+        "config": {
+            "users": args.users, "duration": args.duration, "think": args.think, "seed": args.seed, "mix": args.mix,
+            "line": vars_of(line.faults), "quickchart": vars_of(quickchart.faults), "sheets": vars_of(sheet.faults),
+        },
+        "elapsed": elapsed,
+        "total_requests": sum(item["requests"] for item in endpoints.values()),
+        "total_rps": sum(item["requests"] for item in endpoints.values()) / elapsed,
+        "endpoints": endpoints,
+        "threadpool": {
+            "size": server.threadpool_size,
+            "max_busy": max(busy),
+            "mean_busy": sum(busy) / len(busy),
+            "saturated_fraction": sum(1 for b in busy if b >= server.threadpool_size) / len(busy),
+            "max_waiting": max(waiting for _, waiting in samples),
+        },
+        "event_loop_lag_ms": {
+            "p50": percentile(lag, 0.50) * 1000, "p99": percentile(lag, 0.99) * 1000, "max": lag[-1] * 1000
+        },
+        "stages": {
+            labels[0]: {"count": count, "mean_ms": total / count * 1000}
+            for labels, (count, total) in sorted(STAGE_SECONDS.snapshot().items()) if count
+        },
+        "background_tasks": {
+            labels[0]: {"count": count, "mean_ms": total / count * 1000}
+            for labels, (count, total) in sorted(BACKGROUND_TASK_SECONDS.snapshot().items()) if count
+        },
+        "background_failures": {labels[0]: value for labels, value in sorted(BACKGROUND_TASK_FAILURES.values().items())},
+        "fake_line": {
+            "received": dict(line.received), "delivered": dict(line.delivered), "duplicates": line.duplicates,
+            "injected_errors": line.injected_errors, "invalid": line.invalid,
+        },
+        "fake_quickchart": {"received": quickchart.received, "injected_errors": quickchart.injected_errors},
+        "fake_sheets": {
+            "calls": dict(sheet.calls), "rows_appended": sheet.rows_appended, "injected_errors": sheet.injected_errors,
+        },
+    }
+
+
+def vars_of(faults: FaultProfile) -> dict:
+    return {"latency": faults.latency, "jitter": faults.jitter, "error_rate": faults.error_rate,
+            "error_status": faults.error_status}
+
+
+def print_report(report: dict, line: FakeLineAPI, quickchart: FakeQuickChart, sheet: FakeWorksheet):
+    config = report["config"]
+    print(
+        f"壓力測試：{config['users']} 位虛擬使用者 × {report['elapsed']:.1f} 秒 "
+        f"(LINE {line.faults.describe()}，QuickChart {quickchart.faults.describe()}，Sheets {sheet.faults.describe()})"
+    )
+    # 中文字佔兩格寬，標題的欄寬扣掉字數
+    print(f"  {'端點':<14}{'請求數':>5}{'錯誤':>6}{'每秒':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for endpoint, item in report["endpoints"].items():
+        print(
+            f"  {endpoint:<16}{item['requests']:>8}{item['errors']:>8}{item['rps']:>9.1f}"
+            f"{item['p50_ms']:>9.1f}{item['p95_ms']:>9.1f}{item['p99_ms']:>9.1f}"
+        )
+    print(f"  合計 {report['total_requests']} 個請求，{report['total_rps']:.1f} 個/秒")
+
+    pool = report["threadpool"]
+    lag = report["event_loop_lag_ms"]
+    print(
+        f"threadpool (上限 {pool['size']})：最多同時 {pool['max_busy']}，平均 {pool['mean_busy']:.1f}，"
+        f"滿載 {pool['saturated_fraction']:.0%} 的時間，最多 {pool['max_waiting']} 個等待"
+    )
+    print(f"event loop 延遲：p50 {lag['p50']:.1f} ms，p99 {lag['p99']:.1f} ms，最大 {lag['max']:.1f} ms")
+
+    print("各階段平均耗時 (stage_duration_seconds / background_task_duration_seconds)：")
+    for name, item in list(report["stages"].items()) + list(report["background_tasks"].items()):
+        print(f"  {name:<28}{item['count']:>8} 次{item['mean_ms']:>10.1f} ms")
+    if report["background_failures"]:
+        print(f"背景作業失敗：{report['background_failures']}")
+
+    fake_line = report["fake_line"]
+    print(
+        f"假 LINE API：收到 {dict(fake_line['received'])}，409 重複 {fake_line['duplicates']} 次，"
+        f"注入錯誤 {fake_line['injected_errors']} 次，格式錯誤 {fake_line['invalid']} 次"
+    )
+    print(
+        f"假 QuickChart：收到 {report['fake_quickchart']['received']} 次，"
+        f"注入錯誤 {report['fake_quickchart']['injected_errors']} 次"
+    )
+    print(
+        f"假 Google Sheet：{dict(report['fake_sheets']['calls'])}，寫入 {report['fake_sheets']['rows_appended']} 列，"
+        f"注入錯誤 {report['fake_sheets']['injected_errors']} 次"
+    )
+
+
+def configure_environment(workdir: str, fake_url: str, args):
+    """在 import main 之前設定：所有外部服務指向假服務，資料庫與暫存檔放在暫存目錄"""
+    cred_path = os.path.join(workdir, "google_credentials.json")
+    with open(cred_path, "w", encoding="utf-8") as f:
+        json.dump({"type": "service_account"}, f)
+    os.environ.update({
+        "LINE_CHANNEL_ACCESS_TOKEN": ACCESS_TOKEN,
+        "LINE_CHANNEL_SECRET": CHANNEL_SECRET,
+        "LINE_API_HOST": fake_url,
+        "QUICKCHART_BASE_URL": fake_url,
+        "CHART_RENDERER": "quickchart",
+        "PUBLIC_BASE_URL": "",
+        "GOOGLE_APPLICATION_CREDENTIALS": cred_path,
+        "GOOGLE_SHEET_URL": SHEET_URL,
+        "STORAGE_PATH": os.path.join(workdir, "loadtest.db"),
+        "SHEETS_SPILL_PATH": os.path.join(workdir, "sheets_spill.jsonl"),
+        "SHEETS_FLUSH_SECONDS": str(args.sheets_flush_seconds),
+        "CHART_CACHE_PATH": "",
+        "RESULT_STORE_PATH": "",
+        "WEBHOOK_DEDUPE_PATH": "",
+        "LIFF_URL": "https://liff.line.me/loadtest",
+        "PROFILE_IMAGE_URLS": json.dumps({name: f"{fake_url}/profile/{i}.png" for i, name in enumerate(PROFILE_TYPES)},
+                                         ensure_ascii=False),
+    })
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="以本機假服務對整個服務進行壓力測試")
+    parser.add_argument("--users", type=int, default=16, help="同時進行的虛擬使用者數")
+    parser.add_argument("--duration", type=float, default=10.0, help="產生負載的秒數")
+    parser.add_argument("--think", type=float, default=0.0, help="每位使用者兩次操作之間的平均間隔 (秒)")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f"情境權重，預設 {DEFAULT_MIX}")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--jitter", type=float, default=0.2, help="假服務延遲的隨機抖動比例")
+    for name, latency in (("line", 0.05), ("quickchart", 0.2), ("sheets", 0.3)):
+        parser.add_argument(f"--{name}-latency", type=float, default=latency, help="假服務每次回應的延遲 (秒)")
+        parser.add_argument(f"--{name}-error-rate", type=float, default=0.0, help="假服務回傳錯誤的機率")
+    parser.add_argument("--line-error-status", type=int, default=500, help="假 LINE API 注入錯誤時的狀態碼 (429 / 5xx)")
+    parser.add_argument("--sheets-flush-seconds", type=float, default=1.0, help="Sheets 批次寫入的間隔 (SHEETS_FLUSH_SECONDS)")
+    parser.add_argument("--log", default=os.devnull, help="受測服務的輸出 (print) 寫到這個檔案")
+    parser.add_argument("--json", help="將結果另存成 JSON 檔")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> dict:
+    args = parse_args(argv)
+    line = FakeLineAPI(FaultProfile(args.line_latency, args.jitter, args.line_error_rate, args.line_error_status,
+                                    seed=args.seed))
+    quickchart = FakeQuickChart(FaultProfile(args.quickchart_latency, args.jitter, args.quickchart_error_rate,
+                                             seed=args.seed + 1))
+    sheet = FakeWorksheet(FaultProfile(args.sheets_latency, args.jitter, args.sheets_error_rate, seed=args.seed + 2))
+    services = FakeServices(line, quickchart)
+    fake_url = services.start_and_wait()
+
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    if repo_dir not in sys.path:
+        sys.path.insert(0, repo_dir)
+    original_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir, open(args.log, "a", encoding="utf-8") as log:
+        configure_environment(workdir, fake_url, args)
+        # main 會在目前目錄建立 static/，在暫存目錄中執行以免留下檔案
+        os.chdir(workdir)
+        try:
+            with contextlib.redirect_stdout(log):
+                install_fake_sheet(sheet)
+                import main as app_main
+
+                server = AppServer(app_main.app)
+                base_url = server.start_and_wait()
+                server.recording.set()
+                recorder, elapsed = asyncio.run(generate_load(base_url, args))
+                server.recording.clear()
+                # 關閉時會寫完 Sheets 緩衝並送完佇列中的 webhook 事件
+                server.stop()
+                app_main.chart_prerenderer.close(wait=True)
+                services.stop()
+        finally:
+            os.chdir(original_dir)
+
+    report = build_report(args, recorder, elapsed, server, line, quickchart, sheet)
+    print_report(report, line, quickchart, sheet)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"結果已存到 {args.json}")
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,226 @@
 import os
-from fastapi import FastAPI, Request, HTTPException, BackgroundTasks
+import json
+import math
+import random
+import threading
+import time
+import importlib
+import secrets
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, HTTPException, BackgroundTasks, Depends, Header
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from calculator import calculate_retirement_plan
-from chart_util import generate_quickchart_url
+from pydantic import BaseModel, Field, field_validator, model_validator
+from typing import List, Optional, Union
+import numpy as np
+from calculator import PlanResultCache, calculate_retirement_plans, calculate_sensitivity_grid, solve_min_monthly_saving, simulate_retirement_plan
+from chart_util import generate_quickchart_url, generate_local_chart_url, has_cjk_font, ChartCache, ChartFileJanitor, ChartPrerenderer
+from flex_util import build_result_message, build_summary_message, build_info_message, build_text_message, compile_templates, ProfileMessageCache
 import sheets_util
-
-# === LINE Bot SDK 相關 ===
-from linebot.v3 import WebhookParser
-from linebot.v3.messaging import (
-    Configuration,
-    ApiClient,
-    MessagingApi,
-    PushMessageRequest,
-    FlexMessage,
-    FlexContainer
-)
-from linebot.v3.exceptions import InvalidSignatureError
-from linebot.v3.webhooks import MessageEvent, TextMessageContent
+from storage_util import PlanStore, SheetsReplicator, ResultStore, STORAGE_PATH
+from line_util import LinePushClient, LazyMessages, prepare_messages
+from command_util import CommandRouter
+from payload_util import FastJSONResponse, encode_history, decode_history
+from metrics_util import MetricsMiddleware, GaugeCallback, STAGE_SECONDS, render_metrics
+from webhook_util import WebhookDispatcher, EventDedupeCache, InvalidSignatureError
+from bulk_util import BulkSendStore, BulkSender
+from starlette.concurrency import run_in_threadpool
 from dotenv import load_dotenv
 from fastapi.staticfiles import StaticFiles
-import os
+from fastapi.responses import PlainTextResponse
 
 load_dotenv()
 
 LINE_CHANNEL_ACCESS_TOKEN = os.getenv('LINE_CHANNEL_ACCESS_TOKEN', '')
 LINE_CHANNEL_SECRET = os.getenv('LINE_CHANNEL_SECRET', '')
 
-# 如果有設定 LINE Credential，就初始化 API Client
-line_config = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
-line_parser = WebhookParser(LINE_CHANNEL_SECRET)
+# 圖表繪製方式："local" 在本機以 Pillow 繪製並由 /static 提供 (需設定對外網址)，"quickchart" 使用 QuickChart API
+PUBLIC_BASE_URL = os.getenv('PUBLIC_BASE_URL', '').rstrip('/')
+CHART_RENDERER = os.getenv('CHART_RENDERER', 'local' if PUBLIC_BASE_URL else 'quickchart')
+if CHART_RENDERER == "local" and not PUBLIC_BASE_URL:
+    # 沒有對外網址時只能產生相對路徑，LINE 無法下載圖片，改用 QuickChart
+    print("警告: 未設定 PUBLIC_BASE_URL，圖表改用 QuickChart 繪製；本機繪製需設定服務的對外網址。")
+    CHART_RENDERER = "quickchart"
+if CHART_RENDERER == "local" and not has_cjk_font():
+    # Pillow 內建字型無法顯示中文，改用 QuickChart 以免圖表標題與圖例變成方框
+    print("警告: 找不到中文字型，圖表改用 QuickChart 繪製；請安裝 fonts-noto-cjk 或設定 CHART_FONT_PATH。")
+    CHART_RENDERER = "quickchart"
+# 以程式所在目錄為準，不受啟動時的工作目錄影響
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+CHART_DIR = os.path.join(STATIC_DIR, "charts")
+os.makedirs(CHART_DIR, exist_ok=True)
+# 本機繪製的圖表與網址快取同樣在 3 天後到期，過期的 PNG 由背景執行緒刪除
+chart_file_janitor = ChartFileJanitor(CHART_DIR)
 
-app = FastAPI(title="財富規劃 Line OA API")
+# 圖表網址快取：相同內容的圖表不再重新繪製或呼叫 QuickChart；設定 CHART_CACHE_PATH 可在重啟後沿用
+chart_cache = ChartCache(
+    max_entries=int(os.getenv('CHART_CACHE_SIZE', '1024')),
+    disk_path=os.getenv('CHART_CACHE_PATH') or None
+)
+
+# 試算完成後在背景預先繪製圖表，/api/send_result 直接取用 (或等待進行中的繪製)；CHART_PRERENDER_WORKERS=0 可關閉
+CHART_PRERENDER_WORKERS = int(os.getenv('CHART_PRERENDER_WORKERS', '2'))
+chart_prerenderer = ChartPrerenderer(
+    lambda history, crossover_age: render_result_chart(history, crossover_age),
+    renderer="local" if CHART_RENDERER == "local" else "quickchart",
+    workers=max(CHART_PRERENDER_WORKERS, 1),
+    cache=chart_cache
+)
+
+# 試算紀錄以本機 SQLite 為主要儲存 (寫入不經過網路)，Google Sheets 由背景執行緒同步
+plan_store = PlanStore(STORAGE_PATH)
+sheets_replicator = SheetsReplicator(plan_store)
+
+# /api/calculate 的試算結果快取 (以數值輸入為 key，不含使用者資料)；
+# PLAN_CACHE_WARMUP > 0 時，啟動後在背景預先計算資料庫中最常見的幾組輸入
+plan_cache = PlanResultCache(max_entries=int(os.getenv('PLAN_CACHE_SIZE', '4096')))
+PLAN_CACHE_WARMUP = int(os.getenv('PLAN_CACHE_WARMUP', '0'))
+
+def warm_up_plan_cache(limit: int):
+    try:
+        computed = plan_cache.warm_up(plan_store.common_inputs(limit))
+        print(f"試算結果快取：預先計算 {computed} 組常見輸入")
+    except Exception as e:
+        print(f"試算結果快取預先計算失敗: {e}")
+
+# /api/calculate 的結果暫存在伺服器端 (LRU + TTL)，/api/send_result 只需帶回 result_id；
+# 設定 RESULT_STORE_PATH 時，被擠出記憶體與關閉時尚未過期的結果寫到 SQLite，重啟後仍可使用
+result_store = ResultStore(disk_path=os.getenv('RESULT_STORE_PATH') or None)
+
+# webhook 只驗證簽章並放入佇列，由背景 worker 解析、分派事件；
+# LINE 逾時重送的事件以 webhookEventId 去重，設定 WEBHOOK_DEDUPE_PATH 可在重啟後沿用
+webhook_dispatcher = WebhookDispatcher(
+    LINE_CHANNEL_SECRET,
+    workers=int(os.getenv('WEBHOOK_WORKERS', '4')),
+    max_queue=int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000')),
+    dedupe=EventDedupeCache(disk_path=os.getenv('WEBHOOK_DEDUPE_PATH') or None)
+)
+
+# 全服務共用一個非同步推播客戶端 (連線池 keep-alive)，LINE_PUSH_CONCURRENCY 為同時推播的上限；
+# LINE SDK 在第一次推播 (或預熱) 時才載入。LINE_API_HOST 可指向壓力測試 (loadtest.py) 的本機假服務
+line_push_client = LinePushClient(
+    LINE_CHANNEL_ACCESS_TOKEN,
+    host=os.getenv('LINE_API_HOST') or None,
+    max_concurrency=int(os.getenv('LINE_PUSH_CONCURRENCY', '32'))
+)
+
+# 批次推送：相同內容的訊息只建立一次並以 multicast 送出，進度記錄在本機資料庫，中斷後可繼續
+def build_result_messages(payload: dict) -> bytes:
+    chart_url = render_result_chart(payload["history"], payload["result"].get("crossover_age"))
+    return prepare_messages([build_result_message(payload["result"], chart_url, payload["max_age"], payload["interest_rate"])])
+
+bulk_sender = BulkSender(
+    BulkSendStore(STORAGE_PATH),
+    line_push_client,
+    build_result_messages,
+    max_concurrency=int(os.getenv('BULK_SEND_CONCURRENCY', '4'))
+)
+
+# 理財人格的預設圖片，例如 {"積極型": "https://...", "穩健型": "https://...", "保守型": "https://..."}；
+# 預熱時預先建好這幾張卡片，前端傳來其他圖片網址時以 LRU 快取
+PROFILE_IMAGE_URLS = json.loads(os.getenv('PROFILE_IMAGE_URLS') or '{}')
+profile_message_cache = ProfileMessageCache(max_entries=int(os.getenv('PROFILE_CACHE_SIZE', '256')))
+
+# 文字指令回覆：固定內容的回覆在第一次使用 (或預熱) 時序列化一次，以 reply token 回覆 (不計入推播額度)
+LIFF_URL = os.getenv('LIFF_URL', '')
+BOOKING_URL = os.getenv('BOOKING_URL', 'https://app.simplymeet.me/wealthblueprint')
+NO_PLAN_REPLY = LazyMessages(lambda: [build_text_message("目前還沒有您的試算紀錄，輸入「試算」開始第一次試算吧！")])
+
+async def reply_latest_plan(event) -> bytes:
+    """「我的結果」：直接讀取本機資料庫中該使用者最新一筆紀錄，不重新試算也不讀取 Google Sheets"""
+    user_id = getattr(event.source, "user_id", None)
+    plan = await run_in_threadpool(plan_store.latest_plan, user_id) if user_id else None
+    if plan is None:
+        return await run_warm(NO_PLAN_REPLY.get)
+    return await run_warm(lambda: prepare_messages([build_summary_message(plan)]))
+
+command_router = CommandRouter()
+command_router.add("財稅優化策略", LazyMessages(lambda: [build_info_message(
+    "財稅優化策略",
+    "善用保險、信託與合法的節稅工具，降低所得稅、遺產稅與贈與稅的負擔，讓每一分資產都發揮最大效益。歡迎預約顧問，為您量身規劃。",
+    "預約一對一諮詢",
+    BOOKING_URL
+)]), aliases=("財稅優化", "節稅"))
+command_router.add("資產傳承規劃", LazyMessages(lambda: [build_info_message(
+    "資產傳承規劃",
+    "提早規劃資產傳承，透過保險、信託與遺囑安排，確保資產依您的心意順利交棒，同時兼顧稅負與家人的保障。",
+    "預約一對一諮詢",
+    BOOKING_URL
+)]), aliases=("資產傳承", "傳承規劃"))
+if LIFF_URL:
+    command_router.add("試算", LazyMessages(lambda: [build_info_message(
+        "退休資金缺口試算",
+        "只要 1 分鐘，輸入目前年齡、每月支出與存款，立即算出您的退休資金缺口。",
+        "開始試算",
+        LIFF_URL
+    )]), aliases=("退休試算", "資金缺口試算"))
+command_router.add("我的結果", reply_latest_plan, aliases=("試算結果", "查詢結果"))
+
+# 冷啟動：LINE SDK 等重量級模組不在 import 時載入，服務可以立即開始回應；
+# WARMUP_ON_STARTUP=1 (預設) 時啟動後在背景載入並建好 Flex 範本與固定回覆，設為 0 則延到第一次使用或呼叫 /api/warmup
+WARMUP_ON_STARTUP = os.getenv('WARMUP_ON_STARTUP', '1') == '1'
+WARMUP_MODULES = ("linebot.v3.messaging", "linebot.v3.webhooks") + (("requests",) if CHART_RENDERER != "local" else ())
+
+warmed_up = threading.Event()
+
+async def run_warm(func, *args):
+    """
+    建立 Flex 訊息等需要 LINE SDK 的操作：預熱完成後直接執行；
+    完成前第一次執行可能要載入 SDK (或等背景預熱載入完)，改在 threadpool 中執行，不阻塞 event loop
+    """
+    if warmed_up.is_set():
+        return func(*args)
+    return await run_in_threadpool(func, *args)
+
+def warm_up() -> dict:
+    """載入延後的模組並建好 Flex 範本、理財人格卡片與固定回覆，回傳各步驟的秒數；已完成的步驟幾乎不花時間"""
+    seconds = {}
+    for name in WARMUP_MODULES:
+        started = time.perf_counter()
+        importlib.import_module(name)
+        seconds[name] = time.perf_counter() - started
+    started = time.perf_counter()
+    compile_templates()
+    profile_message_cache.preload(PROFILE_IMAGE_URLS)
+    for reply in (NO_PLAN_REPLY,) + command_router.targets():
+        if isinstance(reply, LazyMessages):
+            reply.get()
+    seconds["flex_messages"] = time.perf_counter() - started
+    warmed_up.set()
+    return seconds
+
+def warm_up_in_background():
+    try:
+        seconds = warm_up()
+        print(f"預熱完成：{sum(seconds.values()):.2f} 秒")
+    except Exception as e:
+        print(f"預熱失敗，將於第一次使用時載入: {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await webhook_dispatcher.start()
+    sheets_util.init_sheet()
+    sheets_util.sheet_writer.start()
+    sheets_replicator.start()
+    if CHART_RENDERER == "local":
+        chart_file_janitor.start()
+    bulk_sender.resume_unfinished()
+    if PLAN_CACHE_WARMUP > 0:
+        threading.Thread(target=warm_up_plan_cache, args=(PLAN_CACHE_WARMUP,), name="plan-cache-warmup", daemon=True).start()
+    if WARMUP_ON_STARTUP:
+        threading.Thread(target=warm_up_in_background, name="warmup", daemon=True).start()
+    yield
+    await bulk_sender.close()
+    await webhook_dispatcher.stop()
+    await line_push_client.close()
+    # 關閉前把尚未同步的紀錄交給 Google Sheets 緩衝，並寫出緩衝中的資料
+    await run_in_threadpool(sheets_replicator.close)
+    await run_in_threadpool(sheets_util.sheet_writer.close)
+    await run_in_threadpool(result_store.close)
+    chart_prerenderer.close()
+    chart_file_janitor.close()
+
+app = FastAPI(title="財富規劃 Line OA API", lifespan=lifespan, default_response_class=FastJSONResponse)
+app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 
 app.add_middleware(
     CORSMiddleware,
@@ -40,6 +229,16 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# 最外層：記錄每個請求 (含 CORS 處理) 的總時間
+app.add_middleware(MetricsMiddleware)
+
+# 匯出時才讀取的目前狀態 (佇列深度、暫存筆數等)
+GaugeCallback("webhook_queue_depth", "webhook 佇列中待處理的請求數", lambda: webhook_dispatcher.stats()["queue_depth"])
+GaugeCallback("sheets_pending_rows", "等待批次寫入 Google Sheet 的列數", sheets_util.sheet_writer.pending)
+GaugeCallback("chart_cache_entries", "記憶體中的圖表網址快取筆數", lambda: chart_cache.stats()["entries"])
+GaugeCallback("chart_prerender_pending", "預先繪製中 (含排隊) 的圖表數", lambda: chart_prerenderer.stats()["pending"])
+GaugeCallback("plan_cache_entries", "記憶體中快取的試算結果筆數", lambda: plan_cache.stats()["entries"])
+GaugeCallback("result_store_entries", "記憶體中暫存的試算結果筆數", lambda: result_store.stats()["entries"])
 
 class CalculateRequest(BaseModel):
     current_age: int
@@ -56,11 +255,115 @@ class CalculateRequest(BaseModel):
     user_id: str = None
     user_name: str = None
 
+# 單次批次試算的情境數上限
+MAX_BATCH_SCENARIOS = 10000
+# 批次、敏感度與模擬以 (情境數 x 年數) 矩陣計算，年齡限制在 0 ~ MAX_PLAN_AGE 歲，年數 (記憶體用量) 才有上限
+MAX_PLAN_AGE = 120
+
+def check_plan_ages(ages):
+    """request model 的 validator 共用：年齡 (或年齡陣列) 需介於 0 與 MAX_PLAN_AGE 之間，否則回應 422"""
+    for age in ages if isinstance(ages, list) else [ages]:
+        if not 0 <= age <= MAX_PLAN_AGE:
+            raise ValueError(f"ages must be between 0 and {MAX_PLAN_AGE}")
+    return ages
+
+class CalculateBatchRequest(BaseModel):
+    """
+    批次試算：每個欄位可以是陣列 (每個情境一個值) 或純量 (套用到所有情境)。
+    例如「60/62/65 歲退休」只需要 retire_age 傳陣列，其餘欄位傳純量。
+    """
+    current_age: Union[List[int], int]
+    retire_age: Union[List[int], int]
+    monthly_basic_expense: Union[List[float], float]
+    monthly_fun_expense: Union[List[float], float] = 0.0
+    monthly_saving: Union[List[float], float]
+    current_saving: Union[List[float], float]
+    max_age: Union[List[int], int] = 100
+    interest_rate: Union[List[float], float] = 0.015
+    # 是否回傳每個情境的歷年軌跡 (畫圖用)，預設只回傳總額與交叉點
+    include_history: bool = False
+
+    @field_validator("current_age", "max_age")
+    @classmethod
+    def check_ages(cls, value):
+        return check_plan_ages(value)
+
+# 敏感度分析的格點數上限
+MAX_GRID_CELLS = 20000
+
+class ValueRange(BaseModel):
+    """數值範圍 (含頭尾)，例如 {"start": 60, "stop": 65, "step": 1}；範圍不合法或超過 MAX_GRID_CELLS 個值時回應 422"""
+    start: float
+    stop: float
+    step: float = 1.0
+
+    @model_validator(mode="after")
+    def check_range(self):
+        if not all(math.isfinite(value) for value in (self.start, self.stop, self.step)):
+            raise ValueError("range bounds and step must be finite")
+        if self.step <= 0 or self.stop < self.start:
+            raise ValueError("step must be positive and stop must not be less than start")
+        # 先以浮點數判斷個數，極小的 step 不會在 int() 時溢位
+        if (self.stop - self.start) / self.step >= MAX_GRID_CELLS:
+            raise ValueError(f"range too large (max {MAX_GRID_CELLS} values)")
+        return self
+
+    def values(self) -> list:
+        count = int((self.stop - self.start) / self.step + 1e-9) + 1
+        return np.round(self.start + self.step * np.arange(count), 10).tolist()
+
+class SensitivityRequest(CalculateRequest):
+    """
+    以一筆試算資料為基準，對 退休年齡 / 每月存款 / 利率 的範圍做敏感度分析；未指定範圍的欄位沿用基準值。
+    mode="grid"：回傳所有組合的資金缺口與交叉點
+    mode="solve"：對每個 退休年齡 x 利率 組合，求出讓資金缺口為 0 的最低每月存款
+    """
+    retire_age_range: Optional[ValueRange] = None
+    monthly_saving_range: Optional[ValueRange] = None
+    interest_rate_range: Optional[ValueRange] = None
+    mode: str = "grid"
+
+    @field_validator("current_age", "max_age")
+    @classmethod
+    def check_ages(cls, value):
+        return check_plan_ages(value)
+
+    @field_validator("retire_age_range")
+    @classmethod
+    def check_retire_age_range(cls, value):
+        # 年齡範圍只接受整數的頭尾與間隔，小數間隔會產生重複的年齡
+        if value is not None:
+            if not all(float(bound).is_integer() for bound in (value.start, value.stop, value.step)):
+                raise ValueError("retire_age_range start, stop and step must be integers")
+            check_plan_ages([value.start, value.stop])
+        return value
+
+# 蒙地卡羅模擬的路徑數上限；超過 SIMULATION_CHUNK_PATHS 時分段模擬，記憶體用量固定
+MAX_SIMULATION_PATHS = 200000
+SIMULATION_CHUNK_PATHS = 20000
+
+class SimulateRequest(CalculateRequest):
+    """
+    蒙地卡羅模擬：每年存款利率與通膨率隨機抽樣 (常態分佈)。
+    未提供 seed 時由伺服器產生並隨結果回傳，之後帶同一個 seed 即可重現結果。
+    """
+    paths: int = 10000
+    seed: Optional[int] = None
+    # 標準差不可為負數或無限大，否則抽樣時會失敗
+    return_volatility: float = Field(0.02, ge=0, allow_inf_nan=False)
+    inflation_volatility: float = Field(0.01, ge=0, allow_inf_nan=False)
+
+    @field_validator("current_age", "max_age")
+    @classmethod
+    def check_ages(cls, value):
+        return check_plan_ages(value)
+
 class ProfileRequest(BaseModel):
     user_id: str
     user_name: str = None
     profile_type: str
-    image_url: str
+    # 未提供時使用 PROFILE_IMAGE_URLS 中該理財人格的預設圖片
+    image_url: str = None
     # 資產分配比例
     stock: float = 0.0
     fund: float = 0.0
@@ -70,201 +373,243 @@ class ProfileRequest(BaseModel):
     crypto: float = 0.0
 
 class SendResultRequest(BaseModel):
+    """
+    只帶 result_id (/api/calculate 回傳)，由伺服器取出當時的試算結果；只能推送 user_id 自己試算的結果。
+    ALLOW_LEGACY_RESULT_UPLOAD=1 時舊版前端仍可上傳完整的 result 與 history (此時 max_age / interest_rate 以請求為準)。
+    """
     user_id: str
-    result: dict
-    history: dict
+    result_id: Optional[str] = None
+    result: Optional[dict] = None
+    history: Optional[dict] = None
     max_age: int = 100
     interest_rate: float = 0.015
 
-def create_flex_message(result: dict, chart_url: str, max_age: int = 100, interest_rate: float = 0.015) -> dict:
-    """建立 LINE Flex Message JSON 結構"""
-    def format_money(val):
-        return f"NT$ {val:,}"
-        
-    gap = result["gap"]
-    gap_color = "#10b981" if gap <= 0 else "#ef4444"
-    gap_text = "恭喜！已達成目標" if gap <= 0 else format_money(gap)
-    
-    # 交叉點提示文字
-    crossover_age = result.get("crossover_age")
-    if crossover_age:
-        chart_hint = f"當綠色線（存款）與橘色線（需求）交叉時，代表存款即將用盡。依您目前的規劃，約在 {crossover_age} 歲時存款將不足以支應退休開銷。點擊圖片可放大查看！"
-    else:
-        chart_hint = f"恭喜！依您目前的規劃，存款預估可支撐退休生活至 {max_age} 歲。點擊圖片可放大查看！"
-    
-    flex_json = {
-        "type": "bubble",
-        "header": {
-            "type": "box",
-            "layout": "vertical",
-            "contents": [
-                {
-                    "type": "text",
-                    "text": "退休金試算結果",
-                    "weight": "bold",
-                    "size": "xl",
-                    "color": "#d97706"
-                }
-            ],
-            "backgroundColor": "#fdfbf7"
-        },
-        "hero": {
-            "type": "image",
-            "url": chart_url,
-            "size": "full",
-            "aspectRatio": "8:5",
-            "aspectMode": "fit",
-            "action": {
-                "type": "uri",
-                "label": "查看完整圖表",
-                "uri": chart_url
-            }
-        },
-        "body": {
-            "type": "box",
-            "layout": "vertical",
-            "contents": [
-                {
-                    "type": "text",
-                    "text": "📌 圖表怎麼看？",
-                    "weight": "bold",
-                    "size": "sm",
-                    "color": "#d97706",
-                    "margin": "none"
-                },
-                {
-                    "type": "text",
-                    "text": chart_hint,
-                    "wrap": True,
-                    "size": "xs",
-                    "color": "#8c7e6c",
-                    "margin": "sm"
-                },
-                {"type": "separator", "margin": "lg", "color": "#d1c7bc"},
-                {
-                    "type": "box",
-                    "layout": "horizontal",
-                    "contents": [
-                        {"type": "text", "text": "退休總需求 (含娛樂)", "color": "#8c7e6c", "size": "sm", "flex": 5},
-                        {"type": "text", "text": format_money(result["total_need_with_fun"]), "align": "end", "weight": "bold", "color": "#4a4036", "flex": 5}
-                    ],
-                    "margin": "lg"
-                },
-                {
-                    "type": "box",
-                    "layout": "horizontal",
-                    "contents": [
-                        {"type": "text", "text": "退休總需求 (僅生活)", "color": "#8c7e6c", "size": "sm", "flex": 5},
-                        {"type": "text", "text": format_money(result["total_need_basic"]), "align": "end", "weight": "bold", "color": "#4a4036", "flex": 5}
-                    ],
-                    "margin": "md"
-                },
-                {
-                    "type": "box",
-                    "layout": "horizontal",
-                    "contents": [
-                        {"type": "text", "text": "預估實際存款累積", "color": "#8c7e6c", "size": "sm", "flex": 5},
-                        {"type": "text", "text": format_money(result["total_fund"]), "align": "end", "weight": "bold", "color": "#4a4036", "flex": 5}
-                    ],
-                    "margin": "md"
-                },
-                {"type": "separator", "margin": "lg", "color": "#d1c7bc"},
-                {
-                    "type": "box",
-                    "layout": "horizontal",
-                    "contents": [
-                        {"type": "text", "text": "資金缺口 (以含娛樂為準)", "color": "#8c7e6c", "size": "md", "weight": "bold", "flex": 5},
-                        {"type": "text", "text": gap_text, "align": "end", "weight": "bold", "color": gap_color, "flex": 5}
-                    ],
-                    "margin": "lg"
-                },
-                {"type": "separator", "margin": "lg", "color": "#d1c7bc"},
-                {
-                    "type": "text",
-                    "text": f"⚙️ 假設條件：通膨率 3% ／存款利率 {interest_rate*100:.1f}% ／預計壽命 {max_age} 歲",
-                    "wrap": True,
-                    "size": "xxs",
-                    "color": "#b0a090",
-                    "margin": "lg"
-                }
-            ],
-            "backgroundColor": "#ffffff"
+# 單次批次推送的收件人上限 (multicast 每次 500 位，即最多 4 次)
+MAX_BULK_RECIPIENTS = 2000
+
+class BulkSendResultRequest(BaseModel):
+    """批次推送試算結果，例如顧問更新圖表後重新發送給同一批客戶；內容相同的收件人會合併成一則 multicast"""
+    recipients: List[SendResultRequest] = Field(max_length=MAX_BULK_RECIPIENTS)
+
+# 批次推送等管理用 API 需帶 Authorization: Bearer <ADMIN_API_TOKEN>；未設定時停用這些 API
+ADMIN_API_TOKEN = os.getenv('ADMIN_API_TOKEN', '')
+# 舊版前端直接上傳 result/history 的推送方式 (內容未經伺服器驗證)，預設關閉
+ALLOW_LEGACY_RESULT_UPLOAD = os.getenv('ALLOW_LEGACY_RESULT_UPLOAD', '0') == '1'
+
+def require_admin(authorization: Optional[str] = Header(None)):
+    if not ADMIN_API_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin API is disabled (ADMIN_API_TOKEN is not set)")
+    if not secrets.compare_digest((authorization or "").encode("utf-8"), f"Bearer {ADMIN_API_TOKEN}".encode("utf-8")):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+def resolve_send_result(req: SendResultRequest) -> dict:
+    """取得要推送的試算內容：{"result", "history", "max_age", "interest_rate"}"""
+    if req.result_id:
+        stored = result_store.get(req.result_id)
+        if stored is None:
+            raise HTTPException(status_code=404, detail="Result expired or not found, please recalculate")
+        # 未帶 user_id 試算的結果不屬於任何人，同樣不能推送
+        if stored["user_id"] != req.user_id:
+            raise HTTPException(status_code=403, detail="Result belongs to another user")
+        result = stored["result"]
+        return {
+            "result": {key: value for key, value in result.items() if key != "history"},
+            "history": result["history"],
+            "max_age": stored["max_age"],
+            "interest_rate": stored["interest_rate"]
         }
-    }
-    return flex_json
+
+    if not ALLOW_LEGACY_RESULT_UPLOAD:
+        raise HTTPException(status_code=400, detail="result_id is required")
+    if req.result is None or req.history is None:
+        raise HTTPException(status_code=400, detail="result_id or result/history is required")
+    try:
+        history = decode_history(req.history)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"result": req.result, "history": history, "max_age": req.max_age, "interest_rate": req.interest_rate}
+
+def render_result_chart(history: dict, crossover_age: int = None) -> str:
+    """產生圖表圖片網址（包含交叉點標註）；繪圖與 QuickChart 呼叫為同步作業，需在 threadpool 中執行"""
+    if CHART_RENDERER == "local":
+        return generate_local_chart_url(history, crossover_age, CHART_DIR, f"{PUBLIC_BASE_URL}/static/charts", cache=chart_cache)
+    return generate_quickchart_url(history, crossover_age, cache=chart_cache)
 
 @app.post("/api/calculate")
-def calculate_api(req: CalculateRequest, background_tasks: BackgroundTasks):
-    # 計算資金缺口
-    result = calculate_retirement_plan(
-        current_age=req.current_age,
-        retire_age=req.retire_age,
-        monthly_basic_expense=req.monthly_basic_expense,
-        monthly_fun_expense=req.monthly_fun_expense,
-        monthly_saving=req.monthly_saving,
-        current_saving=req.current_saving,
-        max_age=req.max_age,
-        interest_rate=req.interest_rate
-    )
-    
-    # 偵錯用：確認收到的基本與娛樂支出
-    print(f"DEBUG: basic={req.monthly_basic_expense}, fun={req.monthly_fun_expense}")
+def calculate_api(req: CalculateRequest, fields: Optional[str] = None, history_format: Optional[str] = None):
+    """
+    fields=summary：不回傳歷年軌跡 (history)
+    history_format=compact：歷年軌跡以 delta-varint 精簡格式回傳 (見 payload_util.encode_history)，
+    /api/send_result 可直接帶回這個格式
+    """
+    if fields not in (None, "summary"):
+        raise HTTPException(status_code=400, detail="fields must be 'summary'")
+    if history_format not in (None, "list", "compact"):
+        raise HTTPException(status_code=400, detail="history_format must be 'list' or 'compact'")
+
+    # 計算資金缺口 (相同的數值輸入直接取用快取的結果，回傳的是淺層複本)
+    with STAGE_SECONDS.time("calculate.compute"):
+        result = plan_cache.calculate(
+            current_age=req.current_age,
+            retire_age=req.retire_age,
+            monthly_basic_expense=req.monthly_basic_expense,
+            monthly_fun_expense=req.monthly_fun_expense,
+            monthly_saving=req.monthly_saving,
+            current_saving=req.current_saving,
+            max_age=req.max_age,
+            interest_rate=req.interest_rate
+        )
     
-    # 使用 BackgroundTasks 異步寫入 Google Sheets，避免卡住使用者的回應時間
+    # 寫入本機 SQLite (不經過網路)，Google Sheets 由背景同步，不會卡住使用者的回應時間
     request_data = {
         "current_age": req.current_age,
         "retire_age": req.retire_age,
         "monthly_basic_expense": req.monthly_basic_expense,
         "monthly_fun_expense": req.monthly_fun_expense,
-        "current_saving": req.current_saving
+        "monthly_saving": req.monthly_saving,
+        "current_saving": req.current_saving,
+        "max_age": req.max_age,
+        "interest_rate": req.interest_rate
     }
-    background_tasks.add_task(
-        sheets_util.append_to_sheet, 
-        req.user_id, 
-        req.user_name, 
-        request_data, 
-        result
-    )
+    # 存檔失敗 (例如磁碟已滿) 只記錄錯誤，不影響試算結果的回應
+    try:
+        with STAGE_SECONDS.time("calculate.save_plan"):
+            plan_store.save_plan(req.user_id, req.user_name, request_data, result)
+    except Exception as e:
+        print(f"試算紀錄存檔失敗: {e}")
+    # 結果留在伺服器端，之後 /api/send_result 只需帶回 result_id
+    result_id = result_store.put({
+        "user_id": req.user_id,
+        "result": result,
+        "max_age": req.max_age,
+        "interest_rate": req.interest_rate
+    })
+    result = dict(result, result_id=result_id)
+    # 之後可能會推送到 LINE 的使用者，先在背景繪製圖表
+    if CHART_PRERENDER_WORKERS > 0 and LINE_CHANNEL_ACCESS_TOKEN and req.user_id:
+        chart_prerenderer.submit(result["history"], result["crossover_age"])
     
-    return result
+    if fields == "summary":
+        result = {key: value for key, value in result.items() if key != "history"}
+    elif history_format == "compact":
+        result = dict(result, history=encode_history(result["history"]))
+    # 結果只含基本型別，直接序列化，略過 jsonable_encoder 逐一走訪
+    return FastJSONResponse(result)
+
+@app.post("/api/calculate_batch")
+def calculate_batch_api(req: CalculateBatchRequest):
+    """
+    一次試算多組情境 (顧問儀表板、LIFF 退休年齡滑桿)，所有情境以矩陣運算一次完成。
+    批次試算屬於 what-if 比較，不寫入 Google Sheets。
+    """
+    columns = [
+        req.current_age, req.retire_age, req.monthly_basic_expense, req.monthly_fun_expense,
+        req.monthly_saving, req.current_saving, req.max_age, req.interest_rate
+    ]
+    if any(isinstance(column, list) and len(column) > MAX_BATCH_SCENARIOS for column in columns):
+        raise HTTPException(status_code=400, detail=f"Too many scenarios (max {MAX_BATCH_SCENARIOS})")
+
+    try:
+        return FastJSONResponse(calculate_retirement_plans(*columns, include_history=req.include_history))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/api/sensitivity")
+def sensitivity_api(req: SensitivityRequest):
+    """敏感度分析，取代前端重複呼叫 /api/calculate 暴力搜尋；不寫入 Google Sheets"""
+    retire_ages = [int(v) for v in req.retire_age_range.values()] if req.retire_age_range else [req.retire_age]
+    interest_rates = req.interest_rate_range.values() if req.interest_rate_range else [req.interest_rate]
+
+    if req.mode == "solve":
+        if len(retire_ages) * len(interest_rates) > MAX_GRID_CELLS:
+            raise HTTPException(status_code=400, detail=f"Too many grid cells (max {MAX_GRID_CELLS})")
+        return FastJSONResponse(solve_min_monthly_saving(
+            current_age=req.current_age,
+            retire_ages=retire_ages,
+            monthly_basic_expense=req.monthly_basic_expense,
+            monthly_fun_expense=req.monthly_fun_expense,
+            current_saving=req.current_saving,
+            max_age=req.max_age,
+            interest_rates=interest_rates
+        ))
+
+    if req.mode != "grid":
+        raise HTTPException(status_code=400, detail="mode must be 'grid' or 'solve'")
+
+    monthly_savings = req.monthly_saving_range.values() if req.monthly_saving_range else [req.monthly_saving]
+    if len(retire_ages) * len(monthly_savings) * len(interest_rates) > MAX_GRID_CELLS:
+        raise HTTPException(status_code=400, detail=f"Too many grid cells (max {MAX_GRID_CELLS})")
+
+    return FastJSONResponse(calculate_sensitivity_grid(
+        current_age=req.current_age,
+        retire_ages=retire_ages,
+        monthly_basic_expense=req.monthly_basic_expense,
+        monthly_fun_expense=req.monthly_fun_expense,
+        monthly_savings=monthly_savings,
+        current_saving=req.current_saving,
+        max_age=req.max_age,
+        interest_rates=interest_rates
+    ))
+
+@app.post("/api/simulate")
+def simulate_api(req: SimulateRequest):
+    """回傳成功機率 (缺口為 0 的比例)、存款百分位數帶與交叉點年齡分佈；不寫入 Google Sheets"""
+    if not 0 < req.paths <= MAX_SIMULATION_PATHS:
+        raise HTTPException(status_code=400, detail=f"paths must be between 1 and {MAX_SIMULATION_PATHS}")
+    if req.max_age <= req.current_age:
+        raise HTTPException(status_code=400, detail="max_age must be greater than current_age")
+
+    return FastJSONResponse(simulate_retirement_plan(
+        current_age=req.current_age,
+        retire_age=req.retire_age,
+        monthly_basic_expense=req.monthly_basic_expense,
+        monthly_fun_expense=req.monthly_fun_expense,
+        monthly_saving=req.monthly_saving,
+        current_saving=req.current_saving,
+        max_age=req.max_age,
+        interest_rate=req.interest_rate,
+        paths=req.paths,
+        seed=req.seed if req.seed is not None else random.getrandbits(32),
+        return_volatility=req.return_volatility,
+        inflation_volatility=req.inflation_volatility,
+        chunk_size=SIMULATION_CHUNK_PATHS if req.paths > SIMULATION_CHUNK_PATHS else None
+    ))
 
 @app.post("/api/send_result")
-def send_result_api(req: SendResultRequest):
+async def send_result_api(req: SendResultRequest):
     """主動將試算結果圖表與資訊推送給 LINE User"""
     if not LINE_CHANNEL_ACCESS_TOKEN or not req.user_id:
         return {"status": "skipped", "reason": "No LINE Token or user_id provided"}
     
-    # 1. 產生 QuickChart 圖片網址（包含交叉點標註）
-    crossover_age = req.result.get("crossover_age")
-    chart_url = generate_quickchart_url(req.history, crossover_age)
+    # 1. 產生圖表圖片網址（包含交叉點標註）；優先取用試算後已在背景繪製 (或繪製中) 的圖表
+    payload = resolve_send_result(req)
+    with STAGE_SECONDS.time("send_result.chart"):
+        chart_url = await chart_prerenderer.chart_url(payload["history"], payload["result"].get("crossover_age"))
     
-    # 2. 生成 Flex Message 內容
-    flex_dict = create_flex_message(req.result, chart_url, req.max_age, req.interest_rate)
-    flex_obj = FlexContainer.from_dict(flex_dict)
-    flex_message = FlexMessage(alt_text="您的財富規劃試算結果出爐了！", contents=flex_obj)
+    # 2. 生成 Flex Message 內容 (填入預先驗證好的範本)
+    with STAGE_SECONDS.time("send_result.flex"):
+        flex_message = await run_warm(build_result_message, payload["result"], chart_url, payload["max_age"], payload["interest_rate"])
     
-    # 3. 推送
-    with ApiClient(line_config) as api_client:
-        line_api = MessagingApi(api_client)
-        push_req = PushMessageRequest(
-            to=req.user_id,
-            messages=[flex_message]
-        )
-        try:
-            line_api.push_message(push_req)
-        except Exception as e:
-            print("LINE Send Result Error:", e)
-            return {"status": "error", "message": str(e)}
+    # 3. 推送 (耗時記錄在 stage="line.push")
+    try:
+        await line_push_client.push_message(req.user_id, [flex_message])
+    except Exception as e:
+        print("LINE Send Result Error:", e)
+        return {"status": "error", "message": str(e)}
 
     return {"status": "success"}
 
 @app.post("/api/send_profile")
-def send_profile_api(req: ProfileRequest, background_tasks: BackgroundTasks):
+async def send_profile_api(req: ProfileRequest, background_tasks: BackgroundTasks):
     """接收前端傳來的理財人格，並發送專屬圖片給使用者"""
     if not LINE_CHANNEL_ACCESS_TOKEN or not req.user_id:
         return {"status": "skipped", "reason": "No LINE Token or user_id provided"}
-    
-    # 紀錄理財人格與資產分配到 Google Sheets（更新同一列）
+
+    image_url = req.image_url or PROFILE_IMAGE_URLS.get(req.profile_type)
+    if not image_url:
+        raise HTTPException(status_code=400, detail="image_url is required")
+
+    # 紀錄理財人格與資產分配（更新該使用者最新一筆試算紀錄，再由背景同步到 Google Sheets 同一列）
     allocations = {
         "stock": req.stock,
         "fund": req.fund,
@@ -273,100 +618,130 @@ def send_profile_api(req: ProfileRequest, background_tasks: BackgroundTasks):
         "time": req.time_deposit,
         "crypto": req.crypto
     }
-    background_tasks.add_task(
-        sheets_util.update_profile_in_sheet,
-        req.user_id,
-        req.profile_type,
-        allocations
-    )
-
-    # 根據 profile_type 決定邊框顏色
-    profile_color = "#f59e0b" # 預設穩健橘黃
-    if req.profile_type == "積極型":
-        profile_color = "#ef4444"
-    elif req.profile_type == "保守型":
-        profile_color = "#10b981"
-
-    flex_dict = {
-        "type": "bubble",
-        "header": {
-            "type": "box",
-            "layout": "vertical",
-            "contents": [
-                {
-                    "type": "text",
-                    "text": "您的專屬理財人格",
-                    "weight": "bold",
-                    "size": "xl",
-                    "color": "#d97706"
-                }
-            ],
-            "backgroundColor": "#fdfbf7"
-        },
-        "hero": {
-            "type": "image",
-            "url": req.image_url,
-            "size": "full",
-            "aspectRatio": "1024:1536",
-            "aspectMode": "cover"
-        },
-        "body": {
-            "type": "box",
-            "layout": "vertical",
-            "contents": [
-                {
-                    "type": "text",
-                    "text": req.profile_type,
-                    "weight": "bold",
-                    "size": "xxl",
-                    "color": profile_color,
-                    "align": "center"
-                }
-            ],
-            "backgroundColor": "#ffffff"
-        }
-    }
-
-    flex_obj = FlexContainer.from_dict(flex_dict)
-    flex_message = FlexMessage(alt_text=f"專屬理財類型分析結果：{req.profile_type}", contents=flex_obj)
-    
-    with ApiClient(line_config) as api_client:
-        line_api = MessagingApi(api_client)
-        push_req = PushMessageRequest(
-            to=req.user_id,
-            messages=[flex_message]
+    with STAGE_SECONDS.time("send_profile.record"):
+        recorded = await run_in_threadpool(plan_store.update_profile, req.user_id, req.profile_type, allocations)
+    if not recorded:
+        # 本機沒有紀錄 (例如改用 SQLite 之前的舊資料)，直接更新 Google Sheets 上的那一列
+        background_tasks.add_task(
+            sheets_util.update_profile_in_sheet,
+            req.user_id,
+            req.profile_type,
+            allocations
         )
-        try:
-            line_api.push_message(push_req)
-        except Exception as e:
-            print("LINE Push Profile Error:", e)
+
+    # 卡片只隨理財人格與圖片變動，直接取用已序列化的訊息，每次只需加上收件人
+    messages_json = await run_warm(profile_message_cache.get, req.profile_type, image_url)
+    try:
+        await line_push_client.push_prepared(req.user_id, messages_json)
+    except Exception as e:
+        print("LINE Push Profile Error:", e)
 
     return {"status": "success"}
 
+def resolve_bulk_recipient(req: SendResultRequest) -> dict:
+    """同 resolve_send_result；取不到內容 (例如 result_id 已過期) 時回傳 {"error": 原因}，只讓這一組的批次失敗"""
+    try:
+        return resolve_send_result(req)
+    except HTTPException as e:
+        return {"error": e.detail}
+
+@app.post("/api/bulk_send_result", dependencies=[Depends(require_admin)])
+async def bulk_send_result_api(req: BulkSendResultRequest):
+    """建立批次推送工作並在背景執行，立即回傳 job_id；以 GET /api/bulk_jobs/{job_id} 查詢進度"""
+    if not LINE_CHANNEL_ACCESS_TOKEN:
+        return {"status": "skipped", "reason": "No LINE Token provided"}
+
+    recipients = [(r.user_id, resolve_bulk_recipient(r)) for r in req.recipients if r.user_id]
+    job_id = await run_in_threadpool(bulk_sender.submit, recipients)
+    bulk_sender.start_job(job_id)
+    return await run_in_threadpool(bulk_sender.store.job, job_id)
+
+@app.get("/api/bulk_jobs/{job_id}", dependencies=[Depends(require_admin)])
+def bulk_job_api(job_id: str):
+    """批次推送工作的進度"""
+    job = bulk_sender.store.job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.post("/api/bulk_jobs/{job_id}/resume", dependencies=[Depends(require_admin)])
+async def resume_bulk_job_api(job_id: str):
+    """重新執行失敗或中斷的工作，只會送出尚未成功的批次"""
+    job = await run_in_threadpool(bulk_sender.store.job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    bulk_sender.start_job(job_id)
+    return job
+
+# 以名稱註冊事件類型，import 時不需要載入 SDK 的 webhook 模型
+@webhook_dispatcher.add("MessageEvent", message="TextMessageContent")
+async def handle_text_message(event):
+    # 目前階段一/二都是被動表單，如果在官方帳號內傳純文字，可以導引他打開表單
+    reply = command_router.match(event.message.text)
+    if reply is None or not LINE_CHANNEL_ACCESS_TOKEN or not event.reply_token:
+        return
+
+    messages_json = await run_warm(reply.get) if isinstance(reply, LazyMessages) else await reply(event)
+    await line_push_client.reply_prepared(event.reply_token, messages_json)
+
 @app.post("/webhook")
 async def line_webhook(request: Request):
     """
-    LINE Message API Webhook 進入點
+    LINE Message API Webhook 進入點：只驗證簽章並放入佇列後立即回應，事件由背景 worker 處理
     """
     signature = request.headers.get("X-Line-Signature", "")
     body = await request.body()
-    body_str = body.decode("utf-8")
 
     if not LINE_CHANNEL_SECRET:
         return "Not configured"
 
     try:
-        events = line_parser.parse(body_str, signature)
+        queued = webhook_dispatcher.accept(body, signature)
     except InvalidSignatureError:
         raise HTTPException(status_code=400, detail="Invalid signature")
 
-    for event in events:
-        if isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent):
-            # 目前階段一/二都是被動表單，如果在官方帳號內傳純文字，可以導引他打開表單
-            pass
+    if not queued:
+        # 佇列已滿：立即拒絕，讓 LINE 稍後重送，而不是讓請求等到逾時
+        print("警告: webhook 佇列已滿，拒絕此次請求。")
+        raise HTTPException(status_code=503, detail="Webhook queue is full")
 
     return "OK"
 
+@app.get("/api/webhook_stats")
+def webhook_stats_api():
+    """webhook 佇列深度與處理統計"""
+    return webhook_dispatcher.stats()
+
+@app.get("/api/plan_cache")
+def plan_cache_stats_api():
+    """試算結果快取的筆數與命中率"""
+    return plan_cache.stats()
+
+@app.get("/api/chart_cache")
+def chart_cache_stats_api():
+    """圖表快取的命中/未命中統計，以及預先繪製的命中率與浪費的繪製次數"""
+    return dict(chart_cache.stats(), prerender=chart_prerenderer.stats())
+
+@app.get("/api/warmup")
+async def warmup_api():
+    """
+    預熱：載入延後的 SDK、建好 Flex 範本與固定回覆並建立 LINE 推播連線池，回傳各步驟秒數。
+    可設為部署平台的 startup probe，讓第一個使用者請求不必等待載入。
+    """
+    seconds = await run_in_threadpool(warm_up)
+    started = time.perf_counter()
+    await line_push_client.start()
+    seconds["line_client"] = time.perf_counter() - started
+    return {
+        "seconds": {name: round(value, 4) for name, value in seconds.items()},
+        "total_seconds": round(sum(seconds.values()), 4)
+    }
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics_api():
+    """Prometheus text format：各路由與各階段的延遲分佈、背景作業耗時與失敗次數、佇列深度"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.get("/")
 def read_root():
     return {"message": "LINE OA Backend API is running."}
@@ -0,0 +1,213 @@
+import bisect
+import threading
+import time
+
+# 預設的延遲分桶 (秒)：涵蓋本機運算 (毫秒以下) 到 QuickChart / LINE API 逾時 (10 秒)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_text(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _ShardedMetric:
+    """
+    每個執行緒各自累計一份 (threading.local)，寫入時不需要 lock，也不會和其他執行緒互相覆蓋；
+    匯出時才把所有執行緒的數值加總。event loop 上的請求都在同一個執行緒，彼此依序執行。
+    每個執行緒 / 每組 label 只在第一次出現時建立一次計數陣列，之後的記錄不再配置記憶體。
+    """
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards = []
+        _registry.append(self)
+
+    def _shard(self) -> dict:
+        shard = getattr(self._local, "series", None)
+        if shard is None:
+            shard = self._local.series = {}
+            # list.append 在 GIL 下是原子操作
+            self._shards.append(shard)
+        return shard
+
+    def _merged(self) -> dict:
+        merged = {}
+        for shard in list(self._shards):
+            for labels, values in list(shard.items()):
+                total = merged.get(labels)
+                if total is None:
+                    merged[labels] = list(values)
+                else:
+                    for i, value in enumerate(values):
+                        total[i] += value
+        return merged
+
+
+class Counter(_ShardedMetric):
+    def inc(self, *labels, amount: float = 1):
+        shard = self._shard()
+        series = shard.get(labels)
+        if series is None:
+            series = shard[labels] = [0]
+        series[0] += amount
+
+    def values(self) -> dict:
+        return {labels: values[0] for labels, values in self._merged().items()}
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self.values().items()):
+            lines.append(f"{self.name}{_label_text(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class _Span:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram, labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+        return False
+
+
+class Histogram(_ShardedMetric):
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels):
+        shard = self._shard()
+        series = shard.get(labels)
+        if series is None:
+            # 各分桶的次數 (最後一格為 +Inf)、總次數、總和
+            series = shard[labels] = [0] * (len(self.buckets) + 1) + [0, 0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-2] += 1
+        series[-1] += value
+
+    def time(self, *labels) -> _Span:
+        """with histogram.time("label")：記錄區塊執行的秒數 (例外時也會記錄)"""
+        return _Span(self, labels)
+
+    def snapshot(self) -> dict:
+        """{labels: (count, sum)}"""
+        return {labels: (values[-2], values[-1]) for labels, values in self._merged().items()}
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, values in sorted(self._merged().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), values):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+                lines.append(f"{self.name}_bucket{_label_text(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_text(self.labelnames, labels)} {_format_value(values[-1])}")
+            lines.append(f"{self.name}_count{_label_text(self.labelnames, labels)} {values[-2]}")
+        return lines
+
+
+class GaugeCallback:
+    """匯出時才呼叫 func 取得目前的值 (佇列深度、快取筆數等)；func 回傳數值或 {labels tuple: 數值}"""
+
+    def __init__(self, name: str, help_text: str, func, labelnames: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.func = func
+        self.labelnames = tuple(labelnames)
+        _registry.append(self)
+
+    def render(self) -> list:
+        try:
+            value = self.func()
+        except Exception as e:
+            print(f"指標 {self.name} 讀取失敗: {e}")
+            return []
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        for labels, item in items:
+            lines.append(f"{self.name}{_label_text(self.labelnames, labels)} {_format_value(item)}")
+        return lines
+
+
+def render_metrics() -> str:
+    """所有已登記指標的 Prometheus text format (0.0.4)"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# === 共用指標 ===
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "HTTP 請求處理時間 (依路由樣板)", ("method", "route", "status")
+)
+STAGE_SECONDS = Histogram(
+    "stage_duration_seconds", "各處理階段的執行時間", ("stage",)
+)
+BACKGROUND_TASK_SECONDS = Histogram(
+    "background_task_duration_seconds", "背景作業 (Google Sheets 寫入、同步等) 每次執行的時間", ("task",)
+)
+BACKGROUND_TASK_FAILURES = Counter(
+    "background_task_failures_total", "背景作業失敗次數", ("task",)
+)
+LINE_API_REQUESTS = Counter(
+    "line_api_requests_total", "LINE API 請求次數 (含重試)，依結果分類", ("api", "outcome")
+)
+
+
+class MetricsMiddleware:
+    """
+    純 ASGI middleware：記錄每個請求的處理時間到 HTTP_REQUEST_SECONDS。
+    route 標籤使用路由樣板 (例如 /api/bulk_jobs/{job_id})，不會因路徑參數產生大量標籤組合。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - started,
+                scope["method"],
+                getattr(route, "path", "unmatched"),
+                status[0]
+            )
@@ -0,0 +1,115 @@
+import base64
+import json
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # orjson 為選用套件，未安裝時改用標準 json
+    orjson = None
+
+# 精簡的歷年軌跡格式：每個欄位為「與前一個值的差」經 zigzag 後以 varint (LEB128) 編碼，再轉成 base64 字串
+HISTORY_ENCODING = "delta-varint"
+HISTORY_COLUMNS = ("ages", "funds", "needs_basic", "needs_with_fun")
+# 前端以 JavaScript 解碼，數值需在 Number 可精確表示的範圍內
+_MAX_ABS_VALUE = 2 ** 53
+
+
+def _json_default(value):
+    """標準 json 無法處理的 numpy 型別 (ndarray 與純量) 轉成 Python 型別"""
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content) -> bytes:
+    """
+    序列化成 JSON bytes；有安裝 orjson 時使用 orjson (可直接處理 numpy 型別)。
+    orjson 只支援 64 位元整數，超出範圍 (例如極大的存款試算出的金額) 時改用標準 json。
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+        except TypeError:
+            pass
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":"), default=_json_default).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    以 dumps 序列化的 JSON 回應。
+    endpoint 直接回傳此物件時，FastAPI 不會再用 jsonable_encoder 走訪整個結果，內容需為可直接序列化的型別。
+    """
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+def _encode_column(values: list):
+    """整數欄位編碼成字串；含非整數 (例如 current_saving 的小數) 或數值過大時回傳 None，維持原本的 list"""
+    out = bytearray()
+    previous = 0
+    try:
+        for value in values:
+            integer = int(value)
+            if integer != value or abs(integer) >= _MAX_ABS_VALUE:
+                return None
+            delta = integer - previous
+            previous = integer
+            zigzag = delta << 1 if delta >= 0 else ((-delta) << 1) - 1
+            while zigzag > 0x7F:
+                out.append((zigzag & 0x7F) | 0x80)
+                zigzag >>= 7
+            out.append(zigzag)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return base64.b64encode(out).decode("ascii")
+
+
+def _decode_column(text: str) -> list:
+    values = []
+    value = 0
+    shift = 0
+    current = 0
+    for byte in base64.b64decode(text, validate=True):
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        current += (value >> 1) ^ -(value & 1)
+        values.append(current)
+        value = 0
+        shift = 0
+    if shift:
+        raise ValueError("歷年軌跡資料不完整")
+    return values
+
+
+def encode_history(history: dict) -> dict:
+    """
+    把 calculate_retirement_plan 的 history (四個整數 list) 轉成精簡格式：
+    {"encoding": "delta-varint", "ages": "<base64>", ...}。無法編碼的欄位保留原本的 list。
+    """
+    encoded = {"encoding": HISTORY_ENCODING}
+    for column, values in history.items():
+        text = _encode_column(values) if column in HISTORY_COLUMNS else None
+        encoded[column] = values if text is None else text
+    return encoded
+
+
+def decode_history(history: dict) -> dict:
+    """encode_history 的反向轉換；一般格式 (沒有 encoding 欄位) 原樣回傳。格式錯誤時拋出 ValueError"""
+    encoding = history.get("encoding")
+    if encoding is None:
+        return history
+    if encoding != HISTORY_ENCODING:
+        raise ValueError(f"不支援的歷年軌跡格式: {encoding}")
+    decoded = {}
+    for column, values in history.items():
+        if column == "encoding":
+            continue
+        try:
+            decoded[column] = _decode_column(values) if isinstance(values, str) else values
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"歷年軌跡欄位 {column} 無法解碼: {e}")
+    return decoded
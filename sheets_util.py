@@ -1,11 +1,16 @@
 import os
-import gspread
-from google.oauth2.service_account import Credentials
-from datetime import datetime
-import pytz
+import re
+import json
+import time
+import shutil
+import threading
+from datetime import datetime, timedelta, timezone
+from metrics_util import BACKGROUND_TASK_SECONDS, BACKGROUND_TASK_FAILURES, Counter
 
-# 設定時區為台北
-tz = pytz.timezone('Asia/Taipei')
+# gspread 與 google-auth 只在建立連線 (背景執行緒) 時才載入，import 本模組不需要等待
+
+# 設定時區為台北 (台灣不實施日光節約時間，固定 UTC+8，不需要載入 pytz 的時區資料庫)
+tz = timezone(timedelta(hours=8), "Asia/Taipei")
 
 # 設定 Google API Scope
 SCOPES = [
@@ -20,66 +25,434 @@ HEADERS = [
     "理財人格", "股票%", "基金%", "保險%", "活存%", "定存%", "加密貨幣%"
 ]
 
-def _get_sheet():
-    """取得 Google Sheet 工作表物件"""
-    cred_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
-    sheet_url = os.getenv("GOOGLE_SHEET_URL")
+# 快取的工作表物件：整個程序共用，只在第一次使用 (或憑證/網址改變、連線失效) 時重新建立。
+# gspread 底層的 AuthorizedSession 會在 access token 過期時自動更新，不需要重新 authorize。
+_sheet_lock = threading.Lock()
+_sheet_cache = None  # (cred_path, sheet_url, worksheet)
 
-    if not cred_path or not sheet_url:
-        print("警告: 尚未設定 GOOGLE_APPLICATION_CREDENTIALS 或 GOOGLE_SHEET_URL，跳過寫入。")
-        return None
+# LINE User ID -> 該使用者最新一列的列號 (1-indexed)。建立連線時以 B 欄一次載入，之後每次 append 時更新，
+# 更新理財人格時不需要下載整張工作表
+_row_index = {}
+_row_index_lock = threading.Lock()
+USER_ID_COLUMN = 2  # B 欄
+
+# 這些狀態碼代表快取的連線已失效 (授權被撤銷、試算表被刪除或換網址)，需要重建
+SHEETS_STALE_STATUS_CODES = (401, 403, 404)
 
-    if not os.path.exists(cred_path):
-        print(f"警告: 找不到 Google 金鑰檔案 {cred_path}，跳過寫入。")
-        return None
+
+def _open_sheet(cred_path: str, sheet_url: str):
+    import gspread
+    from google.oauth2.service_account import Credentials
 
     credentials = Credentials.from_service_account_file(cred_path, scopes=SCOPES)
     gc = gspread.authorize(credentials)
     sheet = gc.open_by_url(sheet_url).sheet1
 
-    # 確保標題列存在
+    # 確保標題列存在 (只在建立連線時檢查一次)
     first_row = sheet.row_values(1)
     if not first_row or first_row[0] != "時間":
         sheet.insert_row(HEADERS, 1)
 
+    _load_row_index(sheet)
     return sheet
 
 
-def append_to_sheet(user_id: str, user_name: str, request_data: dict, result_data: dict):
+def _load_row_index(sheet):
+    """以一次 B 欄讀取重建 user_id -> 列號索引 (同一使用者保留最後一列)"""
+    global _row_index
+    index = {}
+    for row, user_id in enumerate(sheet.col_values(USER_ID_COLUMN)[1:], start=2):
+        if user_id:
+            index[user_id] = row
+    with _row_index_lock:
+        _row_index = index
+
+
+def _index_appended_rows(response: dict, rows: list):
+    """從 append_rows 回傳的 updatedRange (例如 'Sheet1!A12:S14') 取得新列的列號並更新索引"""
+    updated_range = (response or {}).get("updates", {}).get("updatedRange", "")
+    match = re.search(r"![A-Z]+(\d+)", updated_range)
+    if not match:
+        return
+    first_row = int(match.group(1))
+    with _row_index_lock:
+        for offset, row in enumerate(rows):
+            _row_index[row[USER_ID_COLUMN - 1]] = first_row + offset
+
+
+def _find_user_row(user_id: str):
+    """查詢 user_id 最新一列的列號；索引沒有時才讀取 B 欄往回找"""
+    with _row_index_lock:
+        target_row = _row_index.get(user_id)
+    if target_row:
+        return target_row
+
+    user_ids = _with_sheet(lambda sheet: sheet.col_values(USER_ID_COLUMN))
+    if not user_ids:
+        return None
+    for i in range(len(user_ids) - 1, 0, -1):  # 從最後一列往回找，跳過標題列
+        if user_ids[i] == user_id:
+            with _row_index_lock:
+                _row_index[user_id] = i + 1  # gspread 是 1-indexed
+            return i + 1
+    return None
+
+
+def _get_sheet():
+    """取得 Google Sheet 工作表物件 (執行緒安全的快取)"""
+    global _sheet_cache
+    cred_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
+    sheet_url = os.getenv("GOOGLE_SHEET_URL")
+
+    if not cred_path or not sheet_url:
+        print("警告: 尚未設定 GOOGLE_APPLICATION_CREDENTIALS 或 GOOGLE_SHEET_URL，跳過寫入。")
+        return None
+
+    with _sheet_lock:
+        if _sheet_cache is not None and _sheet_cache[:2] == (cred_path, sheet_url):
+            return _sheet_cache[2]
+
+        if not os.path.exists(cred_path):
+            print(f"警告: 找不到 Google 金鑰檔案 {cred_path}，跳過寫入。")
+            return None
+
+        try:
+            with BACKGROUND_TASK_SECONDS.time("sheets.open"):
+                sheet = _open_sheet(cred_path, sheet_url)
+        except Exception:
+            BACKGROUND_TASK_FAILURES.inc("sheets.open")
+            raise
+        _sheet_cache = (cred_path, sheet_url, sheet)
+        return sheet
+
+
+def _reset_sheet(sheet):
+    """丟棄失效的快取；若其他執行緒已經重建過就保留新的"""
+    global _sheet_cache
+    with _sheet_lock:
+        if _sheet_cache is not None and _sheet_cache[2] is sheet:
+            _sheet_cache = None
+
+
+def _is_stale_sheet_error(e: Exception) -> bool:
+    # 例外只會在連線建立 (已載入 gspread) 之後發生
+    import gspread
+    from google.auth.exceptions import RefreshError
+
+    if isinstance(e, RefreshError):
+        return True
+    return isinstance(e, gspread.exceptions.APIError) and e.code in SHEETS_STALE_STATUS_CODES
+
+
+def _with_sheet(operation):
     """
-    第一階段：將使用者的填答與計算結果寫入 Google Sheet（新增一行）。
+    以快取的工作表執行 operation(sheet) 並回傳結果；未設定 Google Sheets 時回傳 None。
+    遇到授權失效或找不到試算表時重建連線再試一次。
     """
-    try:
+    for attempt in range(2):
         sheet = _get_sheet()
         if not sheet:
+            return None
+        try:
+            return operation(sheet)
+        except Exception as e:
+            if attempt or not _is_stale_sheet_error(e):
+                raise
+            print(f"Google Sheet 連線失效，重新建立連線: {e}")
+            _reset_sheet(sheet)
+
+
+def init_sheet():
+    """服務啟動時在背景建立連線並檢查標題列，之後的寫入直接沿用，不影響啟動時間"""
+    def warm_up():
+        try:
+            _get_sheet()
+        except Exception as e:
+            print(f"Google Sheet 初始化失敗，將於第一次寫入時重試: {e}")
+
+    threading.Thread(target=warm_up, name="sheets-init", daemon=True).start()
+
+
+# 寫入緩衝設定：累積到 SHEETS_BATCH_ROWS 筆或每 SHEETS_FLUSH_SECONDS 秒，以一次 append_rows 寫入
+SHEETS_BATCH_ROWS = int(os.getenv("SHEETS_BATCH_ROWS", "200"))
+SHEETS_FLUSH_SECONDS = float(os.getenv("SHEETS_FLUSH_SECONDS", "5"))
+# 記憶體中最多暫存的筆數；滿了之後寫入端最多等待 SHEETS_PUT_TIMEOUT_SECONDS 秒，再改寫到暫存檔
+SHEETS_MAX_PENDING_ROWS = int(os.getenv("SHEETS_MAX_PENDING_ROWS", "10000"))
+SHEETS_PUT_TIMEOUT_SECONDS = 1.0
+# 寫入失敗 (例如超過每分鐘配額) 時，資料先存到本機 JSONL 暫存檔，等待 SHEETS_RETRY_SECONDS 秒後再補寫
+SHEETS_SPILL_PATH = os.getenv("SHEETS_SPILL_PATH", "sheets_spill.jsonl")
+SHEETS_RETRY_SECONDS = 60
+# 單次 append_rows 的最大筆數，避免補寫大量資料時超過 API 請求大小
+SHEETS_MAX_ROWS_PER_CALL = 1000
+# 補寫時每次從暫存檔讀出的最大筆數；暫存檔再大，記憶體用量也不超過這個範圍
+SHEETS_SPILL_READ_ROWS = 5000
+
+SHEETS_ROWS_WRITTEN = Counter("sheets_rows_written_total", "已寫入 Google Sheet 的列數")
+SHEETS_ROWS_SPILLED = Counter("sheets_rows_spilled_total", "寫入失敗或配額用盡而暫存到本機檔案的列數")
+SHEETS_ROWS_DROPPED = Counter("sheets_rows_dropped_total", "未設定暫存檔而捨棄的列數")
+
+
+class GoogleSheetSink:
+    """寫入目的地：Google Sheet 工作表。任何有 append_rows(rows) 方法的物件都可替換 (例如 MemorySheetSink)"""
+
+    def append_rows(self, rows: list):
+        _with_sheet(lambda sheet: _index_appended_rows(sheet.append_rows(rows), rows))
+
+
+class MemorySheetSink:
+    """
+    測試用的記憶體工作表 (benchmark.py 的 check_sheets_buffer 使用)：
+    fail_times 可模擬前幾次寫入失敗 (例如配額用盡)，fail_on_calls 指定第幾次呼叫 (從 1 起算) 失敗，
+    例如多個分段寫入中途失敗。
+    """
+
+    def __init__(self, fail_times: int = 0, fail_on_calls=()):
+        self.rows = []
+        self.calls = 0
+        self.fail_times = fail_times
+        self.fail_on_calls = set(fail_on_calls)
+
+    def append_rows(self, rows: list):
+        self.calls += 1
+        if self.fail_times > 0 or self.calls in self.fail_on_calls:
+            self.fail_times = max(self.fail_times - 1, 0)
+            raise RuntimeError("模擬寫入失敗")
+        self.rows.extend(rows)
+
+
+class SheetsWriteBuffer:
+    """
+    Google Sheets 的 write-behind 緩衝：寫入端只把資料放進記憶體，由背景執行緒合併後批次寫入。
+    - 筆數達 batch_rows 或距上次寫入超過 flush_seconds 時寫入一次
+    - 暫存超過 max_pending_rows 時寫入端會被擋住 (backpressure)，逾時則改寫到暫存檔，不會無限佔用記憶體
+    - 寫入失敗的資料存到 spill_path，retry_seconds 後先依序補寫 (每次最多讀 spill_read_rows 列，
+      寫入成功才從檔案移除)，補寫完才寫入新資料
+    - close() 會把剩餘資料全部寫出，服務關閉時呼叫
+    """
+
+    def __init__(self, sink, batch_rows: int = SHEETS_BATCH_ROWS, flush_seconds: float = SHEETS_FLUSH_SECONDS,
+                 max_pending_rows: int = SHEETS_MAX_PENDING_ROWS, spill_path: str = SHEETS_SPILL_PATH,
+                 retry_seconds: float = SHEETS_RETRY_SECONDS, spill_read_rows: int = SHEETS_SPILL_READ_ROWS):
+        self.sink = sink
+        self.batch_rows = batch_rows
+        self.flush_seconds = flush_seconds
+        self.max_pending_rows = max_pending_rows
+        self.spill_path = spill_path
+        self.retry_seconds = retry_seconds
+        self.spill_read_rows = spill_read_rows
+        self._rows = []
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        self._retry_at = 0.0
+        self._closed = False
+        self._thread = None
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._closed = False
+                self._thread = threading.Thread(target=self._run, name="sheets-writer", daemon=True)
+                self._thread.start()
+
+    def put(self, row: list):
+        """加入一列資料；緩衝已滿時最多等待 SHEETS_PUT_TIMEOUT_SECONDS 秒"""
+        self.start()
+        with self._cond:
+            deadline = time.monotonic() + SHEETS_PUT_TIMEOUT_SECONDS
+            while len(self._rows) >= self.max_pending_rows:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            else:
+                self._rows.append(row)
+                if len(self._rows) >= self.batch_rows:
+                    self._cond.notify_all()
+                return
+        print("警告: Google Sheets 寫入緩衝已滿，改寫入暫存檔。")
+        self._spill([row])
+
+    def flush(self):
+        """立即寫出目前緩衝中的資料 (以及到期的暫存檔資料)"""
+        with self._flush_lock:
+            with self._cond:
+                rows, self._rows = self._rows, []
+                self._cond.notify_all()
+            self._write(rows)
+
+    def write_through(self, rows: list):
+        """
+        不經緩衝、同步寫入 (依序分段)；失敗時直接拋出例外，不寫入暫存檔。
+        供自行保存待寫資料、需要確認寫入成功才標記完成的呼叫端使用 (例如 storage_util.SheetsReplicator)。
+        """
+        with self._flush_lock:
+            for start in range(0, len(rows), SHEETS_MAX_ROWS_PER_CALL):
+                chunk = rows[start:start + SHEETS_MAX_ROWS_PER_CALL]
+                try:
+                    with BACKGROUND_TASK_SECONDS.time("sheets.append_rows"):
+                        self.sink.append_rows(chunk)
+                except Exception:
+                    BACKGROUND_TASK_FAILURES.inc("sheets.append_rows")
+                    raise
+                SHEETS_ROWS_WRITTEN.inc(amount=len(chunk))
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            thread, self._thread = self._thread, None
+            self._cond.notify_all()
+        if thread is not None:
+            thread.join()
+        self.flush()
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._rows)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed and len(self._rows) < self.batch_rows:
+                    self._cond.wait(self.flush_seconds)
+                closed = self._closed
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Google Sheets 背景寫入錯誤: {e}")
+            if closed:
+                return
+
+    def _write(self, rows: list):
+        if time.monotonic() < self._retry_at:
+            self._spill(rows)
             return
+        total = 0
+        # 先依序補寫暫存檔，每段寫入成功後才從檔案移除；補寫失敗時新資料接在暫存檔後面，維持原本順序
+        while True:
+            spilled, line_ends = self._read_spill(self.spill_read_rows)
+            if not spilled:
+                break
+            written = self._append_rows(spilled)
+            if written:
+                self._drop_spill(line_ends[written - 1])
+            total += written
+            if written < len(spilled):
+                self._spill(rows)
+                return
+        written = self._append_rows(rows)
+        self._spill(rows[written:])
+        total += written
+        if total:
+            print(f"成功批次寫入 {total} 筆資料到 Google Sheet！")
+
+    def _append_rows(self, rows: list) -> int:
+        """分段寫入，回傳成功寫入的筆數；失敗時停止並設定重試時間"""
+        written = 0
+        try:
+            while written < len(rows):
+                chunk = rows[written:written + SHEETS_MAX_ROWS_PER_CALL]
+                with BACKGROUND_TASK_SECONDS.time("sheets.append_rows"):
+                    self.sink.append_rows(chunk)
+                written += len(chunk)
+                SHEETS_ROWS_WRITTEN.inc(amount=len(chunk))
+        except Exception as e:
+            BACKGROUND_TASK_FAILURES.inc("sheets.append_rows")
+            self._retry_at = time.monotonic() + self.retry_seconds
+            print(f"批次寫入 Google Sheet 失敗，{len(rows) - written} 筆暫存待 {self.retry_seconds:g} 秒後重試: {e}")
+        return written
+
+    def _spill(self, rows: list):
+        if not rows:
+            return
+        if not self.spill_path:
+            print(f"警告: 未設定暫存檔，捨棄 {len(rows)} 筆資料。")
+            SHEETS_ROWS_DROPPED.inc(amount=len(rows))
+            return
+        SHEETS_ROWS_SPILLED.inc(amount=len(rows))
+        with self._spill_lock:
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                for row in rows:
+                    f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+    def _read_spill(self, limit: int) -> tuple:
+        """從暫存檔開頭讀出最多 limit 列，回傳 (資料, 每列結尾在檔案中的位置)；不修改檔案"""
+        rows, line_ends = [], []
+        if not self.spill_path:
+            return rows, line_ends
+        with self._spill_lock:
+            if not os.path.exists(self.spill_path):
+                return rows, line_ends
+            offset = 0
+            with open(self.spill_path, "rb") as f:
+                for line in f:
+                    offset += len(line)
+                    if line.strip():
+                        rows.append(json.loads(line))
+                        line_ends.append(offset)
+                        if len(rows) >= limit:
+                            break
+        return rows, line_ends
 
-        current_time = datetime.now(tz).strftime("%Y-%m-%d %H:%M:%S")
-
-        row_data = [
-            current_time,                                      # 時間
-            user_id or "未提供ID",                             # LINE User ID
-            user_name or "未提供暱稱",                         # LINE 暱稱
-            request_data.get('current_age', ''),               # 目前年齡
-            request_data.get('retire_age', ''),                # 退休年齡
-            request_data.get('monthly_basic_expense', ''),     # 預計月基本花費
-            request_data.get('monthly_fun_expense', ''),       # 預計月娛樂花費
-            request_data.get('current_saving', ''),            # 目前存款
-            result_data.get('total_need_basic', ''),           # 退休總需求(基本)
-            result_data.get('total_need_with_fun', ''),        # 退休總需求(含娛樂)
-            result_data.get('total_fund', ''),                 # 預估實際存款累積
-            result_data.get('gap', ''),                        # 資金缺口
-            '',                                                # 理財人格 (第二階段填入)
-            '',                                                # 股票%
-            '',                                                # 基金%
-            '',                                                # 保險%
-            '',                                                # 活存%
-            '',                                                # 定存%
-            '',                                                # 加密貨幣%
-        ]
-
-        sheet.append_row(row_data)
-        print("第一階段：成功將試算資料寫入 Google Sheet！")
+    def _drop_spill(self, offset: int):
+        """移除暫存檔開頭 offset 位元組 (已補寫的列)；其餘 (含補寫期間新加入的) 列以串流方式搬到新檔保留"""
+        with self._spill_lock:
+            temp_path = self.spill_path + ".tmp"
+            with open(self.spill_path, "rb") as src:
+                src.seek(offset)
+                with open(temp_path, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                    remaining = dst.tell()
+            if remaining:
+                os.replace(temp_path, self.spill_path)
+            else:
+                os.remove(temp_path)
+                os.remove(self.spill_path)
+
+
+sheet_writer = SheetsWriteBuffer(GoogleSheetSink())
+
+
+def is_configured() -> bool:
+    return bool(os.getenv("GOOGLE_APPLICATION_CREDENTIALS") and os.getenv("GOOGLE_SHEET_URL"))
+
+
+def build_row(user_id: str, user_name: str, request_data: dict, result_data: dict, created_at: str = None,
+              profile_type: str = '', allocations: dict = None) -> list:
+    """組成工作表的一列資料；created_at 未提供時使用目前時間，理財人格欄位預設留白 (第二階段填入)"""
+    current_time = created_at or datetime.now(tz).strftime("%Y-%m-%d %H:%M:%S")
+    allocations = allocations or {}
+
+    return [
+        current_time,                                      # 時間
+        user_id or "未提供ID",                             # LINE User ID
+        user_name or "未提供暱稱",                         # LINE 暱稱
+        request_data.get('current_age', ''),               # 目前年齡
+        request_data.get('retire_age', ''),                # 退休年齡
+        request_data.get('monthly_basic_expense', ''),     # 預計月基本花費
+        request_data.get('monthly_fun_expense', ''),       # 預計月娛樂花費
+        request_data.get('current_saving', ''),            # 目前存款
+        result_data.get('total_need_basic', ''),           # 退休總需求(基本)
+        result_data.get('total_need_with_fun', ''),        # 退休總需求(含娛樂)
+        result_data.get('total_fund', ''),                 # 預估實際存款累積
+        result_data.get('gap', ''),                        # 資金缺口
+        profile_type or '',                                # 理財人格
+        allocations.get('stock', ''),                      # 股票%
+        allocations.get('fund', ''),                       # 基金%
+        allocations.get('insurance', ''),                  # 保險%
+        allocations.get('demand', ''),                     # 活存%
+        allocations.get('time', ''),                       # 定存%
+        allocations.get('crypto', ''),                     # 加密貨幣%
+    ]
+
+
+def append_to_sheet(user_id: str, user_name: str, request_data: dict, result_data: dict):
+    """
+    第一階段：將使用者的填答與計算結果寫入 Google Sheet（新增一行）。
+    實際寫入由 sheet_writer 在背景批次完成。
+    """
+    try:
+        sheet_writer.put(build_row(user_id, user_name, request_data, result_data))
 
     except Exception as e:
         print(f"第一階段寫入 Google Sheet 失敗: {e}")
@@ -90,38 +463,41 @@ def update_profile_in_sheet(user_id: str, profile_type: str, allocations: dict):
     第二階段：找到該 user_id 最近一筆紀錄，在同一行更新理財人格與資金分配比例。
     """
     try:
-        sheet = _get_sheet()
-        if not sheet:
-            return
+        update_profile_row(user_id, profile_type, allocations)
+    except Exception as e:
+        print(f"第二階段更新 Google Sheet 失敗: {e}")
 
-        # 找到 LINE User ID 欄 (B 欄) 中符合的最後一列
-        all_values = sheet.get_all_values()
-        target_row = None
-        for i in range(len(all_values) - 1, 0, -1):  # 從最後一列往回找，跳過標題列
-            if all_values[i][1] == user_id:  # B 欄 = LINE User ID
-                target_row = i + 1  # gspread 是 1-indexed
-                break
 
-        if not target_row:
-            print(f"找不到 user_id={user_id} 的紀錄，無法更新理財人格。")
-            return
+def update_profile_row(user_id: str, profile_type: str, allocations: dict) -> bool:
+    """同 update_profile_in_sheet，但寫入失敗時拋出例外 (供需要重試的呼叫端使用)；找不到該使用者時回傳 False"""
+    # 先寫出緩衝中的資料，確保剛試算的那一列已在工作表上
+    sheet_writer.flush()
 
-        # 更新 M 欄 (理財人格, col 13) 到 R 欄 (定存%, col 18)
-        profile_data = [
-            profile_type,
-            allocations.get('stock', ''),
-            allocations.get('fund', ''),
-            allocations.get('insurance', ''),
-            allocations.get('demand', ''),
-            allocations.get('time', ''),
-            allocations.get('crypto', ''),
-        ]
+    # 找到 LINE User ID 欄 (B 欄) 中符合的最後一列
+    target_row = _find_user_row(user_id)
+    if not target_row:
+        print(f"找不到 user_id={user_id} 的紀錄，無法更新理財人格。")
+        return False
 
-        # 批次更新 M~S 欄 (col 13~19)
-        cell_range = f"M{target_row}:S{target_row}"
-        sheet.update(cell_range, [profile_data])
+    # 更新 M 欄 (理財人格, col 13) 到 R 欄 (定存%, col 18)
+    profile_data = [
+        profile_type,
+        allocations.get('stock', ''),
+        allocations.get('fund', ''),
+        allocations.get('insurance', ''),
+        allocations.get('demand', ''),
+        allocations.get('time', ''),
+        allocations.get('crypto', ''),
+    ]
 
-        print(f"第二階段：成功更新第 {target_row} 列的理財人格與資金分配！")
+    # 批次更新 M~S 欄 (col 13~19)
+    cell_range = f"M{target_row}:S{target_row}"
+    try:
+        with BACKGROUND_TASK_SECONDS.time("sheets.update_profile"):
+            _with_sheet(lambda sheet: sheet.update(cell_range, [profile_data]))
+    except Exception:
+        BACKGROUND_TASK_FAILURES.inc("sheets.update_profile")
+        raise
 
-    except Exception as e:
-        print(f"第二階段更新 Google Sheet 失敗: {e}")
+    print(f"第二階段：成功更新第 {target_row} 列的理財人格與資金分配！")
+    return True
@@ -0,0 +1,341 @@
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import sheets_util
+from payload_util import dumps
+from metrics_util import BACKGROUND_TASK_SECONDS, BACKGROUND_TASK_FAILURES
+
+# 本機主要資料庫 (SQLite, WAL 模式)；Google Sheets 改為背景同步的副本
+STORAGE_PATH = os.getenv("STORAGE_PATH", "wealth_blueprint.db")
+# 背景同步到 Google Sheets 的間隔 (秒) 與每輪處理筆數
+REPLICATE_SECONDS = float(os.getenv("STORAGE_REPLICATE_SECONDS", "2"))
+REPLICATE_BATCH_ROWS = 500
+# 試算結果暫存 (result_id) 的有效時間與記憶體筆數上限
+RESULT_TTL_SECONDS = float(os.getenv("RESULT_TTL_SECONDS", "3600"))
+RESULT_MAX_ENTRIES = int(os.getenv("RESULT_MAX_ENTRIES", "10000"))
+
+PLAN_COLUMNS = (
+    "current_age", "retire_age", "monthly_basic_expense", "monthly_fun_expense", "monthly_saving",
+    "current_saving", "max_age", "interest_rate"
+)
+RESULT_COLUMNS = ("total_need_basic", "total_need_with_fun", "total_fund", "gap", "crossover_age")
+ALLOCATION_COLUMNS = ("stock", "fund", "insurance", "demand", "time", "crypto")
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS plans (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at TEXT NOT NULL,
+    user_id TEXT,
+    user_name TEXT,
+    {", ".join(f"{column} NUMERIC" for column in PLAN_COLUMNS + RESULT_COLUMNS)},
+    profile_type TEXT,
+    {", ".join(f"alloc_{column} NUMERIC" for column in ALLOCATION_COLUMNS)},
+    sheet_synced INTEGER NOT NULL DEFAULT 0,
+    profile_rev INTEGER NOT NULL DEFAULT 0,
+    profile_synced_rev INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_plans_user ON plans (user_id, id);
+CREATE INDEX IF NOT EXISTS idx_plans_created_at ON plans (created_at);
+CREATE INDEX IF NOT EXISTS idx_plans_unsynced ON plans (id) WHERE sheet_synced = 0 OR profile_rev > profile_synced_rev;
+"""
+
+
+# SQLite INTEGER 為 64 位元，超出範圍的整數改存為 REAL (連 float 都放不下時以文字寫入，NUMERIC 欄位會存成 ±Inf)
+SQLITE_INT_MIN, SQLITE_INT_MAX = -2 ** 63, 2 ** 63 - 1
+
+
+def _sqlite_number(value):
+    if isinstance(value, int) and not isinstance(value, bool) and not SQLITE_INT_MIN <= value <= SQLITE_INT_MAX:
+        try:
+            return float(value)
+        except OverflowError:
+            return str(value)
+    return value
+
+
+class PlanStore:
+    """
+    試算紀錄的本機儲存，語意與 sheets_util 相同：
+    save_plan 對應 append_to_sheet (新增一筆)，update_profile 對應 update_profile_in_sheet (更新該使用者最新一筆)。
+    寫入只是本機 SQLite 交易，不經過網路；多個 threadpool worker 共用同一個連線，以 lock 保護。
+    """
+
+    def __init__(self, path: str = STORAGE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # WAL 模式下 NORMAL 不會在每次 commit 時 fsync，程式當掉也不會遺失已 commit 的資料
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+    def save_plan(self, user_id: str, user_name: str, request_data: dict, result_data: dict) -> int:
+        """新增一筆試算紀錄，回傳紀錄 id"""
+        created_at = datetime.now(sheets_util.tz).strftime("%Y-%m-%d %H:%M:%S")
+        columns = ("created_at", "user_id", "user_name") + PLAN_COLUMNS + RESULT_COLUMNS
+        values = [created_at, user_id, user_name]
+        values += [_sqlite_number(request_data.get(column)) for column in PLAN_COLUMNS]
+        values += [_sqlite_number(result_data.get(column)) for column in RESULT_COLUMNS]
+        with self._lock:
+            cursor = self._db.execute(
+                f"INSERT INTO plans ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})", values
+            )
+            self._db.commit()
+            return cursor.lastrowid
+
+    def update_profile(self, user_id: str, profile_type: str, allocations: dict) -> bool:
+        """更新該使用者最新一筆紀錄的理財人格與資產分配；沒有任何紀錄時回傳 False"""
+        assignments = ", ".join(f"alloc_{column} = ?" for column in ALLOCATION_COLUMNS)
+        values = [profile_type] + [_sqlite_number(allocations.get(column)) for column in ALLOCATION_COLUMNS] + [user_id]
+        with self._lock:
+            cursor = self._db.execute(
+                f"UPDATE plans SET profile_type = ?, {assignments}, profile_rev = profile_rev + 1 "
+                "WHERE id = (SELECT MAX(id) FROM plans WHERE user_id = ?)",
+                values
+            )
+            self._db.commit()
+            return cursor.rowcount > 0
+
+    def latest_plan(self, user_id: str):
+        """該使用者最新一筆試算紀錄 (dict)，沒有時回傳 None"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT * FROM plans WHERE user_id = ? ORDER BY id DESC LIMIT 1", (user_id,)
+            ).fetchone()
+        return _plan_dict(row) if row else None
+
+    def common_inputs(self, limit: int) -> list:
+        """最常出現的試算輸入 (依 PLAN_COLUMNS 順序的 tuple)，由多到少，供預先計算試算結果快取"""
+        columns = ", ".join(PLAN_COLUMNS)
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT {columns} FROM plans WHERE {' AND '.join(f'{column} IS NOT NULL' for column in PLAN_COLUMNS)} "
+                f"GROUP BY {columns} ORDER BY COUNT(*) DESC, MAX(id) DESC LIMIT ?",
+                (limit,)
+            ).fetchall()
+        return [tuple(row) for row in rows]
+
+    def unsynced_plans(self, limit: int = REPLICATE_BATCH_ROWS) -> list:
+        with self._lock:
+            return self._db.execute(
+                "SELECT * FROM plans WHERE sheet_synced = 0 ORDER BY id LIMIT ?", (limit,)
+            ).fetchall()
+
+    def unsynced_profiles(self, limit: int = REPLICATE_BATCH_ROWS) -> list:
+        with self._lock:
+            return self._db.execute(
+                "SELECT * FROM plans WHERE sheet_synced = 1 AND profile_rev > profile_synced_rev ORDER BY id LIMIT ?",
+                (limit,)
+            ).fetchall()
+
+    def mark_plans_synced(self, rows: list):
+        """標記新紀錄已寫到工作表；當時已填的理財人格一併寫入，視為同步到該版本"""
+        with self._lock:
+            self._db.executemany(
+                "UPDATE plans SET sheet_synced = 1, profile_synced_rev = MAX(profile_synced_rev, ?) WHERE id = ?",
+                [(row["profile_rev"], row["id"]) for row in rows]
+            )
+            self._db.commit()
+
+    def mark_profile_synced(self, plan_id: int, profile_rev: int):
+        # 只標記已同步的版本；同步期間又被更新的話下一輪會再同步一次
+        with self._lock:
+            self._db.execute(
+                "UPDATE plans SET profile_synced_rev = MAX(profile_synced_rev, ?) WHERE id = ?", (profile_rev, plan_id)
+            )
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def _plan_dict(row: sqlite3.Row) -> dict:
+    plan = {
+        "id": row["id"],
+        "created_at": row["created_at"],
+        "user_id": row["user_id"],
+        "user_name": row["user_name"]
+    }
+    plan.update({column: row[column] for column in PLAN_COLUMNS + RESULT_COLUMNS})
+    plan["profile_type"] = row["profile_type"]
+    plan["allocations"] = {column: row[f"alloc_{column}"] for column in ALLOCATION_COLUMNS}
+    return plan
+
+
+class SheetsReplicator:
+    """
+    背景執行緒：定期把 SQLite 中尚未同步的新紀錄與理財人格更新，依序寫到 Google Sheets。
+    每輪先寫入新紀錄 (已填理財人格的直接寫在同一列)，工作表確認寫入成功後才標記已同步；
+    再同步已在工作表上的紀錄的理財人格，更新成功 (找得到該列) 才標記，否則保留到下一輪。
+    寫入失敗時資料仍留在 SQLite，等 SHEETS_RETRY_SECONDS 後重試，不會遺失也不需另外暫存。
+    未設定 Google Sheets 時不做任何事，資料留在本機，之後設定好再補同步。
+    writer / update_profile 預設為 sheets_util 的 sheet_writer 與 update_profile_row (benchmark.py 可換成測試用的工作表)。
+    """
+
+    def __init__(self, store: PlanStore, interval: float = REPLICATE_SECONDS, writer=None, update_profile=None):
+        self.store = store
+        self.interval = interval
+        self.writer = writer or sheets_util.sheet_writer
+        self.update_profile = update_profile or sheets_util.update_profile_row
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="sheets-replicator", daemon=True)
+            self._thread.start()
+
+    def close(self):
+        """停止背景同步，並在結束前再同步一輪"""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            self._replicate_safely()
+
+    def _run(self):
+        interval = self.interval
+        while not self._stop.wait(interval):
+            ok = self._replicate_safely()
+            interval = self.interval if ok else max(self.interval, sheets_util.SHEETS_RETRY_SECONDS)
+
+    def _replicate_safely(self) -> bool:
+        try:
+            with BACKGROUND_TASK_SECONDS.time("storage.replicate"):
+                self.replicate()
+            return True
+        except Exception as e:
+            BACKGROUND_TASK_FAILURES.inc("storage.replicate")
+            print(f"同步到 Google Sheet 失敗，下一輪重試: {e}")
+            return False
+
+    def replicate(self):
+        if not sheets_util.is_configured():
+            return
+
+        plans = self.store.unsynced_plans()
+        for start in range(0, len(plans), sheets_util.SHEETS_MAX_ROWS_PER_CALL):
+            chunk = plans[start:start + sheets_util.SHEETS_MAX_ROWS_PER_CALL]
+            rows = []
+            for row in chunk:
+                plan = _plan_dict(row)
+                rows.append(sheets_util.build_row(
+                    plan["user_id"], plan["user_name"], plan, plan, created_at=plan["created_at"],
+                    profile_type=plan["profile_type"], allocations=plan["allocations"] if plan["profile_type"] else None
+                ))
+            # 寫入失敗會拋出例外，這批保持未同步，下一輪重寫
+            self.writer.write_through(rows)
+            self.store.mark_plans_synced(chunk)
+
+        for row in self.store.unsynced_profiles():
+            plan = _plan_dict(row)
+            if self.update_profile(plan["user_id"], plan["profile_type"], plan["allocations"]):
+                self.store.mark_profile_synced(row["id"], row["profile_rev"])
+
+
+class ResultStore:
+    """
+    /api/calculate 的試算結果暫存：回傳短的 result_id 給前端，/api/send_result 只需帶回 result_id，
+    不必再上傳整份結果與歷年軌跡，內容也無法被竄改。
+    記憶體 LRU (筆數上限 + TTL)；設定 disk_path 時，被擠出記憶體的項目與關閉時尚未過期的項目寫到 SQLite，
+    之後仍可查到 (寫入磁碟只發生在淘汰時，一般的 put 不經過磁碟)。
+    """
+
+    def __init__(self, max_entries: int = RESULT_MAX_ENTRIES, ttl_seconds: float = RESULT_TTL_SECONDS, disk_path: str = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # result_id -> (data, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.spilled = 0
+
+        self._db = None
+        if disk_path:
+            self._db = sqlite3.connect(disk_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS result_store (result_id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)")
+            self._db.execute("DELETE FROM result_store WHERE expires_at <= ?", (time.time(),))
+            self._db.commit()
+
+    def put(self, data: dict) -> str:
+        """保存一份試算結果 (需可序列化成 JSON)，回傳 result_id"""
+        result_id = secrets.token_urlsafe(12)
+        expires_at = time.time() + self.ttl_seconds
+        with self._lock:
+            self._entries[result_id] = (data, expires_at)
+            if len(self._entries) > self.max_entries:
+                # 有磁碟層時一次擠出 10%，合併成一次寫入，而不是之後每次 put 都寫一次磁碟
+                target = self.max_entries - self.max_entries // 10 if self._db is not None else self.max_entries
+                spill = []
+                while len(self._entries) > target:
+                    spill.append(self._entries.popitem(last=False))
+                self._spill(spill)
+        return result_id
+
+    def get(self, result_id: str):
+        """回傳保存的試算結果，不存在或已過期時回傳 None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(result_id)
+            if entry and entry[1] > now:
+                self._entries.move_to_end(result_id)
+                self.hits += 1
+                return entry[0]
+            if entry:
+                del self._entries[result_id]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT data FROM result_store WHERE result_id = ? AND expires_at > ?", (result_id, now)
+                ).fetchone()
+                if row:
+                    self.disk_hits += 1
+                    return json.loads(row[0])
+
+            self.misses += 1
+            return None
+
+    def _spill(self, entries: list):
+        if self._db is None or not entries:
+            return
+        now = time.time()
+        rows = [(result_id, dumps(data).decode("utf-8"), expires_at) for result_id, (data, expires_at) in entries if expires_at > now]
+        self._db.executemany("INSERT OR REPLACE INTO result_store (result_id, data, expires_at) VALUES (?, ?, ?)", rows)
+        self.spilled += len(rows)
+        # 寫入時順便清除過期資料，磁碟層不會無限成長
+        self._db.execute("DELETE FROM result_store WHERE expires_at <= ?", (now,))
+        self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "spilled": self.spilled
+            }
+
+    def close(self):
+        """把記憶體中尚未過期的項目寫到磁碟，重啟後仍可使用"""
+        with self._lock:
+            self._spill(list(self._entries.items()))
+            self._entries.clear()
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,282 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from starlette.concurrency import run_in_threadpool
+from metrics_util import STAGE_SECONDS, BACKGROUND_TASK_FAILURES
+
+# 佇列上限 (待處理的 webhook 請求數) 與背景 worker 數量
+WEBHOOK_QUEUE_SIZE = 1000
+WEBHOOK_WORKERS = 4
+# 服務關閉時等待佇列清空的最長秒數
+WEBHOOK_DRAIN_SECONDS = 5.0
+# 已處理事件 ID 的保存時間與記憶體筆數上限 (LINE 逾時重送的事件在這段時間內會被略過)
+WEBHOOK_DEDUPE_TTL_SECONDS = 24 * 60 * 60
+WEBHOOK_DEDUPE_MAX_ENTRIES = 100000
+# 磁碟層每新增這麼多筆就清除一次過期資料
+WEBHOOK_DEDUPE_PRUNE_EVERY = 1000
+
+
+class InvalidSignatureError(Exception):
+    """
+    簽章不符。與 SDK 的 linebot.v3.exceptions.InvalidSignatureError 意義相同；
+    import 該模組會連帶載入 linebot.v3 整個 webhook 模型，因此在這裡另外定義。
+    """
+
+
+def _type_name(event_type) -> str:
+    return event_type if isinstance(event_type, str) else event_type.__name__
+
+
+def verify_signature(channel_secret: bytes, body: bytes, signature: str) -> bool:
+    """與 SDK 的 SignatureValidator 相同的 HMAC-SHA256 驗證，直接對原始 bytes 計算，不需先 decode"""
+    digest = hmac.new(channel_secret, body, hashlib.sha256).digest()
+    return hmac.compare_digest(signature.encode("utf-8"), base64.b64encode(digest))
+
+
+class EventDedupeCache:
+    """
+    webhookEventId 的去重集合：記憶體中以 OrderedDict 依加入順序保存 (TTL 固定，最舊的一定最先過期)，
+    每次查詢只清掉開頭已過期的項目，加上筆數上限，記憶體用量固定、每個事件 O(1)。
+    可選擇加上 SQLite 磁碟層，服務重啟後仍能辨識重送的事件。
+    worker 在 threadpool 中呼叫，所有操作都以 lock 保護。
+    """
+
+    def __init__(self, ttl_seconds: float = WEBHOOK_DEDUPE_TTL_SECONDS, max_entries: int = WEBHOOK_DEDUPE_MAX_ENTRIES,
+                 disk_path: str = None):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._seen = OrderedDict()  # event_id -> expires_at
+        self._lock = threading.Lock()
+        self._inserts = 0
+        self.duplicates = 0
+
+        self._db = None
+        if disk_path:
+            self._db = sqlite3.connect(disk_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS webhook_events (event_id TEXT PRIMARY KEY, expires_at REAL NOT NULL)")
+            self._db.execute("DELETE FROM webhook_events WHERE expires_at <= ?", (time.time(),))
+            self._db.commit()
+
+    def add(self, event_id: str) -> bool:
+        """記錄事件 ID；回傳 True 代表第一次看到，False 代表重複 (應略過)"""
+        now = time.time()
+        with self._lock:
+            while self._seen:
+                oldest_id, expires_at = next(iter(self._seen.items()))
+                if expires_at > now:
+                    break
+                del self._seen[oldest_id]
+
+            if event_id in self._seen:
+                self.duplicates += 1
+                return False
+
+            if self._db is not None and not self._add_to_disk(event_id, now):
+                self.duplicates += 1
+                self._remember(event_id, now + self.ttl_seconds)
+                return False
+
+            self._remember(event_id, now + self.ttl_seconds)
+            return True
+
+    def discard(self, event_id: str):
+        """取消事件 ID 的記錄 (handler 失敗或未處理時)，LINE 重送同一事件時會再處理一次"""
+        with self._lock:
+            self._seen.pop(event_id, None)
+            if self._db is not None:
+                self._db.execute("DELETE FROM webhook_events WHERE event_id = ?", (event_id,))
+                self._db.commit()
+
+    def _remember(self, event_id: str, expires_at: float):
+        self._seen[event_id] = expires_at
+        if len(self._seen) > self.max_entries:
+            self._seen.popitem(last=False)
+
+    def _add_to_disk(self, event_id: str, now: float) -> bool:
+        # 不存在或已過期才寫入；rowcount 為 0 代表磁碟上有尚未過期的同一個 ID
+        cursor = self._db.execute(
+            "INSERT INTO webhook_events (event_id, expires_at) VALUES (?, ?) "
+            "ON CONFLICT(event_id) DO UPDATE SET expires_at = excluded.expires_at WHERE webhook_events.expires_at <= ?",
+            (event_id, now + self.ttl_seconds, now)
+        )
+        self._inserts += 1
+        if self._inserts % WEBHOOK_DEDUPE_PRUNE_EVERY == 0:
+            self._db.execute("DELETE FROM webhook_events WHERE expires_at <= ?", (now,))
+        self._db.commit()
+        return cursor.rowcount > 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._seen)
+
+
+class WebhookDispatcher:
+    """
+    非阻塞的 webhook 處理：請求只做簽章驗證並把原始內容放進有上限的佇列，立即回應 LINE；
+    由背景 worker 解析事件 (在 threadpool 中進行，不佔用 event loop) 並分派給註冊的 handler。
+    SDK 的事件模型在第一次解析時才載入 (同樣在 threadpool 中)，服務啟動時不必等待。
+    佇列滿時拒絕新的請求 (load shedding)，確保回應時間不會超過 LINE 的逾時限制。
+    設定 dedupe 時，重送的事件 (相同 webhookEventId) 在建立事件物件之前就會被略過；
+    handler 失敗或因錯誤中斷而未處理的事件會取消記錄，之後重送時仍會處理。
+    """
+
+    def __init__(self, channel_secret: str, workers: int = WEBHOOK_WORKERS, max_queue: int = WEBHOOK_QUEUE_SIZE,
+                 dedupe: EventDedupeCache = None):
+        self.channel_secret = channel_secret.encode("utf-8")
+        self.workers = workers
+        self.max_queue = max_queue
+        self.dedupe = dedupe
+        self._handlers = {}
+        self._queue = None
+        self._tasks = []
+        self.received = 0
+        self.rejected = 0
+        self.invalid_signatures = 0
+        self.events_processed = 0
+        self.errors = 0
+        self.max_depth = 0
+
+    def add(self, event_type, message=None):
+        """
+        註冊 handler 的 decorator，用法與 SDK 的 WebhookHandler.add 相同：
+        @dispatcher.add(MessageEvent, message=TextMessageContent)
+        async def handle_text(event): ...
+        類別也可以用 linebot.v3.webhooks 中的名稱 (字串) 指定，註冊時不需要載入 SDK：
+        @dispatcher.add("MessageEvent", message="TextMessageContent")
+        """
+        key = (_type_name(event_type), _type_name(message) if message is not None else None)
+
+        def decorator(func):
+            self._handlers[key] = func
+            return func
+        return decorator
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, drain_seconds: float = WEBHOOK_DRAIN_SECONDS):
+        """等待佇列中的事件處理完 (最多 drain_seconds 秒) 後停止 worker"""
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=drain_seconds)
+        except asyncio.TimeoutError:
+            print(f"警告: 關閉時仍有 {self._queue.qsize()} 筆 webhook 未處理。")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def accept(self, body: bytes, signature: str) -> bool:
+        """
+        驗證簽章並放入佇列；簽章錯誤時拋出 InvalidSignatureError。
+        回傳 False 代表佇列已滿、請求被拒絕。
+        """
+        if not verify_signature(self.channel_secret, body, signature):
+            self.invalid_signatures += 1
+            raise InvalidSignatureError(f"Invalid signature. signature={signature}")
+
+        self.received += 1
+        try:
+            self._queue.put_nowait(body)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "queue_max_depth": self.max_depth,
+            "queue_size": self.max_queue,
+            "workers": len(self._tasks),
+            "received": self.received,
+            "rejected": self.rejected,
+            "invalid_signatures": self.invalid_signatures,
+            "events_processed": self.events_processed,
+            "duplicates": self.dedupe.duplicates if self.dedupe is not None else 0,
+            "dedupe_entries": len(self.dedupe) if self.dedupe is not None else 0,
+            "errors": self.errors
+        }
+
+    async def _worker(self):
+        while True:
+            body = await self._queue.get()
+            events = []
+            try:
+                with STAGE_SECONDS.time("webhook.parse"):
+                    events = await run_in_threadpool(self._parse_events, body)
+                while events:
+                    if not await self._dispatch(events[0]):
+                        await run_in_threadpool(self._forget, events[:1])
+                    events.pop(0)
+            except Exception as e:
+                self.errors += 1
+                BACKGROUND_TASK_FAILURES.inc("webhook.parse")
+                print(f"Webhook 處理失敗: {e}")
+            finally:
+                # 中斷 (錯誤或關閉時被取消) 而尚未處理的事件同樣取消去重記錄
+                if events:
+                    self._forget(events)
+                self._queue.task_done()
+
+    def _forget(self, events: list):
+        if self.dedupe is None:
+            return
+        for event in events:
+            event_id = getattr(event, "webhook_event_id", None)
+            if event_id:
+                self.dedupe.discard(event_id)
+
+    def _parse_events(self, body: bytes) -> list:
+        from linebot.v3.webhooks import Event
+        events = []
+        claimed = []
+        try:
+            for event in json.loads(body)["events"]:
+                event_id = event.get("webhookEventId")
+                if self.dedupe is not None and event_id:
+                    if not self.dedupe.add(event_id):
+                        continue
+                    claimed.append(event_id)
+                try:
+                    events.append(Event.from_dict(event))
+                except ValueError:
+                    # 尚未支援的事件類型，略過
+                    print(f"Unknown event type. type={event.get('type')}")
+        except BaseException:
+            # 內容格式錯誤而中途失敗：這次登記的事件都沒有處理，取消去重記錄，讓 LINE 重送時仍會處理
+            for event_id in claimed:
+                self.dedupe.discard(event_id)
+            raise
+        return events
+
+    async def _dispatch(self, event) -> bool:
+        """交給對應的 handler；handler 發生錯誤時回傳 False"""
+        event_type = type(event).__name__
+        message = getattr(event, "message", None) if event_type == "MessageEvent" else None
+        handler = self._handlers.get((event_type, type(message).__name__ if message is not None else None))
+        if handler is None:
+            handler = self._handlers.get((event_type, None))
+        self.events_processed += 1
+        if handler is None:
+            return True
+        try:
+            with STAGE_SECONDS.time("webhook.handler"):
+                await handler(event)
+            return True
+        except Exception as e:
+            self.errors += 1
+            BACKGROUND_TASK_FAILURES.inc("webhook.handler")
+            print(f"Webhook handler {handler.__name__} 發生錯誤: {e}")
+            return False